@@ -1,7 +1,5 @@
 from .utils import output
-from .settings import DB_FILES
 import db
-import os
 
 
 def initialize_address(conn):
@@ -9,21 +7,11 @@ def initialize_address(conn):
     return address.public_ip
 
 
-def assign_addresses(conn, instances):
-    """
-    Assign addresses for the first time
-    * Associate newly allocated addresses to instances
-    * Store mapping of each instance to addresses (name to public IPs)
-    """
-    data = []
-    for instance in instances:
-        public_ip = initialize_address(conn)
-        conn.associate_address(instance.id, public_ip)
-        instance.update()  # Update assigned tags
-        name = instance.tags.get("Name", "-")
-        data.append([name, public_ip])
-    filename = DB_FILES["addresses"]
-    db.write_data(filename, data)
+def assign_address(conn, instance_id):
+    """Associate a newly allocated address to an instance; return its IP"""
+    public_ip = initialize_address(conn)
+    conn.associate_address(instance_id, public_ip)
+    return public_ip
 
 
 def get_addresses():
@@ -33,14 +21,7 @@ def get_addresses():
       associated public IPs
 
     """
-    filename = DB_FILES["addresses"]
-    rows = db.read_data(filename)
-    addresses = {}
-    for row in rows:
-        name = row[0]
-        ip = row[1]
-        addresses[name] = ip
-    return addresses
+    return db.get_addresses()
 
 
 def release_all_addresses(conn):
@@ -48,4 +29,7 @@ def release_all_addresses(conn):
     all_addresses = conn.get_all_addresses()
     for address in all_addresses:
         if not address.instance_id:
-            address.release()
+            if address.allocation_id:
+                conn.release_address(allocation_id=address.allocation_id)
+            else:
+                conn.release_address(public_ip=address.public_ip)
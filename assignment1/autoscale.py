@@ -1,31 +1,38 @@
-import sys
-import time
-import boto.ec2
+# Autoscale
+# * Groups are set up and deleted concurrently, on up to `workers' threads;
+#   the security group, key pair, launch configurations and existing groups
+#   are looked up once for all groups
+# * Groups that fail are retried up to AS_RETRIES times, waiting
+#   EC2_DEFAULT_WAIT_INTERVAL seconds (doubled on each retry) in between; a
+#   retry goes on from the first step not done (the launch configuration
+#   and the group are only created once, policies and alarms are upserts)
 from boto.ec2.autoscale import (AutoScalingGroup,
                                 LaunchConfiguration, ScalingPolicy)
 from boto.ec2.cloudwatch import MetricAlarm
-from boto.exception import BotoServerError
+from . import clock, connections, fleet, regions
 from .cw import cw_conn
 from .keys import get_key_pair
-from .settings import (EC2_DEFAULT_REGION, AS_DEFAULT_MIN_SIZE,
-                       AS_DEFAULT_MAX_SIZE, EC2_DEFAULT_EBS_AZ,
-                       AS_DEFAULT_CPU_UP, AS_DEFAULT_CPU_DOWN,
-                       EC2_DEFAULT_INSTANCE_TYPE, EC2_DEFAULT_WAIT_INTERVAL)
+from .parallel import run_parallel
+from .settings import (AS_DEFAULT_MIN_SIZE, AS_DEFAULT_MAX_SIZE,
+                       AS_DEFAULT_CPU_UP, AS_DEFAULT_CPU_DOWN, AS_RETRIES,
+                       EC2_DEFAULT_WAIT_INTERVAL, EC2_DEFAULT_WORKERS)
 from .sg import get_security_group
 from .utils import output
+from .waiters import wait_for_instances
 
 
-as_conn = boto.ec2.autoscale.connect_to_region(EC2_DEFAULT_REGION)
+as_conn = connections.get("autoscale")
 
 
-def create_launch_configuration(conn, name, image_id):
+class AutoscaleError(Exception):
+    pass
 
-    sg = get_security_group(conn)
-    key_pair = get_key_pair(conn)
+
+def create_launch_configuration(name, image_id, sg, key_pair):
 
     lc = LaunchConfiguration(name=name, image_id=image_id,
                              key_name=key_pair.name, security_groups=[sg.name],
-                             instance_type=EC2_DEFAULT_INSTANCE_TYPE,
+                             instance_type=fleet.current.instance_type(name),
                              instance_monitoring=True)
 
     as_conn.create_launch_configuration(lc)
@@ -34,7 +41,7 @@ def create_launch_configuration(conn, name, image_id):
 
 def create_auto_scaling_group(name, lc):
     ag = AutoScalingGroup(group_name=name,
-                          availability_zones=[EC2_DEFAULT_EBS_AZ],
+                          availability_zones=[regions.zone()],
                           launch_config=lc, min_size=AS_DEFAULT_MIN_SIZE,
                           max_size=AS_DEFAULT_MAX_SIZE,
                           connection=as_conn)
@@ -43,7 +50,11 @@ def create_auto_scaling_group(name, lc):
 
 
 def create_scaling_policies(as_name):
-    """Create scaling up and scaling down policy"""
+    """
+    Create scaling up and scaling down policy
+    * Return a dictionary mapping policy names to the ARNs PutScalingPolicy
+      returned
+    """
 
     scale_up_policy = ScalingPolicy(
         name='scale_up', adjustment_type='ChangeInCapacity',
@@ -53,19 +64,16 @@ def create_scaling_policies(as_name):
         name='scale_down', adjustment_type='ChangeInCapacity',
         as_name=as_name, scaling_adjustment=-1, cooldown=180)
 
-    as_conn.create_scaling_policy(scale_up_policy)
-    as_conn.create_scaling_policy(scale_down_policy)
+    arns = {}
+    for policy in (scale_up_policy, scale_down_policy):
+        # boto keeps the PolicyARN element of the response as an attribute
+        arns[policy.name] = as_conn.create_scaling_policy(policy).PolicyARN
+    return arns
 
 
-def create_scaling_alarms(cw_conn, as_name):
+def create_scaling_alarms(cw_conn, as_name, policy_arns):
     """Create scaling up and scaling down alarms using CloudWatch"""
 
-    scale_up_policy = as_conn.get_all_policies(
-        as_group=as_name, policy_names=['scale_up'])[0]
-
-    scale_down_policy = as_conn.get_all_policies(
-        as_group=as_name, policy_names=['scale_down'])[0]
-
     alarm_dimensions = {"AutoScalingGroupName": as_name}
 
     scale_up_alarm = MetricAlarm(
@@ -73,7 +81,7 @@ def create_scaling_alarms(cw_conn, as_name):
         metric='CPUUtilization', statistic='Average',
         comparison='>', threshold=AS_DEFAULT_CPU_UP,
         period='60', evaluation_periods=2,
-        alarm_actions=[scale_up_policy.policy_arn],
+        alarm_actions=[policy_arns['scale_up']],
         dimensions=alarm_dimensions)
 
     scale_down_alarm = MetricAlarm(
@@ -81,65 +89,118 @@ def create_scaling_alarms(cw_conn, as_name):
         metric='CPUUtilization', statistic='Average',
         comparison='<', threshold=AS_DEFAULT_CPU_DOWN,
         period='60', evaluation_periods=2,
-        alarm_actions=[scale_down_policy.policy_arn],
+        alarm_actions=[policy_arns['scale_down']],
         dimensions=alarm_dimensions)
 
     cw_conn.create_alarm(scale_up_alarm)
     cw_conn.create_alarm(scale_down_alarm)
 
 
-def setup_autoscale_group(conn, name, image_id):
-    """Set up autoscale for an instance"""
-    msg = "Setting up Autoscale for instance %s (image_id: %s)..." \
-        % (name, image_id)
-    output.debug(msg)
-    lc = get_launch_configuration(conn, name, image_id)
-    groups = as_conn.get_all_groups(names=[name])
-    if groups:
-        name = groups[0].name
-        fmsg = ("Autoscale group %s already/still exists. "
-                "Please try again later, or make sure this group is deleted.")
-        msg = fmsg % name
-        output.warning(fmsg)
-        sys.exit(0)
-    create_auto_scaling_group(name, lc)
-    #as_conn.get_all_policies(policy_names=["scale_up", "scale_down"])
-    create_scaling_policies(name)
-    create_scaling_alarms(cw_conn, name)
-    output.success("Autoscale group %s created." % name)
-
-
-def delete_autoscale_group(conn, name):
-    msg = "Deleting Autoscale group %s..." % name
-    output.debug(msg)
-    ag = as_conn.get_all_groups(names=[name])[0]
-    ag.shutdown_instances()
-    instance_ids = [i.instance_id for i in ag.instances]
-    instances = conn.get_only_instances(instance_ids)
-    msg = "Shutting down instances in this group..."
-    output.debug(msg)
-    #activities = as_conn.get_all_activities(ag)
-    time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-    for instance in instances:
-        while instance.update() == "shutting-down":
-            time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-    time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-
-    try:
-        ag.delete()
-    except BotoServerError:
-        output.warning("This group still has activities. Try again later.")
-        sys.exit(0)
-
-    # Delete launch configuration
-    as_conn.delete_launch_configuration(name)
-    output.success("Autoscale group %s deleted." % name)
-
-
-def get_launch_configuration(conn, name, image_id):
-    """Get or create launch configuration with specified name"""
-    lcs = as_conn.get_all_launch_configurations(names=[name])
-    for lc in lcs:
-        if lc.name == name:
-            return lc
-    return create_launch_configuration(conn, name, image_id)
+def setup_autoscale_groups(conn, image_ids, workers=EC2_DEFAULT_WORKERS):
+    """
+    Set up an Autoscale group per instance
+    * `image_ids' maps instance names to the AMIs of their groups
+    * Return a list of TaskResult, one per instance name
+    """
+    sg = get_security_group(conn)
+    key_pair = get_key_pair(conn)
+    lcs = {}
+    existing = []
+    created = set()  # Groups created by this call
+
+    def lookup():
+        # Groups and launch configurations are looked up again before each
+        # round, since groups being deleted may be gone by a retry, and a
+        # failed round may have created some
+        lcs.clear()
+        lcs.update((lc.name, lc) for lc in
+                   _get_all(as_conn.get_all_launch_configurations))
+        existing[:] = [g.name for g in _get_all(as_conn.get_all_groups)]
+
+    def setup(name):
+        if name in existing and name not in created:
+            raise AutoscaleError("Autoscale group %s already/still exists" %
+                                 name)
+        output.debug("Setting up Autoscale for instance %s (image_id: %s)..."
+                     % (name, image_ids[name]))
+        lc = lcs.get(name)
+        if lc is None:
+            lc = create_launch_configuration(name, image_ids[name], sg,
+                                             key_pair)
+        if name not in existing:
+            create_auto_scaling_group(name, lc)
+            created.add(name)
+        policy_arns = create_scaling_policies(name)
+        create_scaling_alarms(cw_conn, name, policy_arns)
+        output.success("Autoscale group %s created." % name)
+
+    return _run_with_retries(setup, sorted(image_ids), workers, lookup)
+
+
+def delete_autoscale_groups(conn, names=None, workers=EC2_DEFAULT_WORKERS):
+    """
+    Delete Autoscale groups and their launch configurations
+    * `names' are the names of the groups, all groups if not given
+    * Instances of all groups are shut down at once, then groups are
+      deleted as soon as their scaling activities are over
+    * Return a list of TaskResult, one per group name
+    """
+    groups = [g for g in _get_all(as_conn.get_all_groups)
+              if names is None or g.name in names]
+    names = [g.name for g in groups]
+    for name in names:
+        output.debug("Deleting Autoscale group %s..." % name)
+    run_parallel(lambda group: group.shutdown_instances(), groups, workers)
+    instance_ids = [i.instance_id for g in groups for i in g.instances]
+    output.debug("Shutting down %d instances in these groups..." %
+                 len(instance_ids))
+    wait_for_instances(conn, instance_ids, "terminated", pending=None)
+
+    deleted = set()
+
+    def delete(name):
+        # A group is kept while its scaling activities are in progress
+        if name not in deleted:
+            as_conn.delete_auto_scaling_group(name)
+            deleted.add(name)
+        as_conn.delete_launch_configuration(name)
+        output.success("Autoscale group %s deleted." % name)
+
+    return _run_with_retries(delete, names, workers)
+
+
+def _run_with_retries(func, names, workers, before=None):
+    """
+    Run `func(name)' for every name concurrently, retrying the names that
+    failed; `before()' is called before each round
+    * Return a list of TaskResult in the same order as `names'
+    """
+    results = {}
+    pending = list(names)
+    delay = EC2_DEFAULT_WAIT_INTERVAL
+    for attempt in range(AS_RETRIES + 1):
+        if attempt:
+            output.warning("Retrying %d Autoscale group(s) in %d seconds..."
+                           % (len(pending), delay))
+            clock.sleep(delay)
+            delay *= 2
+        if before is not None:
+            before()
+        for result in run_parallel(func, pending, workers):
+            results[result.item] = result
+        pending = [name for name in pending if not results[name].ok]
+        if not pending:
+            break
+    return [results[name] for name in names]
+
+
+def _get_all(method, **kwargs):
+    """Follow the NextToken of a Describe* call of Autoscale"""
+    items = []
+    next_token = None
+    while True:
+        page = method(next_token=next_token, **kwargs)
+        items.extend(page)
+        next_token = getattr(page, "next_token", None)
+        if not next_token:
+            return items
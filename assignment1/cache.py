@@ -0,0 +1,137 @@
+# Per-run memoizing cache for EC2 describe calls
+import threading
+
+from . import clock, regions
+from .settings import EC2_CACHE_TTL
+
+
+# Describe calls served from the cache, and the resource kind they read
+CACHED_CALLS = {
+    "get_only_instances": "instances",
+    "get_all_instances": "instances",
+    "get_all_reservations": "instances",
+    "get_all_volumes": "volumes",
+    "get_all_snapshots": "snapshots",
+    "get_all_images": "images",
+    "get_image": "images",
+    "get_all_security_groups": "security_groups",
+    "get_key_pair": "key_pairs",
+    "get_all_key_pairs": "key_pairs",
+    "get_all_addresses": "addresses",
+}
+
+# Mutating calls, and the resource kinds whose cached entries they invalidate
+INVALIDATING_CALLS = {
+    "run_instances": ("instances",),
+    "terminate_instances": ("instances",),
+    "stop_instances": ("instances",),
+    "start_instances": ("instances",),
+    "create_tags": ("instances", "volumes", "snapshots", "images"),
+    "delete_tags": ("instances", "volumes", "snapshots", "images"),
+    "create_volume": ("volumes",),
+    "delete_volume": ("volumes",),
+    "attach_volume": ("instances", "volumes"),
+    "detach_volume": ("instances", "volumes"),
+    "create_snapshot": ("snapshots",),
+    "copy_snapshot": ("snapshots",),
+    "delete_snapshot": ("snapshots",),
+    "create_image": ("images",),
+    "deregister_image": ("images",),
+    "allocate_address": ("addresses",),
+    "release_address": ("addresses",),
+    "associate_address": ("instances", "addresses"),
+    "disassociate_address": ("instances", "addresses"),
+    "create_security_group": ("security_groups",),
+    "authorize_security_group": ("security_groups",),
+    "create_key_pair": ("key_pairs",),
+}
+
+
+class CachedConnection(object):
+    """
+    Memoizing proxy in front of an EC2 connection
+    * Describe calls listed in CACHED_CALLS are served from memory for `ttl'
+      seconds after they were first made with the same arguments
+    * Calls listed in INVALIDATING_CALLS drop the cached entries of the
+      resource kinds they change
+    * Entries are kept per region of the calling thread (see regions.py), so
+      that a connection following that region caches each apart
+    * A describe call invalidated while it ran (e.g. by a mutation on another
+      thread) returns its result without caching it, as it may be stale
+    * Every other attribute is passed through to the wrapped connection
+
+    Mutations must go through this proxy (e.g. `conn.detach_volume(id)'
+    rather than `volume.detach()') for invalidation to take effect.
+    """
+
+    def __init__(self, connection, ttl=EC2_CACHE_TTL):
+        self.uncached = connection
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # Mapping of (kind, region, key) to (expiry, value)
+        self._generations = {}  # Invalidations of each (kind, region)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.uncached, name)
+        if name in CACHED_CALLS:
+            return self._cached(CACHED_CALLS[name], name, attr)
+        if name in INVALIDATING_CALLS:
+            return self._invalidating(INVALIDATING_CALLS[name], attr)
+        return attr
+
+    def _cached(self, kind, name, func):
+        def call(*args, **kwargs):
+            region = regions.current()
+            key = (kind, region, repr((name, args, sorted(kwargs.items()))))
+            now = clock.now()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] > now:
+                    self.hits += 1
+                    return entry[1]
+                self.misses += 1
+                generation = self._generations.get((kind, region), 0)
+            value = func(*args, **kwargs)
+            with self._lock:
+                if self._generations.get((kind, region), 0) == generation:
+                    self._entries[key] = (now + self.ttl, value)
+            return value
+        return call
+
+    def _invalidating(self, kinds, func):
+        def call(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.invalidate(*kinds)
+        return call
+
+    def invalidate(self, *kinds):
+        """
+        Drop cached entries of the given resource kinds (all if none) in the
+        region of the calling thread
+        """
+        region = regions.current()
+        with self._lock:
+            for kind in kinds or set(CACHED_CALLS.values()):
+                self._generations[(kind, region)] = \
+                    self._generations.get((kind, region), 0) + 1
+            for key in list(self._entries):
+                if (not kinds or key[0] in kinds) and key[1] == region:
+                    del self._entries[key]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def uncached(conn):
+    """Get the connection behind a CachedConnection, for polling calls"""
+    return getattr(conn, "uncached", conn)
+
+
+def invalidate(conn, *kinds):
+    """Invalidate cached entries if `conn' is a CachedConnection"""
+    if isinstance(conn, CachedConnection):
+        conn.invalidate(*kinds)
@@ -0,0 +1,63 @@
+# Time source for waiters, caches and worker pools
+# * By default this is the wall clock of the time module
+# * The simulator installs a virtual clock so that waits are simulated rather
+#   than slept; it has to know which threads are runnable, which is why worker
+#   threads are started and joined through this module
+import contextlib
+import time as _time
+
+
+class Clock(object):
+    """Wall clock"""
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+    def start_thread(self, thread):
+        thread.start()
+
+    def thread_done(self):
+        pass
+
+    @contextlib.contextmanager
+    def blocked(self):
+        yield
+
+
+_clock = Clock()
+
+
+def install(clock):
+    """Install `clock' as the time source, returning the previous one"""
+    global _clock
+    previous = _clock
+    _clock = clock
+    return previous
+
+
+def now():
+    return _clock.time()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+
+def start_thread(thread):
+    """Start a worker thread, which must call thread_done() when it ends"""
+    _clock.start_thread(thread)
+
+
+def thread_done():
+    _clock.thread_done()
+
+
+def blocked():
+    """
+    Context manager around a wait on other threads (e.g. Thread.join()),
+    during which the current thread is not runnable
+    """
+    return _clock.blocked()
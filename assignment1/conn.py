@@ -1,5 +1,5 @@
-import boto.ec2
-from .settings import EC2_DEFAULT_REGION
+from .cache import CachedConnection
+from . import connections
 
 
-conn = boto.ec2.connect_to_region(EC2_DEFAULT_REGION)
+conn = CachedConnection(connections.get("ec2"))
@@ -0,0 +1,177 @@
+# Connection registry
+# * Clients of AWS services are created on first use rather than at import
+#   time, so that commands only pay for the services they call
+# * boto modules of a service are imported when it is first connected to
+# * Clients are pooled per (service, region): each thread is bound to a
+#   client of its own, which goes back to the pool when the thread is done
+#   (see release_thread()), so that worker threads reuse the kept-alive
+#   HTTP(S) connections of earlier workers instead of opening new ones
+# * Connections got without a region use the region of the calling thread
+#   (see regions.py)
+import threading
+
+from . import regions
+from .metrics import instrument
+from .settings import (EC2_DEFAULT_REGION, AWS_CONNECTION_POOL_SIZE,
+                       S3_ENDPOINT, S3_IS_SECURE)
+
+
+def _connect_ec2(region):
+    import boto.ec2
+    return boto.ec2.connect_to_region(region)
+
+
+def _connect_cloudwatch(region):
+    import boto.ec2.cloudwatch
+    return boto.ec2.cloudwatch.connect_to_region(region)
+
+
+def _connect_autoscale(region):
+    import boto.ec2.autoscale
+    return boto.ec2.autoscale.connect_to_region(region)
+
+
+def _connect_s3(region):
+    """Connect to Amazon S3, or to the S3-compatible S3_ENDPOINT if set"""
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+    if S3_ENDPOINT:
+        host, _, port = S3_ENDPOINT.partition(":")
+        return S3Connection(host=host, port=int(port) if port else None,
+                            is_secure=S3_IS_SECURE,
+                            calling_format=OrdinaryCallingFormat())
+    if region != EC2_DEFAULT_REGION:
+        import boto.s3
+        return boto.s3.connect_to_region(region)
+    return S3Connection()
+
+
+CONNECTORS = {
+    "ec2": _connect_ec2,
+    "cloudwatch": _connect_cloudwatch,
+    "autoscale": _connect_autoscale,
+    "s3": _connect_s3,
+}
+
+
+def connect(service, region=EC2_DEFAULT_REGION):
+    """Create an instrumented client of `service' (key of CONNECTORS)"""
+    return instrument(CONNECTORS[service](region), service)
+
+
+class ConnectionPool(object):
+    """
+    Clients of one service in one region
+    * Threads are bound to a client on first use; when more threads than
+      `size' are active, extra clients are created rather than making
+      threads wait, and dropped when released to a full pool
+    """
+
+    def __init__(self, service, region, size=AWS_CONNECTION_POOL_SIZE):
+        self.service = service
+        self.region = region
+        self.size = size
+        self.created = 0
+        self.reused = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.created += 1
+        return connect(self.service, self.region)
+
+    def release(self, client):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(client)
+                return
+        client.close()
+
+    def client(self):
+        """Get the client bound to the current thread"""
+        bound = _bound_clients()
+        if self not in bound:
+            bound[self] = self.acquire()
+        return bound[self]
+
+    def stats(self):
+        return {"created": self.created, "reused": self.reused,
+                "idle": len(self._idle)}
+
+
+class PooledConnection(object):
+    """
+    Proxy passing every attribute access to the client of a pool bound to
+    the calling thread
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.pool.client(), name)
+
+    @property
+    def connected(self):
+        return self.pool.created > 0
+
+
+class RegionalConnection(PooledConnection):
+    """
+    Pooled connection to `service' in the region of the calling thread
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    @property
+    def pool(self):
+        return get_pool(self.service, regions.current())
+
+
+_pools = {}  # Mapping of (service, region) to ConnectionPool
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+
+def _bound_clients():
+    if not hasattr(_local, "clients"):
+        _local.clients = {}  # Mapping of ConnectionPool to client
+    return _local.clients
+
+
+def get_pool(service, region=EC2_DEFAULT_REGION):
+    with _pools_lock:
+        key = (service, region)
+        if key not in _pools:
+            _pools[key] = ConnectionPool(service, region)
+        return _pools[key]
+
+
+def get(service, region=None):
+    """
+    Get a thread-safe connection to `service' in `region', or in the region
+    of each calling thread
+    """
+    if region is None:
+        return RegionalConnection(service)
+    return PooledConnection(get_pool(service, region))
+
+
+def release_thread():
+    """Return the clients bound to the current thread to their pools"""
+    bound = _bound_clients()
+    while bound:
+        pool, client = bound.popitem()
+        pool.release(client)
+
+
+def stats():
+    """Return the statistics of every pool, by (service, region)"""
+    with _pools_lock:
+        return dict((key, pool.stats()) for key, pool in _pools.items())
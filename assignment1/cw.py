@@ -1,10 +1,12 @@
 # CloudWatch
+import calendar
 import datetime
-import boto.ec2.cloudwatch
-from .settings import EC2_DEFAULT_REGION
+import math
+from . import connections
+from .settings import CW_EBS_PERIOD
 
 
-cw_conn = boto.ec2.cloudwatch.connect_to_region(EC2_DEFAULT_REGION)
+cw_conn = connections.get("cloudwatch")
 
 
 def get_cpu_stat(cw_conn, instanced_id, minutes=10):
@@ -29,3 +31,53 @@ def get_cpu_stat(cw_conn, instanced_id, minutes=10):
         percent = stat[0]["Average"]
         return percent
     return 0.00
+
+
+def get_volume_writes(cw_conn, volume_id, start_time, end_time):
+    """
+    Get the writes to an EBS volume between two UTC datetimes
+    * Return a tuple of write operations, bytes written, and the end of the
+      last period CloudWatch reported; None if it has no data
+    """
+    span = (end_time - start_time).total_seconds()
+    # At most 1440 datapoints are returned per request
+    period = max(CW_EBS_PERIOD, int(math.ceil(span / 1440 / 60)) * 60)
+    totals = []
+    covered_until = None
+    for metric_name in ("VolumeWriteOps", "VolumeWriteBytes"):
+        stat = cw_conn.get_metric_statistics(
+            period=period,
+            start_time=start_time,
+            end_time=end_time,
+            metric_name=metric_name,
+            namespace='AWS/EBS',
+            statistics='Sum',
+            dimensions={'VolumeId': [volume_id]}
+            )
+        if not stat:
+            return None
+        totals.append(sum(point["Sum"] for point in stat))
+        last = max(point["Timestamp"] for point in stat)
+        end = last + datetime.timedelta(seconds=period)
+        covered_until = min(covered_until or end, end)
+    return totals[0], totals[1], covered_until
+
+
+def get_instance_samples(cw_conn, instance_id, metric_name, statistic,
+                         start, end, period):
+    """
+    Get the datapoints of an instance metric between two timestamps
+    * Return a list of (timestamp, value) in time order, timestamps being
+      the start of each `period'
+    """
+    stat = cw_conn.get_metric_statistics(
+        period=period,
+        start_time=datetime.datetime.utcfromtimestamp(start),
+        end_time=datetime.datetime.utcfromtimestamp(end),
+        metric_name=metric_name,
+        namespace='AWS/EC2',
+        statistics=statistic,
+        dimensions={'InstanceId': [instance_id]}
+        )
+    return sorted((calendar.timegm(point["Timestamp"].utctimetuple()),
+                   point[statistic]) for point in stat)
@@ -0,0 +1,243 @@
+# Idle detection and auto-store daemon
+# * Every DAEMON_POLL_INTERVAL seconds the running instances of the account
+#   are listed and their idleness evaluated (EC2_INSTANCE_IDLE_TIME,
+#   IDLE_RULES); each idle instance is stored right away on a thread of its
+#   own, at most DAEMON_WORKERS at a time
+# * The first time an instance is seen busy on a day is recorded in its
+#   history, which prewarm learns from; instances prewarmed less than
+#   PREWARM_HOLD seconds ago are not stored
+# * Connections are kept for the life of the daemon
+# * Health and metrics are served on DAEMON_HTTP_ADDRESS (localhost):
+#   GET /health (JSON) and GET /metrics (Prometheus text format)
+import BaseHTTPServer
+import datetime
+import json
+import threading
+
+from . import clock, connections, db, regions
+from .cache import invalidate
+from .conn import conn
+from .idle import detector as idle_detector
+from .instances import get_instances, get_idle_instances, store_instance
+from .metrics import metrics
+from .settings import (DAEMON_POLL_INTERVAL, DAEMON_WORKERS,
+                       DAEMON_HTTP_ADDRESS, EC2_INSTANCE_IDLE_TIME,
+                       PREWARM_HOLD)
+from .utils import output
+
+
+class Daemon(object):
+    """
+    Scheduler keeping a view of the fleet and storing idle instances
+    * `time_limit' and `detector' decide which instances are idle (see
+      get_idle_instances), `copy_snapshots' is passed to the store of each
+      instance
+    """
+
+    def __init__(self, conn, interval=DAEMON_POLL_INTERVAL,
+                 workers=DAEMON_WORKERS, time_limit=EC2_INSTANCE_IDLE_TIME,
+                 detector=idle_detector, copy_snapshots=False):
+        self.conn = conn
+        self.interval = interval
+        self.workers = workers
+        self.time_limit = time_limit
+        self.detector = detector
+        self.copy_snapshots = copy_snapshots
+        self.instances = {}  # Mapping of instance ids to running instances
+        self.polls = 0
+        self.last_poll = None
+        self.last_error = None
+        self.stored = 0
+        self.failed = 0
+        self._storing = {}  # Mapping of instance ids to store threads
+        self._active = {}  # Mapping of names to the last day seen busy
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._polling = False  # Whether polls are due, until run() returns
+
+    def run(self, rounds=None):
+        """Poll until stopped, or `rounds' times; wait for running stores"""
+        self._polling = True
+        try:
+            while not self._stopped and rounds != 0:
+                self.poll()
+                if rounds is not None:
+                    rounds -= 1
+                    if rounds == 0:
+                        break
+                clock.sleep(self.interval)
+        finally:
+            # No poll is overdue while the last stores are waited for
+            self._polling = False
+        self.join()
+
+    def stop(self):
+        self._stopped = True
+
+    def poll(self):
+        """Refresh the view of the fleet and store the idle instances"""
+        try:
+            invalidate(self.conn, "instances", "volumes")
+            instances = list(get_instances(self.conn))
+            held = db.get_history(clock.now() - PREWARM_HOLD, ["prewarm"])
+            with self._lock:
+                self.instances = dict((i.id, i) for i in instances)
+                candidates = [i for i in instances
+                              if i.id not in self._storing and
+                              i.tags.get("Name") not in held]
+            idle = get_idle_instances(self.conn, self.time_limit,
+                                      candidates, self.detector)
+            for instance in idle:
+                self._submit(instance)
+            self._record_active(instances)
+            self.last_error = None
+        except Exception as e:
+            self.last_error = "%s: %s" % (e.__class__.__name__, e)
+            output.error("Daemon poll failed: %s" % self.last_error)
+        self.polls += 1
+        self.last_poll = clock.now()
+
+    def _record_active(self, instances):
+        """Record the instances seen busy for the first time today"""
+        now = clock.now()
+        today = datetime.date.fromtimestamp(now)
+        rows = []
+        for instance in instances:
+            name = instance.tags.get("Name")
+            if (name and self._active.get(name) != today and
+                    self.detector.is_busy(instance.id, now)):
+                self._active[name] = today
+                rows.append((name, "active", now, None))
+        db.put_history(rows)
+
+    def _submit(self, instance):
+        """Store `instance' on a new thread unless all workers are busy"""
+        name = instance.tags.get("Name", "-")
+        with self._lock:
+            if len(self._storing) >= self.workers:
+                output.debug("All workers busy; instance %s is left for the "
+                             "next poll." % name)
+                return
+            thread = threading.Thread(target=regions.bound(self._store),
+                                      args=(instance,))
+            thread.daemon = True
+            self._storing[instance.id] = thread
+        output.debug("Storing idle instance %s (%s)..." % (name, instance.id))
+        clock.start_thread(thread)
+
+    def _store(self, instance):
+        name = instance.tags.get("Name", "-")
+        try:
+            try:
+                store_instance(self.conn, instance, self.copy_snapshots)
+            except Exception as e:
+                output.error("Could not store instance %s: %s" % (name, e))
+                with self._lock:
+                    self.failed += 1
+            else:
+                output.success("Instance %s is stored." % name)
+                with self._lock:
+                    self.stored += 1
+        finally:
+            with self._lock:
+                del self._storing[instance.id]
+                self.instances.pop(instance.id, None)
+            connections.release_thread()
+            db.close()
+            clock.thread_done()
+
+    def join(self):
+        """Wait for the stores in progress"""
+        while True:
+            with self._lock:
+                threads = self._storing.values()
+            if not threads:
+                return
+            with clock.blocked():
+                for thread in threads:
+                    thread.join()
+
+    def health(self):
+        with self._lock:
+            storing = sorted(self._storing)
+            num_instances = len(self.instances)
+        overdue = (self._polling and self.last_poll is not None and
+                   clock.now() - self.last_poll > 3 * self.interval)
+        healthy = (self.last_poll is not None and not self.last_error and
+                   not overdue)
+        return {
+            "status": "ok" if healthy else "degraded",
+            "polls": self.polls,
+            "last_poll": self.last_poll,
+            "last_error": self.last_error,
+            "instances": num_instances,
+            "storing": storing,
+            "stored": self.stored,
+            "failed": self.failed,
+        }
+
+    def to_prometheus(self):
+        health = self.health()
+        lines = []
+        for name, kind, value in (
+                ("polls_total", "counter", health["polls"]),
+                ("last_poll_timestamp_seconds", "gauge",
+                 health["last_poll"] or 0),
+                ("instances", "gauge", health["instances"]),
+                ("storing", "gauge", len(health["storing"])),
+                ("stored_total", "counter", health["stored"]),
+                ("store_failures_total", "counter", health["failed"]),
+                ("up", "gauge", int(health["status"] == "ok"))):
+            lines.append("# TYPE assignment1_daemon_%s %s" % (name, kind))
+            lines.append("assignment1_daemon_%s %s" % (name, value))
+        return "\n".join(lines) + "\n" + metrics.to_prometheus()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        if self.path == "/health":
+            health = daemon.health()
+            code = 200 if health["status"] == "ok" else 503
+            self._reply(code, "application/json", json.dumps(health))
+        elif self.path == "/metrics":
+            self._reply(200, "text/plain; version=0.0.4",
+                        daemon.to_prometheus())
+        else:
+            self._reply(404, "text/plain", "Not found\n")
+
+    def _reply(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(daemon, address=DAEMON_HTTP_ADDRESS):
+    """Serve the health and metrics of `daemon' on a background thread"""
+    server = BaseHTTPServer.HTTPServer(address, _Handler)
+    server.daemon = daemon
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def run_daemon(conn=conn):
+    daemon = Daemon(conn)
+    server = serve(daemon)
+    output.debug("Daemon started; health and metrics on http://%s:%d/" %
+                 server.server_address)
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        output.debug("Stopping daemon; waiting for stores in progress...")
+        daemon.stop()
+        daemon.join()
+    finally:
+        server.shutdown()
@@ -1,11 +1,362 @@
 # I/O operations for locally stored data
+# * State lives in an SQLite database in WAL mode (DB_STATE_FILE), indexed by
+#   virtual machine name and timestamp
+# * The legacy CSV files (DB_FILES) are imported into the DB of
+#   EC2_DEFAULT_REGION on first use
+# * Snapshots are recorded with their lineage: the volume they were taken of
+#   and the snapshot that volume was created from
+# * The journal records the steps of store and restore completed for each
+#   resource, so that an interrupted run can be resumed (see journal.py)
+# * The history records when each virtual machine was stored, restored and
+#   first seen busy each day, from which prewarm predicts when it is needed
+#   (see prewarm.py)
+# * Each region has a state DB of its own (see regions.py): DB_STATE_FILE
+#   for EC2_DEFAULT_REGION, e.g. state.us-west-2.db next to it for others
 import csv
+import json
+import os
+import sqlite3
+import threading
+import time
 
+from . import regions
+from .settings import DB_FILES, DB_STATE_FILE, EC2_DEFAULT_REGION
+from .utils import output
 
-def write_data(filename, rows):
-    with open(filename, 'w') as f:
-        writer = csv.writer(f)
-        writer.writerows(rows)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS addresses (
+    name TEXT PRIMARY KEY,
+    public_ip TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    snapshot_id TEXT NOT NULL,
+    volume_id TEXT,
+    parent_id TEXT,
+    PRIMARY KEY (name, created_at)
+);
+CREATE INDEX IF NOT EXISTS snapshots_id ON snapshots (snapshot_id);
+CREATE TABLE IF NOT EXISTS samples (
+    instance_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (instance_id, metric, timestamp)
+);
+CREATE INDEX IF NOT EXISTS samples_timestamp ON samples (timestamp);
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    image_id TEXT NOT NULL,
+    PRIMARY KEY (name, created_at)
+);
+CREATE TABLE IF NOT EXISTS journal (
+    command TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    step TEXT NOT NULL,
+    value TEXT,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (command, resource, step)
+);
+CREATE TABLE IF NOT EXISTS history (
+    name TEXT NOT NULL,
+    event TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    duration REAL,
+    PRIMARY KEY (name, event, timestamp)
+);
+CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp);
+"""
+
+path = DB_STATE_FILE
+csv_files = DB_FILES
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = set()
+
+
+def region_path(region):
+    """Path of the state DB of `region'"""
+    if region == EC2_DEFAULT_REGION:
+        return path
+    root, ext = os.path.splitext(path)
+    return "%s.%s%s" % (root, region, ext)
+
+
+def connect():
+    """
+    Get the state DB connection of the current thread, to the DB of its
+    region
+    """
+    db = getattr(_local, "db", None)
+    db_path = region_path(regions.current())
+    if db is None or _local.path != db_path:
+        if db is not None:
+            db.close()
+        db = sqlite3.connect(db_path, timeout=30)
+        db.text_factory = str
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        _local.db = db
+        _local.path = db_path
+        with _init_lock:
+            if db_path not in _initialized:
+                db.executescript(SCHEMA)
+                _migrate_columns(db)
+                if db_path == region_path(EC2_DEFAULT_REGION):
+                    _migrate_csv(db)
+                _initialized.add(db_path)
+    return db
+
+
+def close():
+    """
+    Close the state DB connection of the current thread
+    * Worker threads close theirs before they end, rather than leaving it to
+      the garbage collector at some later point
+    """
+    db = getattr(_local, "db", None)
+    if db is not None:
+        db.close()
+        _local.db = None
+
+
+def put_addresses(rows):
+    """Upsert (name, public_ip) rows"""
+    now = time.time()
+    with connect() as db:
+        db.executemany(
+            "INSERT OR REPLACE INTO addresses VALUES (?, ?, ?)",
+            [(name, ip, now) for name, ip in rows])
+
+
+def get_addresses():
+    """Return a dictionary mapping virtual machine names to public IPs"""
+    rows = connect().execute("SELECT name, public_ip FROM addresses")
+    return dict(rows)
+
+
+def put_snapshot(name, snapshot_id, created_at=None, volume_id=None,
+                 parent_id=None):
+    """
+    Record `snapshot_id' as the latest snapshot of virtual machine `name'
+    * `volume_id' is the data volume it stands for, `parent_id' the snapshot
+      that volume was created from; a snapshot reused for an unchanged
+      volume is its own parent
+    """
+    with connect() as db:
+        db.execute("INSERT OR REPLACE INTO snapshots (name, created_at, "
+                   "snapshot_id, volume_id, parent_id) VALUES "
+                   "(?, ?, ?, ?, ?)",
+                   (name, created_at or time.time(), snapshot_id, volume_id,
+                    parent_id))
+
+
+def get_latest_snapshots():
+    """
+    Return a dictionary mapping snapshot ids to virtual machine names, for
+    the latest snapshot of each virtual machine
+    """
+    # The other columns of a MAX() row come from the row of the maximum,
+    # found on the (name, created_at) index
+    rows = connect().execute(
+        "SELECT snapshot_id, name, MAX(created_at) FROM snapshots "
+        "GROUP BY name")
+    return dict((snapshot_id, name) for snapshot_id, name, _ in rows)
+
+
+def get_lineage(snapshot_id):
+    """
+    Return the (snapshot_id, volume_id, parent_id) rows of a snapshot and its
+    recorded ancestors, newest first
+    """
+    lineage = []
+    seen = set()
+    db = connect()
+    while snapshot_id and snapshot_id not in seen:
+        seen.add(snapshot_id)
+        row = db.execute(
+            "SELECT snapshot_id, volume_id, parent_id FROM snapshots "
+            "WHERE snapshot_id = ? ORDER BY created_at LIMIT 1",
+            (snapshot_id,)).fetchone()
+        if row is None:
+            break
+        lineage.append(row)
+        snapshot_id = row[2]
+    return lineage
+
+
+def delete_snapshots(snapshot_ids):
+    with connect() as db:
+        db.executemany("DELETE FROM snapshots WHERE snapshot_id = ?",
+                       [(sid,) for sid in snapshot_ids])
+
+
+def put_image(name, image_id, created_at=None):
+    with connect() as db:
+        db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?)",
+                   (name, created_at or time.time(), image_id))
+
+
+def get_latest_images():
+    """Return a dictionary mapping virtual machine names to latest AMI ids"""
+    rows = connect().execute(
+        "SELECT name, image_id FROM images i WHERE created_at = "
+        "(SELECT MAX(created_at) FROM images WHERE name = i.name)")
+    return dict(rows)
+
+
+def put_samples(rows):
+    """Insert (instance_id, metric, timestamp, value) metric samples"""
+    with connect() as db:
+        db.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)",
+                       rows)
+
+
+def get_samples(instance_ids):
+    """
+    Return a dictionary mapping (instance_id, metric) to lists of
+    (timestamp, value) samples in time order
+    """
+    samples = {}
+    db = connect()
+    for instance_id in instance_ids:
+        rows = db.execute(
+            "SELECT metric, timestamp, value FROM samples "
+            "WHERE instance_id = ? ORDER BY timestamp", (instance_id,))
+        for metric, timestamp, value in rows:
+            samples.setdefault((instance_id, metric), []).append(
+                (timestamp, value))
+    return samples
+
+
+def prune_samples(before):
+    """Delete metric samples older than timestamp `before'"""
+    with connect() as db:
+        db.execute("DELETE FROM samples WHERE timestamp < ?", (before,))
+
+
+def put_journal(command, resource, step, value=None):
+    """Record that `step' of `command' is done for `resource'"""
+    with connect() as db:
+        db.execute("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?)",
+                   (command, resource, step, json.dumps(value), time.time()))
+
+
+def get_journal(command):
+    """
+    Return a dictionary mapping the resources of `command' to dictionaries
+    mapping their recorded steps to values
+    """
+    journal = {}
+    rows = connect().execute(
+        "SELECT resource, step, value FROM journal WHERE command = ? "
+        "ORDER BY created_at", (command,))
+    for resource, step, value in rows:
+        journal.setdefault(resource, {})[step] = json.loads(value)
+    return journal
+
+
+def delete_journal(command, resources=None):
+    """Forget the steps of `command' for `resources', or for all resources"""
+    with connect() as db:
+        if resources is None:
+            db.execute("DELETE FROM journal WHERE command = ?", (command,))
+        else:
+            db.executemany(
+                "DELETE FROM journal WHERE command = ? AND resource = ?",
+                [(command, resource) for resource in resources])
+
+
+def put_history(rows):
+    """
+    Record (name, event, timestamp, duration) events of virtual machines
+    * Events are "store", "restore" and "prewarm", with the seconds they
+      took, and "active", without
+    """
+    with connect() as db:
+        db.executemany("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?)",
+                       rows)
+
+
+def get_history(since=None, events=None):
+    """
+    Return a dictionary mapping virtual machine names to lists of (event,
+    timestamp, duration) in time order
+    * Only events from timestamp `since' on, and of the kinds of `events',
+      are returned if given
+    """
+    query = "SELECT name, event, timestamp, duration FROM history " \
+            "WHERE timestamp >= ?"
+    params = [since or 0]
+    if events is not None:
+        query += " AND event IN (%s)" % ", ".join("?" * len(events))
+        params.extend(events)
+    history = {}
+    for name, event, timestamp, duration in connect().execute(
+            query + " ORDER BY timestamp", params):
+        history.setdefault(name, []).append((event, timestamp, duration))
+    return history
+
+
+def prune_history(before):
+    """Delete the history events older than timestamp `before'"""
+    with connect() as db:
+        db.execute("DELETE FROM history WHERE timestamp < ?", (before,))
+
+
+def flush():
+    with connect() as db:
+        for table in ("addresses", "snapshots", "images", "samples",
+                      "journal", "history"):
+            db.execute("DELETE FROM %s" % table)
+
+
+def flush_db():
+    output.debug("Flushing local DB files...")
+    flush()
+    output.success("Local DB file are flushed.")
+
+
+def _migrate_columns(db):
+    """Add the lineage columns to snapshots tables created without them"""
+    columns = [row[1] for row in db.execute("PRAGMA table_info(snapshots)")]
+    for column in ("volume_id", "parent_id"):
+        if column not in columns:
+            db.execute("ALTER TABLE snapshots ADD COLUMN %s TEXT" % column)
+    db.commit()
+
+
+def _migrate_csv(db):
+    """Import the legacy CSV files once"""
+    done = db.execute("SELECT value FROM meta WHERE key = 'csv_migrated'")
+    if done.fetchone():
+        return
+    now = time.time()
+    with db:
+        filename = csv_files["addresses"]
+        if os.path.exists(filename):
+            db.executemany(
+                "INSERT OR REPLACE INTO addresses VALUES (?, ?, ?)",
+                [(row[0], row[1], now) for row in read_data(filename)
+                 if len(row) >= 2])
+        filename = csv_files["snapshots"]
+        if os.path.exists(filename):
+            rows = [row for row in read_data(filename) if len(row) >= 2]
+            # Rows were appended in order; keep that order in timestamps
+            db.executemany(
+                "INSERT OR REPLACE INTO snapshots (name, created_at, "
+                "snapshot_id) VALUES (?, ?, ?)",
+                [(row[0], now - len(rows) + i, row[1])
+                 for i, row in enumerate(rows)])
+        db.execute("INSERT INTO meta VALUES ('csv_migrated', ?)", (now,))
 
 
 def read_data(filename):
@@ -1,39 +1,69 @@
 # Elastic Block Store
-from .settings import (EC2_DEFAULT_EBS_AZ, EC2_DEFAULT_EBS_SIZE,
-                       EC2_DEFAULT_DATA_DEVICE, DB_FILES,
-                       EC2_DEFAULT_INSTANCE_NUM)
+import threading
+
+from boto.exception import EC2ResponseError
+from boto.utils import parse_ts
+from . import clock, regions
+from .cw import get_volume_writes
+from .parallel import Prefetch
+from .settings import (EC2_DEFAULT_EBS_SIZE, EC2_DEFAULT_DATA_DEVICE,
+                       EC2_DEFAULT_WAIT_INTERVAL,
+                       EC2_SNAPSHOT_COPY_CONCURRENCY, CW_EBS_COVERAGE_WAIT,
+                       CW_EBS_POLL_INTERVAL)
 from .utils import output
+from .waiters import wait_for_snapshots
 import db
 
 
 def initialize_data_volume(conn):
-    vol = conn.create_volume(size=EC2_DEFAULT_EBS_SIZE,
-                             zone=EC2_DEFAULT_EBS_AZ)
+    vol = conn.create_volume(size=EC2_DEFAULT_EBS_SIZE, zone=regions.zone())
     return vol
 
 
+def is_unchanged(cw_conn, volume, attach_time, detached_at,
+                 timeout=CW_EBS_COVERAGE_WAIT):
+    """
+    Tell whether a data volume created from a snapshot was not written to
+    while attached
+    * `attach_time' is the attach time EC2 reported (ISO 8601), `detached_at'
+      a UTC datetime
+    * Writes are read from CloudWatch; a volume is only deemed unchanged if
+      its metrics cover the whole attachment. Since they lag behind, they are
+      read again every CW_EBS_POLL_INTERVAL seconds, for up to `timeout'
+      seconds, until they cover `detached_at' or show writes
+    """
+    if not (volume.snapshot_id and attach_time):
+        return False
+    deadline = clock.now() + timeout
+    while True:
+        writes = get_volume_writes(cw_conn, volume.id, parse_ts(attach_time),
+                                   detached_at)
+        if writes is not None:
+            ops, written, covered_until = writes
+            if ops or written:
+                return False
+            if covered_until >= detached_at:
+                return True
+        if clock.now() + CW_EBS_POLL_INTERVAL > deadline:
+            output.debug("The metrics of data volume %s do not cover its "
+                         "detach yet; taking a new snapshot." % volume.id)
+            return False
+        clock.sleep(CW_EBS_POLL_INTERVAL)
+
+
 def get_snapshots():
     """
-    Get snapshots of EBS data volumes
+    Get the latest snapshot of the EBS data volume of each virtual machine
     * Return a dictionary mapping snapshot ids to virtual machine names
     """
-    filename = DB_FILES["snapshots"]
-    rows = db.read_data(filename)
-    snapshots = {}
-    if len(rows) > EC2_DEFAULT_INSTANCE_NUM:
-        rows = rows[-EC2_DEFAULT_INSTANCE_NUM:]
-    for row in rows:
-        name = row[0]
-        snapshot_id = row[1]
-        snapshots[snapshot_id] = name
-    return snapshots
+    return db.get_latest_snapshots()
 
 
 def delete_all_data_volumes(conn, volume_ids=None):
     output.debug("Deleting data volumes...")
     volumes = conn.get_all_volumes(volume_ids=volume_ids)
     for volume in volumes:
-        volume.delete()
+        conn.delete_volume(volume.id)
 
 
 def delete_all_snapshots(conn, snapshot_ids=None):
@@ -52,3 +82,69 @@ def get_data_volumes(conn, instances):
         volume_id = bdt.volume_id
         volume_ids.append(volume_id)
     return conn.get_all_volumes(volume_ids=volume_ids)
+
+
+class SnapshotCopier(object):
+    """
+    Pipeline copying snapshots, then deleting their sources
+    * Each submitted snapshot goes through its stages on a thread of its
+      own: wait for the snapshot to complete, copy it, wait for the copy to
+      complete, delete the source; snapshots of many volumes are at
+      different stages at the same time
+    * At most `concurrency' copies are in progress at once; a copy refused
+      by AWS for exceeding its own limit is tried again later
+    """
+
+    def __init__(self, conn, concurrency=EC2_SNAPSHOT_COPY_CONCURRENCY,
+                 region=None):
+        self.conn = conn
+        self.region = region or regions.current()
+        self._slots = threading.Semaphore(concurrency)
+
+    def submit(self, snapshot_id):
+        """
+        Start copying `snapshot_id'
+        * Return a Prefetch whose get() returns the id of the copy and the
+          seconds from submission to the completion of the copy
+        """
+        return Prefetch(self._copy, snapshot_id, clock.now())
+
+    def _copy(self, snapshot_id, submitted):
+        wait_for_snapshots(self.conn, [snapshot_id]).check()
+        with clock.blocked():
+            self._slots.acquire()
+        try:
+            copy_id = self._start_copy(snapshot_id)
+            wait_for_snapshots(self.conn, [copy_id]).check()
+        finally:
+            self._slots.release()
+        self.conn.delete_snapshot(snapshot_id)
+        return copy_id, clock.now() - submitted
+
+    def _start_copy(self, snapshot_id):
+        while True:
+            try:
+                return self.conn.copy_snapshot(self.region, snapshot_id)
+            except EC2ResponseError as e:
+                if e.error_code != "ResourceLimitExceeded":
+                    raise
+            output.debug("Too many snapshot copies in progress; copying "
+                         "snapshot %s later..." % snapshot_id)
+            clock.sleep(EC2_DEFAULT_WAIT_INTERVAL)
+
+
+_copiers = {}
+_copiers_lock = threading.Lock()
+
+
+def get_copier(conn):
+    """
+    Get the snapshot copy pipeline of a connection in the current region,
+    shared by concurrent stores so that the copies in progress stay within
+    its limit
+    """
+    key = (conn, regions.current())
+    with _copiers_lock:
+        if key not in _copiers:
+            _copiers[key] = SnapshotCopier(conn)
+        return _copiers[key]
@@ -0,0 +1,85 @@
+# Fleet definition
+# * A fleet is made of groups of virtual machines; the machines of a group
+#   are named after the group's name pattern (e.g. "web%d" -> web1, web2...)
+#   and share an instance type, a public AMI to launch from and a store
+#   strategy (see STORE_STRATEGIES)
+# * The default fleet is EC2_DEFAULT_FLEET; another definition can be read
+#   from a JSON file holding a list of groups (see Group for the keys)
+import json
+
+from .settings import (EC2_DEFAULT_FLEET, EC2_DEFAULT_IMAGE_ID,
+                       EC2_DEFAULT_INSTANCE_TYPE, EC2_DEFAULT_STORE_STRATEGY,
+                       STORE_STRATEGIES)
+
+
+class Group(object):
+    """
+    Group of virtual machines
+    * `name': pattern of the machine names, with one %d for the index
+    * `count': number of machines
+    * `instance_type', `image_id': launch parameters of the machines
+    * `start': index of the first machine
+    * `store_strategy': how store puts the machines away
+    """
+
+    def __init__(self, name, count, instance_type=EC2_DEFAULT_INSTANCE_TYPE,
+                 image_id=EC2_DEFAULT_IMAGE_ID, start=1,
+                 store_strategy=EC2_DEFAULT_STORE_STRATEGY):
+        if store_strategy not in STORE_STRATEGIES:
+            raise ValueError("Unknown store strategy of group %s: %s" %
+                             (name, store_strategy))
+        self.name = name
+        self.count = count
+        self.instance_type = instance_type
+        self.image_id = image_id
+        self.start = start
+        self.store_strategy = store_strategy
+        self.names = [name % i for i in range(start, start + count)]
+
+
+class Fleet(object):
+
+    def __init__(self, groups):
+        self.groups = groups
+        self._groups_by_name = {}
+        for group in groups:
+            for name in group.names:
+                if name in self._groups_by_name:
+                    raise ValueError("Duplicate machine name in fleet: %s" %
+                                     name)
+                self._groups_by_name[name] = group
+
+    @classmethod
+    def from_definition(cls, definition):
+        """Create a fleet from a list of dictionaries of Group arguments"""
+        return cls([Group(**dict((str(k), v) for k, v in group.items()))
+                    for group in definition])
+
+    @property
+    def names(self):
+        return [name for group in self.groups for name in group.names]
+
+    @property
+    def size(self):
+        return sum(group.count for group in self.groups)
+
+    def group_of(self, name):
+        """Get the group of the machine named `name' (None if unknown)"""
+        return self._groups_by_name.get(name)
+
+    def instance_type(self, name):
+        group = self.group_of(name)
+        return group.instance_type if group else EC2_DEFAULT_INSTANCE_TYPE
+
+    def store_strategy(self, name):
+        group = self.group_of(name)
+        return group.store_strategy if group else EC2_DEFAULT_STORE_STRATEGY
+
+
+def load(path):
+    with open(path) as f:
+        return Fleet.from_definition(json.load(f))
+
+
+# Fleet managed by the commands
+current = Fleet.from_definition(EC2_DEFAULT_FLEET)
@@ -0,0 +1,155 @@
+# Idle detection
+# * A history of instance metrics (IDLE_METRICS) is kept in the local DB as
+#   one ring buffer per instance and metric: the last IDLE_HISTORY_SIZE
+#   samples of IDLE_SAMPLE_PERIOD seconds
+# * Histories are refreshed incrementally: only the periods completed since
+#   the last sample are fetched from CloudWatch, so repeated runs within a
+#   period make no requests
+# * Idleness is decided by rules over a window of samples (IDLE_RULES),
+#   e.g. "p90 of CPUUtilization below 50 for 10 minutes"
+import collections
+import math
+
+from . import clock
+from .cw import get_instance_samples
+from .parallel import run_parallel
+from .settings import (IDLE_METRICS, IDLE_SAMPLE_PERIOD, IDLE_HISTORY_SIZE,
+                       IDLE_RULES, IDLE_MIN_COVERAGE, CW_DEFAULT_WORKERS)
+from .utils import output
+import db
+
+
+def percentile(values, p):
+    """Nearest-rank `p'th percentile of `values'"""
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class Rule(object):
+    """`percentile' of `metric' over the last `minutes' below `threshold'"""
+
+    def __init__(self, metric, threshold, minutes, percentile=95):
+        self.metric = metric
+        self.threshold = threshold
+        self.minutes = minutes
+        self.percentile = percentile
+
+    def __str__(self):
+        return "p%d %s < %s for %d min" % (self.percentile, self.metric,
+                                           self.threshold, self.minutes)
+
+    def evaluate(self, history, now, period=IDLE_SAMPLE_PERIOD):
+        """
+        Return the percentile of the samples in the window of the rule, or
+        None if too few samples cover it
+        """
+        start = now - 60 * self.minutes
+        values = [value for timestamp, value in history
+                  if start <= timestamp < now]
+        expected = 60 * self.minutes / period
+        if not values or len(values) < IDLE_MIN_COVERAGE * expected:
+            return None
+        return percentile(values, self.percentile)
+
+
+class IdleDetector(object):
+    """
+    Metric histories of instances, and the idle rules evaluated on them
+    * `rules' is a list of Rule, IDLE_RULES by default
+    """
+
+    def __init__(self, rules=None, period=IDLE_SAMPLE_PERIOD,
+                 size=IDLE_HISTORY_SIZE, metrics=IDLE_METRICS):
+        if rules is None:
+            rules = [Rule(**rule) for rule in IDLE_RULES]
+        self.rules = rules
+        self.period = period
+        self.size = size
+        self.metrics = metrics
+        self.fetched = 0  # Number of CloudWatch requests made
+        self._histories = {}  # Mapping of (instance_id, metric) to deques
+
+    def history(self, instance_id, metric):
+        key = (instance_id, metric)
+        if key not in self._histories:
+            self._histories[key] = collections.deque(maxlen=self.size)
+        return self._histories[key]
+
+    def refresh(self, cw_conn, instance_ids, workers=CW_DEFAULT_WORKERS,
+                metrics=None):
+        """
+        Bring the histories of `instance_ids' up to date
+        * Samples are loaded from the local DB, and the periods completed
+          since the last one are fetched from CloudWatch concurrently
+        * `metrics' is a list of the names of the metrics to refresh, all of
+          them by default
+        * Return the current time the histories are up to date with
+        """
+        now = clock.now()
+        # Only completed periods are fetched
+        end = int(now // self.period) * self.period
+        oldest = end - self.size * self.period
+        stored = db.get_samples(instance_ids)
+        requests = []
+        for instance_id in instance_ids:
+            for metric in metrics or self.metrics:
+                history = self.history(instance_id, metric)
+                history.clear()
+                history.extend(s for s in stored.get((instance_id, metric), [])
+                               if s[0] >= oldest)
+                start = history[-1][0] + self.period if history else oldest
+                if start < end:
+                    requests.append((instance_id, metric, start))
+
+        def fetch(request):
+            instance_id, metric, start = request
+            return get_instance_samples(cw_conn, instance_id, metric,
+                                        self.metrics[metric], start, end,
+                                        self.period)
+
+        results = run_parallel(fetch, requests, workers)
+        self.fetched += len(requests)
+        rows = []
+        for result in results:
+            instance_id, metric, start = result.item
+            if not result.ok:
+                output.warning("Failed to get %s of instance %s: %s" %
+                               (metric, instance_id, result.error))
+                continue
+            history = self.history(instance_id, metric)
+            for timestamp, value in result.value:
+                if timestamp >= start:
+                    history.append((timestamp, value))
+                    rows.append((instance_id, metric, timestamp, value))
+        db.put_samples(rows)
+        db.prune_samples(oldest)
+        return end
+
+    def evaluate(self, instance_id, now):
+        """Return a list of (rule, value) for the rules of `instance_id'"""
+        return [(rule, rule.evaluate(self.history(instance_id, rule.metric),
+                                     now, self.period))
+                for rule in self.rules]
+
+    def is_idle(self, instance_id, now):
+        return all(value is not None and value < rule.threshold
+                   for rule, value in self.evaluate(instance_id, now))
+
+    def is_busy(self, instance_id, now):
+        """Whether some rule is known not to hold, unlike a lack of samples"""
+        return any(value is not None and value >= rule.threshold
+                   for rule, value in self.evaluate(instance_id, now))
+
+    def mean(self, instance_id, metric, minutes, now):
+        """Mean of the samples of the last `minutes', None if there are none"""
+        values = [value for timestamp, value
+                  in self.history(instance_id, metric)
+                  if timestamp >= now - 60 * minutes]
+        if not values:
+            return None
+        return sum(values) / len(values)
+
+
+# Histories of the instances handled by this process
+detector = IdleDetector()
@@ -1,299 +1,1014 @@
 # Virtual machine operations
 import datetime
-import time
+from functools import partial
 
+from boto.exception import EC2ResponseError
 
-from .addr import assign_addresses, get_addresses, release_all_addresses
-from .autoscale import setup_autoscale_group, as_conn, delete_autoscale_group
+from . import clock, fleet, plan as plans, regions
+from .addr import assign_address, get_addresses, release_all_addresses
+from .autoscale import setup_autoscale_groups, delete_autoscale_groups
 from .conn import conn
-from .cw import cw_conn, get_cpu_stat
-from .ebs import (initialize_data_volume, get_snapshots, delete_all_snapshots,
-                  delete_all_data_volumes, get_data_volumes)
+from .cw import cw_conn
+from .ebs import (get_copier, initialize_data_volume, get_snapshots,
+                  delete_all_data_volumes, get_data_volumes, is_unchanged)
+from .idle import detector as idle_detector
+from .journal import Journal
 from .keys import get_key_pair
-from .settings import (EC2_DEFAULT_INSTANCE_TYPE, EC2_DEFAULT_IMAGE_ID,
-                       EC2_DEFAULT_INSTANCE_NUM, EC2_DEFAULT_TAG_NAMES,
-                       EC2_DEFAULT_WAIT_INTERVAL, EC2_DEFAULT_DATA_DEVICE,
-                       EC2_DEFAULT_REGION, DB_FILES, EC2_DEFAULT_EBS_AZ,
-                       EC2_INSTANCE_IDLE_TIME, EC2_INSTANCE_IDLE_CPU)
+from .settings import (EC2_DEFAULT_IMAGE_ID, EC2_DEFAULT_DATA_DEVICE,
+                       EC2_INSTANCE_IDLE_TIME,
+                       EC2_DEFAULT_WORKERS, EC2_DESCRIBE_PAGE_SIZE,
+                       EC2_TAG_BATCH_SIZE, EC2_START_STOP_BATCH_SIZE)
+from .parallel import Prefetch, TaskResult, run_parallel
+from .plan import Plan
 from .sg import get_security_group
 from .utils import output
+from .waiters import wait_for_instances, wait_for_volumes, wait_for_images
 import db
 import pdb
 
-def initialize_instances(conn):
+def initialize_instances(conn, workers=EC2_DEFAULT_WORKERS):
     """
     Initialize instances (one-time operation)
-    * Create and launch instances from public AMIs provided by AWS
+    * Create and launch the instances of every group of the fleet from
+      public AMIs provided by AWS
+    * Runs as a plan (see plan.py) of up to `workers' concurrent tasks: data
+      volumes are created while the instances boot, and each group gets its
+      volumes, tags and addresses as soon as it is running
     """
-    # Empty local DB files
-    flush_db()
-
-    # Create or get (if any) security groups and key pairs
-    sg = get_security_group(conn)
-    key_pair = get_key_pair(conn)
+    plan = Plan("init")
+    plan.add("security-group", "setup", partial(get_security_group, conn))
+    plan.add("key-pair", "setup", partial(get_key_pair, conn))
+    plan.add("release-addresses", "setup",
+             partial(release_all_addresses, conn))
+    addresses = []
+    for group in fleet.current.groups:
+        launch = plan.add("launch:" + group.name, "launch",
+                          partial(_launch_group, conn, group),
+                          ["security-group", "key-pair"])
+        plan.add("tag:" + group.name, "tag",
+                 lambda launched: assign_tags(
+                     conn, dict((i, n) for n, i in launched.items()),
+                     workers),
+                 [launch])
+        # Volumes of a group are created while it boots, and attached in a
+        # batch, so that a single waiter covers the whole group
+        volumes = plan.add("volumes:" + group.name, "volume",
+                           partial(_create_data_volumes, conn, group,
+                                   workers))
+        plan.add("attach:" + group.name, "attach",
+                 partial(_attach_data_volumes, conn, workers),
+                 [launch, volumes])
+        for name in group.names:
+            addresses.append(plan.add(
+                "address:" + name, "address",
+                partial(_assign_address, conn, name),
+                [launch, "release-addresses"]))
+    if not plans.dry_run:
+        # Empty local DB files
+        db.flush_db()
+    if not _run_plan(plan, workers):
+        return
+
+    db.put_addresses([plan[address].value for address in addresses
+                      if plan[address].ok])
+    _print_report(plan)
+    if all(task.ok for task in plan.tasks):
+        output.success("All instances are initialized.")
+    else:
+        for task in plan.tasks:
+            if task.status == "failed":
+                output.error("Task %s failed: %s" % (task.name, task.error))
+        output.error("Some instances could not be initialized.")
 
-    # Release all elastic IPs if any
-    release_all_addresses(conn)
 
-    output.debug("Launching instances for the first time...")
+def _launch_group(conn, group, sg, key_pair):
+    """
+    Launch the instances of a fleet group and wait for them to run
+    * Return a dictionary mapping the names of the running virtual machines
+      to their instance ids
+    """
+    output.debug("Launching %d instances of group %s..." %
+                 (group.count, group.name))
     reservation = conn.run_instances(
-        image_id=EC2_DEFAULT_IMAGE_ID,
-        min_count=EC2_DEFAULT_INSTANCE_NUM, max_count=EC2_DEFAULT_INSTANCE_NUM,
+        image_id=group.image_id,
+        min_count=group.count, max_count=group.count,
         security_groups=[sg.name],
         key_name=key_pair.name,
-        instance_type=EC2_DEFAULT_INSTANCE_TYPE,
-        placement=EC2_DEFAULT_EBS_AZ,
+        instance_type=group.instance_type,
+        placement=regions.zone(),
         monitoring_enabled=True
         )
-
-    for i, instance in enumerate(reservation.instances):
-        while instance.update() == "pending":
-            time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-
-        if instance.update() == "running":
-            output.debug("Initializing EBS data volume for instance %d..." % i)
-            volume = initialize_data_volume(conn)
-
-            while volume.update() != "available":
-                time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-            output.debug("Attaching EBS data volume for instance %d..." % i)
-            volume.attach(instance.id, EC2_DEFAULT_DATA_DEVICE)
-
-    instances = get_instances(conn, True, "running")
-    msg = "Assigning tag names and public IPs for the running instances..."
-    output.debug(msg)
-    assign_tags(conn, instances, EC2_DEFAULT_TAG_NAMES)
-    assign_addresses(conn, instances)
-    output.success("All instances are initialized.")
-
-
-def store_instances(conn, copy_snapshots=False, idle_only=False):
+    names = dict((instance.id, name) for instance, name
+                 in zip(reservation.instances, group.names))
+    running_ids = wait_for_instances(conn, names.keys()).ready
+    for instance_id in set(names) - set(running_ids):
+        output.error("Instance %s (%s) did not start." %
+                     (names.pop(instance_id), instance_id))
+    return dict((name, instance_id) for instance_id, name in names.items())
+
+
+def _create_data_volumes(conn, group, workers):
+    """Return a dictionary mapping the names of a group to new volumes"""
+    output.debug("Creating EBS data volumes for group %s..." % group.name)
+    results = run_parallel(lambda _: initialize_data_volume(conn),
+                           group.names, workers)
+    return dict((result.item, result.value) for result in results
+                if result.ok)
+
+
+def _launched(launched, name):
+    if name not in launched:
+        raise RuntimeError("Instance %s did not start" % name)
+    return launched[name]
+
+
+def _attach_data_volumes(conn, workers, launched, volumes):
+    """Attach the data volumes of a group to its running instances"""
+    names = [name for name in sorted(volumes) if name in launched]
+    volume_ids = [volumes[name].id for name in names]
+    wait_for_volumes(conn, volume_ids).check()
+    output.debug("Attaching EBS data volumes...")
+    run_parallel(lambda name: conn.attach_volume(
+        volumes[name].id, launched[name], EC2_DEFAULT_DATA_DEVICE),
+        names, workers)
+    wait_for_volumes(conn, volume_ids, "in-use").check()
+    if len(names) < len(launched):
+        raise RuntimeError("%d data volume(s) could not be created" %
+                           (len(launched) - len(names)))
+
+
+def _assign_address(conn, name, launched, _):
+    """Return the name and the public IP associated to its instance"""
+    return name, assign_address(conn, _launched(launched, name))
+
+
+def store_instances(conn, copy_snapshots=False, idle_only=False,
+                    workers=EC2_DEFAULT_WORKERS, reuse_snapshots=True,
+                    strategy=None):
     """
     Store instances
     * Detach data volumes from instances, create volume snapshots, create
       AMIs and terminate instances
+    * Instances of the "stop" strategy (`strategy', or that of their fleet
+      group) are stopped instead, in batches, keeping their volumes and
+      addresses
+    * Runs as a plan (see plan.py) of up to `workers' concurrent tasks; the
+      AMI of an instance is created while its data volume is snapshotted
+    * With `reuse_snapshots', a data volume restored from a snapshot and not
+      written to since keeps that snapshot instead of a new one
+    * Steps are recorded in the journal (see journal.py) as they complete:
+      instances whose store was interrupted are stored first, idle or not,
+      from their first unfinished step
 
     """
+    journal = Journal("store")
     instances = []
     if idle_only:
         # Get all idle instances
         instances = get_idle_instances(conn)
-        if not instances:
-            all_instances = get_instances(conn)
-            list_instances_info(conn, all_instances)
-            output.warning("There is no idle instance at this time.")
-            return
     else:
-        instances = get_instances(conn, True, "running")
+        instances = list(get_instances(conn))
+        if len(instances) != fleet.current.size:
+            output.warning("%d running instances, the fleet has %d." %
+                           (len(instances), fleet.current.size))
+    instances.extend(_interrupted_instances(conn, journal, instances))
+    if idle_only and not instances:
+        all_instances = list(get_instances(conn))
+        list_instances_info(conn, all_instances)
+        output.warning("There is no idle instance at this time.")
+        return
 
     output.debug("The following idle instances will be stored.")
     list_instances_info(conn, instances)
 
-    output.debug("Preparing to detach data volumes from instances...")
-    volumes = get_data_volumes(conn, instances)
-    volume_ids = [volume.id for volume in volumes]
+    stopped = [instance for instance in instances
+               if _store_strategy(journal, instance, strategy) == "stop"]
+    snapshotted = [instance for instance in instances
+                   if instance not in stopped]
+    volumes, states = _store_states(conn, journal, snapshotted)
+    copier = get_copier(conn) if copy_snapshots else None
+    plan = Plan("store")
+    copies = {}
+    tasks = [_plan_store(plan, conn, journal, state,
+                         volumes.get(state["instance_id"]), copier, copies,
+                         reuse_snapshots)
+             for state in states]
+    if stopped:
+        plan.add("stop", "stop", partial(_stop_instances, conn,
+                                         [i.id for i in stopped]))
+    if not plans.dry_run:
+        _begin_store(journal, states)
+    if not _run_plan(plan, workers):
+        return
+    snapshot_results = [
+        TaskResult(instance, plan[names[-1]].value, plan.error(names))
+        for instance, names in zip(snapshotted, tasks)]
+    results = snapshot_results + [
+        TaskResult(instance, None, _stop_error(plan, instance))
+        for instance in stopped]
+    _record_history(plan, "store",
+                    [(state["name"], names)
+                     for state, names in zip(states, tasks)] +
+                    [(instance.tags.get("Name", "-"), ["stop"])
+                     for instance in stopped])
+
+    _print_summary(results)
+    sizes = dict((state["instance_id"], state["volume_size"])
+                 for state in states)
+    _print_snapshot_savings(snapshot_results, sizes, copy_snapshots)
+    _print_report(plan, journal)
+    if all(result.ok for result in results):
+        output.success("All idle instances are stored and backed up.")
+    else:
+        output.error("Some instances could not be stored.")
+    return results
 
-    data = []
 
-    # Read previous snapshots data if any
-    rows = db.read_data(DB_FILES["snapshots"])
-    data += rows
+def store_instance(conn, instance, copy_snapshots=False,
+                   reuse_snapshots=True, strategy=None):
+    """
+    Store a single instance (see store_instances)
+    * Return a tuple of the snapshot id, whether it was reused, and the
+      seconds spent taking it; None if the instance was stopped
+    """
+    journal = Journal("store")
+    if _store_strategy(journal, instance, strategy) == "stop":
+        if instance.id not in _stop_instances(conn, [instance.id]):
+            raise RuntimeError("Instance %s did not stop" % instance.id)
+        return None
+    volumes, states = _store_states(conn, journal, [instance])
+    copier = get_copier(conn) if copy_snapshots else None
+    plan = Plan("store %s" % instance.tags.get("Name", instance.id))
+    names = _plan_store(plan, conn, journal, states[0],
+                        volumes.get(instance.id), copier, {},
+                        reuse_snapshots)
+    _begin_store(journal, states)
+    plan.run()
+    error = plan.error(names)
+    if error:
+        raise error
+    return plan[names[-1]].value
+
+
+def _store_strategy(journal, instance, strategy=None):
+    """
+    Return how to store `instance': `strategy', or the store strategy of its
+    fleet group
+    * Interrupted stores go on with snapshots, and only EBS-backed instances
+      can be stopped
+    """
+    if journal.get(instance.id, "begin"):
+        return "snapshot"
+    name = instance.tags.get("Name", "-")
+    strategy = strategy or fleet.current.store_strategy(name)
+    if strategy == "stop" and instance.root_device_type != "ebs":
+        output.warning("Instance %s is not EBS-backed: storing it with "
+                       "snapshots instead of stopping it." % name)
+        return "snapshot"
+    return strategy
+
+
+def _stop_instances(conn, instance_ids):
+    """
+    Stop instances, EC2_START_STOP_BATCH_SIZE per call; their data volumes
+    stay attached and their addresses associated
+    * Return the ids of the stopped instances
+    """
+    output.debug("Stopping %d instances..." % len(instance_ids))
+    for i in range(0, len(instance_ids), EC2_START_STOP_BATCH_SIZE):
+        conn.stop_instances(instance_ids[i:i + EC2_START_STOP_BATCH_SIZE])
+    return wait_for_instances(conn, instance_ids, "stopped",
+                              pending=("running", "stopping")).ready
 
-    source_snapshots = []
-    old_ami_snapshot_ids = []
-    for volume in volumes:
-        # Detach the data volume and create snapshots
-        instance_id = volume.attach_data.instance_id
-        instance = get_instance(conn, instance_id)
-        name = instance.tags.get("Name", "-")
-        output.debug("Detaching data volume from instance %s..." % name)
-        volume.detach()
-        while volume.update() != "available":
-            time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-        msg = "Creating snapshot of this volume..."
-        output.debug(msg)
-        snapshot = volume.create_snapshot()
-        snapshot_id = snapshot.id
 
-        if copy_snapshots:
-            # Copy the snapshot to Amazon S3
-            snapshot.update()
-            if snapshot.status != "completed":
-                time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-                snapshot.update()
+def _stop_error(plan, instance):
+    error = plan.error(["stop"])
+    if error is None and instance.id not in plan["stop"].value:
+        error = RuntimeError("Instance did not stop")
+    return error
 
-            msg = "Copying the snapshot to Amazon S3..."
-            output.debug(msg)
 
-            snapshot_id = conn.copy_snapshot(EC2_DEFAULT_REGION,
-                                             snapshot.id)
-            time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
+def _interrupted_instances(conn, journal, instances):
+    """
+    Return the instances of the journal whose store was interrupted, other
+    than `instances'
+    * Instances that were terminated already are returned as long as EC2
+      still describes them
+    """
+    ids = set(instance.id for instance in instances)
+    begun = dict((instance_id, journal.get(instance_id, "begin"))
+                 for instance_id in journal.resources
+                 if instance_id not in ids and journal.get(instance_id,
+                                                           "begin"))
+    if not begun:
+        return []
+    names = sorted(set(state["name"] for state in begun.values()))
+    found = dict((instance.id, instance) for instance
+                 in get_instances(conn, state=None, tags={"Name": names}))
+    interrupted = []
+    for instance_id, state in sorted(begun.items()):
+        if instance_id in found:
+            output.warning("Resuming the interrupted store of instance %s "
+                           "(%s)..." % (state["name"], instance_id))
+            interrupted.append(found[instance_id])
+        else:
+            output.error("The interrupted store of instance %s (%s) cannot "
+                         "be resumed: EC2 no longer knows the instance." %
+                         (state["name"], instance_id))
+    return interrupted
+
+
+def _store_states(conn, journal, instances):
+    """
+    Return the data volumes of `instances', and the state their stores start
+    from: the journaled one for interrupted stores
+    """
+    # Data volumes of interrupted stores may be detached (or deleted already)
+    fresh = [instance for instance in instances
+             if not journal.get(instance.id, "begin")]
+    volumes = dict((volume.attach_data.instance_id, volume)
+                   for volume in get_data_volumes(conn, fresh))
+    latest = db.get_latest_snapshots() if fresh else {}
+    states = []
+    for instance in instances:
+        state = journal.get(instance.id, "begin")
+        if state:
+            volumes[instance.id] = _describe(conn.get_all_volumes,
+                                             state["volume_id"])
+        else:
+            state = _store_state(instance, volumes[instance.id], latest)
+        states.append(state)
+    return volumes, states
 
-            # Get the copied snapshot and make sure they are comleted
-            copied_snapshot = conn.get_all_snapshots([snapshot_id])[0]
-            copied_snapshot.update()
-            if copied_snapshot.status != "completed":
-                time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-                copied_snapshot.update()
 
-            source_snapshots.append(snapshot)
+def _store_state(instance, volume, latest):
+    """
+    Everything the store of an instance needs to know about it
+    * `latest' is what db.get_latest_snapshots() returns
+    """
+    name = instance.tags.get("Name", "-")
+    # Snapshot the data volume was restored from, if recorded by a previous
+    # store of this virtual machine
+    parent_id = volume.snapshot_id or None
+    if latest.get(parent_id) != name:
+        parent_id = None
+    return {"instance_id": instance.id, "name": name,
+            "label": instance.tags.get("Name") or instance.id,
+            "image_id": instance.image_id,
+            "ip_address": instance.ip_address, "volume_id": volume.id,
+            "volume_size": volume.size,
+            "attach_time": volume.attach_data.attach_time,
+            "parent_id": parent_id}
+
+
+def _begin_store(journal, states):
+    """Record the stores about to start, before any change is made"""
+    for state in states:
+        if not journal.get(state["instance_id"], "begin"):
+            journal.put(state["instance_id"], "begin", state)
+
+
+def _plan_store(plan, conn, journal, state, volume, copier=None,
+                copies=None, reuse_snapshots=True):
+    """
+    Add the tasks storing an instance and its data volume to `plan'
+    * `state' is what _store_state() returns; `volume' is None if the data
+      volume was deleted by an interrupted store
+    * With a SnapshotCopier, the new snapshot of the data volume is copied
+      by `copier' while the AMI of the instance is created; `copies' maps
+      instance ids to the copies in progress
+    * Every task but the last is a step of the journal; the last task
+      records the snapshot of the data volume and the AMI in the local DB,
+      and has the value store_instance() returns
+    * Return the names of the tasks
+    """
+    instance_id = state["instance_id"]
+    label = state["label"]
+    step = partial(journal.step, instance_id)
+    # Only the steps of an interrupted store may have been done already
+    resumed = bool(journal.get(instance_id, "begin"))
+
+    def snapshot_holds(value):
+        snapshot_id, reused, seconds = value
+        # The source of a copied snapshot is deleted
+        return (reused or bool(journal.get(instance_id, "copy")) or
+                _snapshot_holds(conn, snapshot_id))
+
+    detach = plan.add("detach:" + label, "detach",
+                      step("detach",
+                           partial(_detach_data_volume, conn, state, volume),
+                           partial(_volume_detached, conn, state)))
+    snapshot = plan.add("snapshot:" + label, "snapshot",
+                        step("snapshot",
+                             partial(_snapshot_data_volume, conn, state,
+                                     volume, copier, copies,
+                                     reuse_snapshots),
+                             snapshot_holds),
+                        [detach])
+    deregister = plan.add("deregister:" + label, "deregister",
+                          step("deregister",
+                               partial(_deregister_image, conn, state)))
+    image = plan.add("image:" + label, "image",
+                     step("image",
+                          partial(_create_image, conn, journal, state),
+                          partial(_image_holds, conn)),
+                     [detach, deregister])
+    terminate = plan.add("terminate:" + label, "terminate",
+                         step("terminate",
+                              partial(_terminate_instance, conn, state,
+                                      resumed),
+                              partial(_instance_terminated, conn,
+                                      instance_id)),
+                         [image])
+    if copier:
+        # Copies go through the pipeline of the copier meanwhile: waiting
+        # for them last keeps workers for the other tasks
+        snapshot = plan.add("copy:" + label, "copy",
+                            step("copy",
+                                 partial(_copy_snapshot, copier, copies,
+                                         instance_id),
+                                 lambda copy: _snapshot_holds(conn,
+                                                              copy[0])),
+                            [snapshot, terminate])
+    record = plan.add("record:" + label, "record",
+                      partial(_record_store, conn, journal, state, resumed),
+                      [snapshot, image, deregister, terminate])
+    return [detach, snapshot, deregister, image, terminate, record]
+
+
+def _describe(method, resource_id):
+    """
+    Describe a resource with `method' (e.g. conn.get_all_volumes); None if
+    EC2 does not know it
+    """
+    try:
+        resources = method([resource_id])
+    except EC2ResponseError as e:
+        if e.error_code and e.error_code.endswith("NotFound"):
+            return None
+        raise
+    return resources[0] if resources else None
 
-        data.append([name, snapshot_id])
 
-    db.write_data(DB_FILES["snapshots"], data)
+def _volume_detached(conn, state, detached_at):
+    # A data volume is deleted once its store is recorded
+    volume = _describe(conn.get_all_volumes, state["volume_id"])
+    return volume is None or volume.status == "available"
 
-    for instance in instances:
 
-        name = instance.tags.get("Name", "-")
+def _snapshot_holds(conn, snapshot_id):
+    snapshot = _describe(conn.get_all_snapshots, snapshot_id)
+    return snapshot is not None and snapshot.status != "error"
+
+
+def _image_holds(conn, image_id):
+    image = _describe(conn.get_all_images, image_id)
+    return image is not None and image.state in ("pending", "available")
+
+
+def _instance_terminated(conn, instance_id, _=None):
+    instance = _describe(conn.get_only_instances, instance_id)
+    return instance is None or instance.state == "terminated"
+
+
+def _detach_data_volume(conn, state, volume):
+    """Return the time the volume detached, as a timestamp"""
+    if volume is None:
+        raise RuntimeError("Data volume %s does not exist" %
+                           state["volume_id"])
+    if volume.status == "in-use":
+        output.debug("Detaching data volume from instance %s..." %
+                     state["name"])
+        conn.detach_volume(volume.id)
+    wait_for_volumes(conn, [volume.id]).check()
+    return clock.now()
 
-        image = conn.get_image(instance.image_id)
-        if image:
-            if image.id != EC2_DEFAULT_IMAGE_ID:
-                bdm = image.block_device_mapping
-                snapshot_id = bdm["/dev/sda1"].snapshot_id
-                old_ami_snapshot_ids.append(snapshot_id)
-                msg = "Deleting old AMI of instance %s..." % name
-                output.debug(msg)
-                image.deregister()
+
+def _snapshot_data_volume(conn, state, volume, copier, copies,
+                          reuse_snapshots, detached_at):
+    """
+    Snapshot a detached data volume, unless its parent snapshot is reused
+    * Return the snapshot id, whether it was reused and the seconds spent
+      taking it
+    * With `copier', the copy of a new snapshot starts right away; it is in
+      `copies' until the copy task takes it
+    """
+    name = state["name"]
+    parent_id = state["parent_id"]
+    detached_at = datetime.datetime.utcfromtimestamp(detached_at)
+    reused = bool(reuse_snapshots and parent_id and
+                  is_unchanged(cw_conn, volume, state["attach_time"],
+                               detached_at))
+    started = clock.now()
+    if reused:
+        output.debug("The data volume of instance %s is unchanged; reusing "
+                     "snapshot %s..." % (name, parent_id))
+        snapshot_id = parent_id
+    else:
+        msg = "Creating snapshot of the data volume of instance %s..." % name
+        output.debug(msg)
+        snapshot_id = conn.create_snapshot(volume.id).id
+        if copier:
+            # The snapshot is copied to Amazon S3, and the source deleted,
+            # once it is completed
+            msg = "Copying the snapshot of instance %s to Amazon S3..." % name
+            output.debug(msg)
+            copies[state["instance_id"]] = copier.submit(snapshot_id)
+    return snapshot_id, reused, clock.now() - started
+
+
+def _copy_snapshot(copier, copies, instance_id, snapshot, terminated):
+    """Return the id of the copy of a new snapshot and its seconds"""
+    snapshot_id, reused, seconds = snapshot
+    if reused:
+        return snapshot_id, seconds
+    copy = copies.pop(instance_id, None)
+    if copy is None:
+        # Snapshot taken by an interrupted store
+        copy = copier.submit(snapshot_id)
+    return copy.get()
+
+
+def _deregister_image(conn, state):
+    """Deregister the previous AMI of an instance; return its snapshot id"""
+    image = conn.get_image(state["image_id"])
+    if image and image.id != EC2_DEFAULT_IMAGE_ID:
+        msg = "Deleting old AMI of instance %s..." % state["name"]
+        output.debug(msg)
+        conn.deregister_image(image.id)
+        return image.block_device_mapping["/dev/sda1"].snapshot_id
 
 
-        msg = "Creating AMI from instance %s..." % (name)
+def _create_image(conn, journal, state, detached_at, old_ami_snapshot_id):
+    instance_id = state["instance_id"]
+    image_id = journal.get(instance_id, "image-requested")
+    if image_id and _image_holds(conn, image_id):
+        output.debug("Waiting for the AMI of instance %s requested by an "
+                     "interrupted store..." % state["name"])
+    else:
+        msg = "Creating AMI from instance %s..." % state["name"]
+        output.debug(msg)
+        image_id = conn.create_image(instance_id, state["name"])
+        journal.put(instance_id, "image-requested", image_id)
+    wait_for_images(conn, [image_id]).check()
+    return image_id
+
+
+def _terminate_instance(conn, state, resumed, image_id):
+    name, instance_id = state["name"], state["instance_id"]
+    if not (resumed and _instance_terminating(conn, instance_id)):
+        public_ip = state["ip_address"]
+        msg = "Disassociating public IP %s from instance %s..." % (public_ip,
+                                                                   name)
         output.debug(msg)
-        image_id = instance.create_image(name)
-        time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-        image = conn.get_image(image_id)
-        while image.update() != "available":
-            time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-        public_ip = instance.ip_address
-        msg = "Disassociating public IP %s from instance %s..." % (name,
-                                                                   instance.id)
         conn.disassociate_address(public_ip)
         # After AMI is created, terminate the instance
-        msg = "Terminating instance %s (%s)..." % (name, instance.id)
+        msg = "Terminating instance %s (%s)..." % (name, instance_id)
         output.debug(msg)
-        instance.terminate()
+        conn.terminate_instances([instance_id])
 
-    output.debug("Waiting for all idle instances terminated before deleting "
-                 "their data volumes...")
+    output.debug("Waiting for instance %s terminated before deleting its "
+                 "data volume..." % name)
+    wait_for_instances(conn, [instance_id], "terminated", pending=None).check()
 
-    for instance in instances:
-        while instance.update() == "shutting-down":
-            time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-        assert instance.update() == "terminated"
 
-    delete_all_data_volumes(conn, volume_ids=volume_ids)
+def _instance_terminating(conn, instance_id):
+    instance = _describe(conn.get_only_instances, instance_id)
+    return instance is None or instance.state in ("shutting-down",
+                                                  "terminated")
+
+
+def _record_store(conn, journal, state, resumed, snapshot, image_id,
+                  old_ami_snapshot_id, terminated):
+    """
+    Record the snapshot and the AMI of a stored instance, then delete what
+    they replace and forget its journal
+    * `snapshot' is the value of the snapshot task, or of the copy task
+    """
+    name, parent_id = state["name"], state["parent_id"]
+    snapshot_id, snapshot_time = snapshot[0], snapshot[-1]
+    reused = snapshot_id == parent_id
+
+    db.put_snapshot(name, snapshot_id, volume_id=state["volume_id"],
+                    parent_id=parent_id)
+    db.put_image(name, image_id)
 
-    if copy_snapshots:
-        output.debug("Deleting source snapshots... ")
-        for snapshot in source_snapshots:
-            snapshot.delete()
+    if not resumed or _describe(conn.get_all_volumes, state["volume_id"]):
+        delete_all_data_volumes(conn, volume_ids=[state["volume_id"]])
 
-    output.debug("Deleting snapshots of old AMIs...")
-    for sid in old_ami_snapshot_ids:
-        conn.delete_snapshot(sid)
+    if old_ami_snapshot_id:
+        output.debug("Deleting snapshot of old AMI of instance %s..." % name)
+        _delete_snapshot(conn, old_ami_snapshot_id)
 
-    output.success("All idle instances are stored and backed up.")
+    if parent_id and not reused:
+        output.debug("Deleting superseded data snapshot of instance %s..." %
+                     name)
+        _delete_snapshot(conn, parent_id)
 
+    journal.done([state["instance_id"]])
+    return snapshot_id, reused, snapshot_time
 
-def restore_instances(conn):
+
+def _delete_snapshot(conn, snapshot_id):
+    """Delete a snapshot, unless an interrupted store deleted it already"""
+    try:
+        conn.delete_snapshot(snapshot_id)
+    except EC2ResponseError as e:
+        if not (e.error_code and e.error_code.endswith("NotFound")):
+            raise
+
+
+def _print_snapshot_savings(results, sizes, copy_snapshots=False):
+    """
+    Report the snapshots of unchanged data volumes reused by a store
+    * `sizes' maps instance ids to the sizes of their data volumes
+    """
+    stored = [result for result in results if result.ok]
+    reused = [result for result in stored if result.value[1]]
+    if not reused:
+        return
+    size = sum(sizes[result.item.id] for result in reused)
+    # Calls of the snapshot step of a changed volume: create the snapshot
+    # (copy it and delete the source) and delete the superseded one
+    calls = len(reused) * (4 if copy_snapshots else 2)
+    msg = ("%d of %d data volumes were unchanged and kept their snapshots "
+           "(%d GiB not snapshotted, %d EC2 calls saved" %
+           (len(reused), len(stored), size, calls))
+    taken = [result.value[2] for result in stored if not result.value[1]]
+    if taken:
+        msg += ", about %.0f s of snapshotting" % (
+            len(reused) * sum(taken) / len(taken))
+    output.success(msg + ").")
+
+
+def _print_summary(results, label=None):
+    """
+    Print per-item outcome of a batch operation
+    * `label' maps an item to its (name, id); items are instances by default
+    """
+    if label is None:
+        label = lambda instance: (instance.tags.get("Name", "-"), instance.id)
+    print _format_line("Name", "ID", "Result")
+    print '-' * 60
+    for result in results:
+        name, item_id = label(result.item)
+        if result.ok:
+            status = "OK"
+        else:
+            error = result.error
+            status = "FAILED: %s" % (str(error) or error.__class__.__name__)
+        print _format_line(name, item_id, status)
+
+
+def restore_instances(conn, workers=EC2_DEFAULT_WORKERS, names=None,
+                      prewarm=False):
     """
     Restore instances
     * Launch instances from AMIs, create volume from volume snapshots, attach
       volumes to the instances
+    * Only the virtual machines of `names' are restored if given
+    * Restores are recorded in the history with their durations; with
+      `prewarm', as restores ahead of need (see prewarm.py), which do not
+      tell when the virtual machines are needed
+    * Runs as a plan (see plan.py) of up to `workers' concurrent tasks: the
+      data volume of an instance is created while it boots and attached as
+      soon as both are ready
+    * Steps are recorded in the journal (see journal.py) until every
+      instance is restored: a rerun after an interruption or a failure only
+      does the unfinished steps
     """
-    sg = get_security_group(conn)
-    key_pair = get_key_pair(conn)
     snapshots = get_snapshots()
+    snapshot_name_mapping = dict((name, snapshot_id)
+                                 for snapshot_id, name in snapshots.items())
+    addresses = get_addresses()
 
-    images = conn.get_all_images(owners=["self"])
-    image_name_mapping = {}  # Mapping of image name to instance id
-    output.debug("Launching instances from this account's AMIs...")
-    for image in images:
-        reservation = image.run(
-            min_count=1, max_count=1,
-            security_groups=[sg.name], key_name=key_pair.name,
-            instance_type=EC2_DEFAULT_INSTANCE_TYPE,
-            placement=EC2_DEFAULT_EBS_AZ,
-            monitoring_enabled=True)
-        time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-        instance = reservation.instances[0]
-        conn.create_tags([instance.id], {"Name": image.name})
-        image_name_mapping[image.name] = instance.id
+    # Instances stored by stopping them are started; AMIs of their earlier
+    # stores are left alone
+    stopped = list(get_instances(conn, state=["stopping", "stopped"]))
+    stopped_names = set(instance.tags.get("Name") for instance in stopped)
+    images = [image for image in conn.get_all_images(owners=["self"])
+              if image.name not in stopped_names]
+    journal = Journal("restore")
+    image_ids = set(image.id for image in images)
+    stale = [image_id for image_id in journal.resources
+             if image_id not in image_ids]
+    if stale and not plans.dry_run:
+        # AMIs replaced by a store since
+        journal.done(stale)
+    if names is not None:
+        stopped = [instance for instance in stopped
+                   if instance.tags.get("Name") in names]
+        images = [image for image in images if image.name in names]
+    plan = Plan("restore")
+    plan.add("security-group", "setup", partial(get_security_group, conn))
+    plan.add("key-pair", "setup", partial(get_key_pair, conn))
+    tasks = [_plan_restore(plan, conn, journal, image,
+                           snapshot_name_mapping.get(image.name),
+                           addresses.get(image.name))
+             for image in images]
+    started = _plan_start(plan, conn, stopped, addresses)
+    output.debug("Restoring instances from this account's AMIs...")
+    if not _run_plan(plan, workers):
+        return
+    results = [TaskResult(image, snapshot_name_mapping.get(image.name),
+                          plan.error(["security-group", "key-pair"] +
+                                     task_names))
+               for image, task_names in zip(images, tasks)]
+    results += [TaskResult(instance, None, plan.error(task_names))
+                for instance, task_names in zip(stopped, started)]
+    _record_history(plan, "prewarm" if prewarm else "restore",
+                    [(image.name, task_names)
+                     for image, task_names in zip(images, tasks)] +
+                    [(instance.tags.get("Name", "-"), task_names)
+                     for instance, task_names in zip(stopped, started)])
+
+    # Snapshots of restored data volumes are kept: a volume left unchanged
+    # until the next store reuses its snapshot
+
+    # Items are AMIs, which have a name, and started instances
+    _print_summary(results, lambda item: (
+        getattr(item, "name", None) or item.tags.get("Name", "-"), item.id))
+    _print_report(plan, journal)
+    if all(result.ok for result in results):
+        journal.done([image.id for image in images])
+        output.success("All instances are restored.")
+    else:
+        output.error("Some instances could not be restored.")
+    return results
 
-    instances = get_instances(conn, True, "pending")
-    output.debug("Waiting for all instances running...")
-    for instance in instances:
-        while instance.update() == "pending":
-            time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-        assert instance.update() == "running"
 
-    instances = get_instances(conn, True, "running")
+def _plan_restore(plan, conn, journal, image, snapshot_id=None,
+                  public_ip=None):
+    """
+    Add the tasks restoring an instance from its AMI and data volume
+    snapshot to `plan', as steps of the journal; return the names of the
+    tasks
+    """
+    name = image.name
+    step = partial(journal.step, image.id)
+    launch = plan.add("launch:" + name, "launch",
+                      step("launch",
+                           partial(_launch_instance, conn, journal, image),
+                           partial(_instance_launched, conn)),
+                      ["security-group", "key-pair"])
+    names = [launch]
+    if public_ip:
+        names.append(plan.add(
+            "address:" + name, "address",
+            step("address",
+                 partial(_associate_address, conn, name, public_ip),
+                 partial(_address_associated, conn, public_ip)),
+            [launch]))
+    if snapshot_id:
+        # The volume does not depend on the instance; create it during boot
+        volume = plan.add("volume:" + name, "volume",
+                          step("volume",
+                               partial(_create_volume_from, conn, name,
+                                       snapshot_id),
+                               partial(_volume_created, conn)))
+        attach = plan.add("attach:" + name, "attach",
+                          step("attach",
+                               partial(_attach_restored_volume, conn, name),
+                               partial(_volume_attached, conn)),
+                          [launch, volume])
+        names.extend([volume, attach])
+    else:
+        output.warning("No data volume snapshot for instance %s." % name)
+    return names
 
-    addresses = get_addresses()
-    output.debug("Associating public IPs into restored instances...")
 
+def _plan_start(plan, conn, instances, addresses):
+    """
+    Add the tasks starting stopped `instances' to `plan': all of them are
+    started at once, then their addresses are associated again if need be
+    * Return the names of the tasks of each instance
+    """
+    if not instances:
+        return []
+    start = plan.add("start", "start",
+                     partial(_start_instances, conn,
+                             [instance.id for instance in instances]))
+    tasks = []
     for instance in instances:
         name = instance.tags.get("Name", "-")
-        ip = addresses[name]
-        conn.associate_address(instance.id, ip)
-
-    output.debug("Creating EBS data volumes from snapshots...")
-    snapshots_dict = get_snapshots()
-    snapshot_ids = [item for item in snapshots_dict]
-    snapshots = conn.get_all_snapshots(snapshot_ids=snapshot_ids,
-                                       owner="self")
-    for snapshot in snapshots:
-        volume = snapshot.create_volume(EC2_DEFAULT_EBS_AZ)
-        while volume.update() != "available":
-            time.sleep(EC2_DEFAULT_WAIT_INTERVAL)
-        name = snapshots_dict[snapshot.id]
-        instanced_id = image_name_mapping[name]
-        output.debug("Attaching EBS data volume for instance %s..." % name)
-        volume.attach(instanced_id, EC2_DEFAULT_DATA_DEVICE)
-
-    # Delete snapshots of data volumes
-    delete_all_snapshots(conn, snapshot_ids)
-    db.write_data(DB_FILES["snapshots"], [])
-
-
-def autoscale_instances(conn):
-    instances = get_instances(conn)
-    for instance in instances:
-        name = instance.tags.get("Name", "-")
-        image_id = instance.image_id
-        setup_autoscale_group(conn, name, image_id)
+        names = [start]
+        if addresses.get(name):
+            names.append(plan.add(
+                "address:" + name, "address",
+                partial(_reassociate_address, conn, name, addresses[name],
+                        instance.id),
+                [start]))
+        tasks.append(names)
+    return tasks
+
+
+def _start_instances(conn, instance_ids):
+    """
+    Start stopped instances, EC2_START_STOP_BATCH_SIZE per call
+    * Return a dictionary mapping their ids to their public IPs
+    """
+    # Instances being stopped cannot be started yet
+    wait_for_instances(conn, instance_ids, "stopped",
+                       pending=("stopping",)).check()
+    output.debug("Starting %d instances..." % len(instance_ids))
+    for i in range(0, len(instance_ids), EC2_START_STOP_BATCH_SIZE):
+        conn.start_instances(instance_ids[i:i + EC2_START_STOP_BATCH_SIZE])
+    result = wait_for_instances(conn, instance_ids,
+                                pending=("stopped", "pending")).check()
+    return dict((instance_id, instance.ip_address) for instance_id, instance
+                in result.resources.items())
+
+
+def _reassociate_address(conn, name, public_ip, instance_id, public_ips):
+    """
+    Associate the address of a started instance again, if it lost it (as
+    instances outside a VPC do when stopped)
+    * `public_ips' maps the ids of the started instances to their addresses
+    """
+    if public_ips.get(instance_id) != public_ip:
+        _associate_address(conn, name, public_ip, instance_id)
 
 
-def stop_autoscale():
-    groups = as_conn.get_all_groups()
-    for group in groups:
-        name = group.name
-        delete_autoscale_group(conn, name)
+def _launch_instance(conn, journal, image, sg, key_pair):
+    """Launch an instance from its AMI and wait for it to run; return its id"""
+    name = image.name
+    instance_id = journal.get(image.id, "launch-requested")
+    if instance_id and _instance_launched(conn, instance_id):
+        output.debug("Waiting for instance %s launched by an interrupted "
+                     "restore..." % name)
+    else:
+        output.debug("Launching instance %s from AMI %s..." %
+                     (name, image.id))
+        reservation = conn.run_instances(
+            image.id, min_count=1, max_count=1,
+            security_groups=[sg.name], key_name=key_pair.name,
+            instance_type=fleet.current.instance_type(name),
+            placement=regions.zone(),
+            monitoring_enabled=True)
+        instance_id = reservation.instances[0].id
+        journal.put(image.id, "launch-requested", instance_id)
+    wait_for_instances(conn, [instance_id]).check()
+    conn.create_tags([instance_id], _tags(name))
+    return instance_id
 
 
-def get_instances(conn, assert_num=False, state="running"):
-    """Get all instances associated with this account"""
-    all_instances = conn.get_only_instances()
-    instances = []
-    for instance in all_instances:
-        if instance.state == state:
-            instances.append(instance)
-    if assert_num:
-        # Confirm number of instances
-        assert len(instances) == EC2_DEFAULT_INSTANCE_NUM
-    return instances
+def _instance_launched(conn, instance_id):
+    instance = _describe(conn.get_only_instances, instance_id)
+    return instance is not None and instance.state in ("pending", "running")
+
+
+def _associate_address(conn, name, public_ip, instance_id):
+    output.debug("Associating public IP %s into instance %s..." %
+                 (public_ip, name))
+    conn.associate_address(instance_id, public_ip)
+    return instance_id
+
+
+def _address_associated(conn, public_ip, instance_id):
+    instance = _describe(conn.get_only_instances, instance_id)
+    return instance is not None and instance.ip_address == public_ip
+
+
+def _create_volume_from(conn, name, snapshot_id):
+    output.debug("Creating EBS data volume for instance %s from "
+                 "snapshot %s..." % (name, snapshot_id))
+    volume = conn.create_volume(None, regions.zone(), snapshot=snapshot_id)
+    return volume.id
+
+
+def _volume_created(conn, volume_id):
+    volume = _describe(conn.get_all_volumes, volume_id)
+    return volume is not None and volume.status != "error"
+
+
+def _attach_restored_volume(conn, name, instance_id, volume_id):
+    """Return the ids of the volume and of the instance it is attached to"""
+    # Waiting here rather than in the volume task keeps a worker free while
+    # the instance boots
+    wait_for_volumes(conn, [volume_id]).check()
+    output.debug("Attaching EBS data volume for instance %s..." % name)
+    conn.attach_volume(volume_id, instance_id, EC2_DEFAULT_DATA_DEVICE)
+    wait_for_volumes(conn, [volume_id], "in-use").check()
+    return volume_id, instance_id
+
+
+def _volume_attached(conn, attachment):
+    volume_id, instance_id = attachment
+    volume = _describe(conn.get_all_volumes, volume_id)
+    return (volume is not None and volume.status == "in-use" and
+            volume.attach_data.instance_id == instance_id)
+
+
+def _run_plan(plan, workers):
+    """Run `plan', or only print it with run.py --plan; return if it ran"""
+    if plans.dry_run:
+        for line in plan.describe():
+            print line
+        return False
+    plan.run(workers)
+    return True
+
+
+def _record_history(plan, event, tasks):
+    """
+    Record `event' in the history of each virtual machine whose tasks all
+    succeeded, with the seconds from the start of `plan' to the end of its
+    last task
+    * `tasks' is a list of (name, names of its tasks)
+    """
+    rows = []
+    for name, names in tasks:
+        if plan.error(names) is None:
+            end = max(plan[task].end for task in names)
+            rows.append((name, event, plan.start, end - plan.start))
+    db.put_history(rows)
+
+
+def _print_report(plan, journal=None):
+    print
+    for line in plan.report():
+        print line
+    if journal and journal.resumed:
+        print "  %d step(s) done by an interrupted run were not redone" % (
+            journal.resumed)
+
+
+def autoscale_instances(conn, workers=EC2_DEFAULT_WORKERS):
+    """Set up an Autoscale group for each running instance, concurrently"""
+    image_ids = dict((instance.tags.get("Name", "-"), instance.image_id)
+                     for instance in get_instances(conn))
+    results = setup_autoscale_groups(conn, image_ids, workers)
+    _print_summary(results, lambda name: (name, image_ids[name]))
+    if all(result.ok for result in results):
+        output.success("Autoscale is set up for all instances.")
+    else:
+        output.error("Autoscale could not be set up for some instances.")
+    return results
+
+
+def stop_autoscale(conn, workers=EC2_DEFAULT_WORKERS):
+    """Delete all Autoscale groups, concurrently"""
+    results = delete_autoscale_groups(conn, workers=workers)
+    _print_summary(results, lambda name: (name, "-"))
+    if all(result.ok for result in results):
+        output.success("All Autoscale groups are deleted.")
+    else:
+        output.error("Some Autoscale groups could not be deleted.")
+    return results
+
+
+def get_instances(conn, state="running", tags=None, instance_ids=None,
+                  page_size=EC2_DESCRIBE_PAGE_SIZE):
+    """
+    Generate instances associated with this account
+    * `state', `tags' (mapping of tag name to a value or list of values) and
+      `instance_ids' are sent to EC2 as filters
+    * Results are read `page_size' instances at a time; the next page is
+      requested while the instances of the current one are processed
+    """
+    if instance_ids is not None and not instance_ids:
+        return
+    filters = {}
+    if state:
+        filters["instance-state-name"] = state
+    for name, value in (tags or {}).items():
+        filters["tag:" + name] = value
+    # EC2 rejects a page size along with instance IDs
+    max_results = None if instance_ids else page_size
+
+    def fetch(next_token):
+        return conn.get_all_reservations(instance_ids=instance_ids,
+                                         filters=filters,
+                                         max_results=max_results,
+                                         next_token=next_token)
+
+    page = fetch(None)
+    while True:
+        next_page = page.next_token and Prefetch(fetch, page.next_token)
+        for reservation in page:
+            for instance in reservation.instances:
+                yield instance
+        if not next_page:
+            break
+        page = next_page.get()
 
 
 def list_instances_info(conn, instances=None):
     if not instances:
-        instances = get_instances(conn)
+        instances = list(get_instances(conn))
+    # Only the CPU utilization is shown
+    now = idle_detector.refresh(cw_conn, [i.id for i in instances],
+                                metrics=["CPUUtilization"])
     print _format_line("Name", "Instance ID", "State", "CPU Util (%)")
     print '-' * 60
     for instance in instances:
         name = instance.tags.get("Name", "-")
         instance_id = instance.id
         state = instance.state
-        cpu_util = "%.2f" % get_cpu_stat(cw_conn, instance_id)
+        cpu_util = "-"
+        mean = idle_detector.mean(instance_id, "CPUUtilization", 10, now)
+        if mean is not None:
+            cpu_util = "%.2f" % mean
         print _format_line(name, instance_id, state, cpu_util)
     return len(instances)
 
@@ -306,10 +1021,38 @@ def _format_line(*items):
     return line
 
 
-def assign_tags(conn, instances, tags):
-    assert len(instances) == len(tags)
-    for i, instance in enumerate(instances):
-        conn.create_tags([instance.id], {"Name": tags[i]})
+def _tags(name):
+    """Tags of the instance of virtual machine `name'"""
+    tags = {"Name": name}
+    group = fleet.current.group_of(name)
+    if group:
+        tags["Group"] = group.name
+    return tags
+
+
+def assign_tags(conn, names, workers=EC2_DEFAULT_WORKERS):
+    """
+    Tag instances with their virtual machine names and fleet groups
+    * `names' maps instance ids to virtual machine names
+    * A CreateTags call sets the same tags on all its resources: group tags
+      are set on up to EC2_TAG_BATCH_SIZE instances at once, Name tags one
+      instance at a time, concurrently
+    """
+    groups = {}
+    for instance_id, name in names.items():
+        group = fleet.current.group_of(name)
+        if group:
+            groups.setdefault(group.name, []).append(instance_id)
+    for group_name, instance_ids in sorted(groups.items()):
+        for i in range(0, len(instance_ids), EC2_TAG_BATCH_SIZE):
+            conn.create_tags(instance_ids[i:i + EC2_TAG_BATCH_SIZE],
+                             {"Group": group_name})
+
+    def tag(item):
+        instance_id, name = item
+        conn.create_tags([instance_id], {"Name": name})
+
+    run_parallel(tag, names.items(), workers)
 
 
 def create_image(conn, instance):
@@ -319,9 +1062,8 @@ def create_image(conn, instance):
         conn.create_image(name)
 
 
-def get_instance(get_instance, instance_id):
+def get_instance(conn, instance_id):
     instances = conn.get_only_instances(instance_ids=[instance_id])
-    assert len(instances) == 1
     if instances:
         return instances[0]
 
@@ -329,38 +1071,37 @@ def get_instance(get_instance, instance_id):
 def delete_all_images(conn):
     images = conn.get_all_images(owners=["self"])
     for image in images:
-        image.deregister()
+        conn.deregister_image(image.id)
 
 
 def get_idle_instances(conn, time_limit=EC2_INSTANCE_IDLE_TIME,
-                       cpu_limit=EC2_INSTANCE_IDLE_CPU):
-    """Get instances whose CPU utilization is less than 5 percent for
-    for 10 minutes, or if it is after 5:00 p.m.
+                       instances=None, detector=idle_detector):
+    """Get instances for which every idle rule of `detector' holds (see
+    IDLE_RULES), or all instances if it is after 5:00 p.m.
         time_limit is a number (0-24) representing 24-hour
+        instances are the running instances if not given
     """
-    instances = get_instances(conn)
+    if instances is None:
+        instances = list(get_instances(conn))
     idle_instances = []
     now = datetime.datetime.now()
     if now.hour >= time_limit:
         output.debug("The current local time is after %d:00 p.m.. All"
                      " instances will be stored." % (time_limit - 12))
+        return instances
+    # Only the metrics the rules read are fetched
+    now = detector.refresh(cw_conn, [i.id for i in instances],
+                           metrics=sorted(set(rule.metric
+                                              for rule in detector.rules)))
     for instance in instances:
-        if now.hour >= time_limit:
-            idle_instances.append(instance)
-            continue
-        cpu_util = get_cpu_stat(cw_conn, instance.id)
-        if cpu_util < cpu_limit:
+        if detector.is_idle(instance.id, now):
             name = instance.tags.get("Name", "-")
-            fmsg = "Instance %s (%s) has an average CPU Utilization of %.2f%%."
-            msg = fmsg % (name, instance.id, cpu_util)
-            output.debug(msg)
+            values = ", ".join(
+                "p%d %s over %d min is %.2f" % (rule.percentile, rule.metric,
+                                               rule.minutes, value)
+                for rule, value in detector.evaluate(instance.id, now))
+            output.debug("Instance %s (%s) is idle: %s." %
+                         (name, instance.id, values))
             output.debug("This instance is to be stored.")
             idle_instances.append(instance)
     return idle_instances
-
-
-def flush_db():
-    output.debug("Flushing local DB files...")
-    db.write_data(DB_FILES["addresses"], [])
-    db.write_data(DB_FILES["snapshots"], [])
-    output.success("Local DB file are flushed.")
@@ -0,0 +1,70 @@
+# Write-ahead journal of store and restore
+# * Each step of a command is recorded in the local DB once it is done for a
+#   resource (an instance being stored, an AMI being restored), with the
+#   value later steps need, e.g. the id of the AMI it created
+# * A rerun of an interrupted command skips the recorded steps whose result
+#   still holds in AWS, and continues from the first unfinished step of each
+#   resource
+# * Requests followed by a long wait (creating an AMI, launching an
+#   instance) are also recorded as soon as they are made, so that a rerun
+#   waits for the resource instead of requesting another one
+import threading
+
+from .utils import output
+import db
+
+
+class Journal(object):
+
+    def __init__(self, command):
+        self.command = command
+        self.resumed = 0  # Number of steps skipped as already done
+        self._entries = db.get_journal(command)
+        self._lock = threading.Lock()
+
+    def __contains__(self, resource):
+        return resource in self._entries
+
+    @property
+    def resources(self):
+        return list(self._entries)
+
+    def get(self, resource, step, default=None):
+        return self._entries.get(resource, {}).get(step, default)
+
+    def put(self, resource, step, value=None):
+        db.put_journal(self.command, resource, step, value)
+        with self._lock:
+            self._entries.setdefault(resource, {})[step] = value
+
+    def step(self, resource, step, func, verify=None):
+        """
+        Wrap `func' as `step' of `resource'
+        * If the step is recorded and `verify(value)' holds (or no `verify'
+          is given), the wrapper returns the recorded value without calling
+          `func'; otherwise it calls `func' and records its value, which
+          must be JSON-serializable
+        """
+        def run(*args):
+            steps = self._entries.get(resource, {})
+            if step in steps:
+                value = steps[step]
+                if verify is None or verify(value):
+                    output.debug("Resuming %s of %s: %s is already done." %
+                                 (self.command, resource, step))
+                    with self._lock:
+                        self.resumed += 1
+                    return value
+                output.warning("Redoing %s of %s: %s no longer holds in "
+                               "AWS." % (self.command, resource, step))
+            value = func(*args)
+            self.put(resource, step, value)
+            return value
+        return run
+
+    def done(self, resources):
+        """Forget the steps of `resources', whose command is complete"""
+        db.delete_journal(self.command, resources)
+        with self._lock:
+            for resource in resources:
+                self._entries.pop(resource, None)
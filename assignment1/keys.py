@@ -1,11 +1,25 @@
 import os
-from .settings import EC2_DEFAULT_KEY_NAME, EC2_DEFAULT_KEY_PATH
+from . import regions
+from .settings import (EC2_DEFAULT_KEY_NAME, EC2_DEFAULT_KEY_PATH,
+                       EC2_DEFAULT_REGION)
 from .utils import output
 
 
-def initialize_key_pair(conn, name=EC2_DEFAULT_KEY_NAME):
+def key_name():
+    """
+    Name of the key pair of the current region: EC2_DEFAULT_KEY_NAME, with
+    the region appended outside EC2_DEFAULT_REGION since private keys are
+    saved by name
+    """
+    region = regions.current()
+    if region == EC2_DEFAULT_REGION:
+        return EC2_DEFAULT_KEY_NAME
+    return "%s-%s" % (EC2_DEFAULT_KEY_NAME, region)
+
+
+def initialize_key_pair(conn, name=None):
     """Initialize key pair and download private key to default path"""
-    key_pair = conn.create_key_pair(name)
+    key_pair = conn.create_key_pair(name or key_name())
     save_private_key(key_pair)
     return key_pair
 
@@ -17,9 +31,10 @@ def save_private_key(key_pair):
     key_pair.save(EC2_DEFAULT_KEY_PATH)
 
 
-def get_key_pair(conn, name=EC2_DEFAULT_KEY_NAME):
+def get_key_pair(conn, name=None):
+    name = name or key_name()
     key_pair = conn.get_key_pair(name)
     if key_pair:
         return key_pair
-    key_pair = initialize_key_pair(conn)
+    key_pair = initialize_key_pair(conn, name)
     return key_pair
@@ -0,0 +1,189 @@
+# API call instrumentation
+# * Every request made through an instrumented boto connection is recorded
+#   per (command, service, operation): count, latency histogram, errors and
+#   throttled requests
+# * At the end of a run the records are printed as a table, and can be
+#   written as JSON or in the Prometheus text format
+import json
+import threading
+import time
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+THROTTLE_CODES = ("Throttling", "ThrottlingException", "RequestLimitExceeded",
+                  "SlowDown", "RequestThrottled")
+
+
+class OperationStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.throttles = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # Last one is +Inf
+
+    def add(self, latency, error, throttled):
+        self.count += 1
+        self.errors += int(error)
+        self.throttles += int(throttled)
+        self.total_time += latency
+        self.max_time = max(self.max_time, latency)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def quantile(self, q):
+        """Upper bound of the histogram bucket holding quantile `q'"""
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                if i < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[i]
+                return self.max_time
+        return 0.0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "throttles": self.throttles,
+            "total_time": self.total_time,
+            "max_time": self.max_time,
+            "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"],
+                                self.buckets)),
+        }
+
+
+class Metrics(object):
+    """Registry of API call statistics, attributed to the current command"""
+
+    def __init__(self):
+        self.command = "-"
+        self.operations = {}  # Mapping of (command, service, op) to stats
+        self._lock = threading.Lock()
+
+    def record(self, service, operation, latency, error=False,
+               throttled=False):
+        key = (self.command, service, operation)
+        with self._lock:
+            if key not in self.operations:
+                self.operations[key] = OperationStats()
+            self.operations[key].add(latency, error, throttled)
+
+    def summary(self):
+        """Return the statistics as lines of a table"""
+        fmt = " {:<10} {:<30} {:>6} {:>6} {:>9} {:>8} {:>8} {:>8}"
+        lines = [fmt.format("Service", "Operation", "Calls", "Errors",
+                            "Throttled", "Avg ms", "p95 ms", "Max ms"),
+                 '-' * 95]
+        for (command, service, op), stats in sorted(self.operations.items()):
+            lines.append(fmt.format(
+                service, op, stats.count, stats.errors, stats.throttles,
+                "%.0f" % (1000 * stats.total_time / stats.count),
+                "%.0f" % (1000 * stats.quantile(0.95)),
+                "%.0f" % (1000 * stats.max_time)))
+        return lines
+
+    def to_json(self):
+        return json.dumps([
+            dict(stats.to_dict(), command=command, service=service,
+                 operation=op)
+            for (command, service, op), stats
+            in sorted(self.operations.items())], indent=2)
+
+    def to_prometheus(self):
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append("# HELP assignment1_%s %s" % (name, help))
+            lines.append("# TYPE assignment1_%s %s" % (name, kind))
+
+        def labels(key, **extra):
+            pairs = zip(("command", "service", "operation"), key)
+            pairs += sorted(extra.items())
+            return ",".join('%s="%s"' % (k, v) for k, v in pairs)
+
+        items = sorted(self.operations.items())
+        for name, attr, help in (
+                ("api_calls_total", "count", "API calls made"),
+                ("api_errors_total", "errors", "API calls that failed"),
+                ("api_throttles_total", "throttles",
+                 "API calls rejected by throttling")):
+            metric(name, "counter", help)
+            for key, stats in items:
+                lines.append("assignment1_%s{%s} %d" %
+                             (name, labels(key), getattr(stats, attr)))
+        metric("api_latency_seconds", "histogram", "API call latency")
+        for key, stats in items:
+            cumulative = 0
+            bounds = [str(b) for b in LATENCY_BUCKETS] + ["+Inf"]
+            for bound, n in zip(bounds, stats.buckets):
+                cumulative += n
+                lines.append("assignment1_api_latency_seconds_bucket{%s} %d" %
+                             (labels(key, le=bound), cumulative))
+            lines.append("assignment1_api_latency_seconds_sum{%s} %f" %
+                         (labels(key), stats.total_time))
+            lines.append("assignment1_api_latency_seconds_count{%s} %d" %
+                         (labels(key), stats.count))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def _is_throttled(response):
+    if response.status == 503:
+        return True
+    body = response.read()  # Cached by boto for later reads
+    return any("<Code>%s</Code>" % code in body for code in THROTTLE_CODES)
+
+
+def _s3_operation(method, bucket="", key="", headers=None, data="",
+                  query_args=None, *args, **kwargs):
+    resource = "Object" if key else "Bucket" if bucket else "Service"
+    operation = "%s %s" % (method, resource)
+    if query_args:
+        operation += "?" + query_args.split("&")[0].split("=")[0]
+    return operation
+
+
+def _query_operation(action, *args, **kwargs):
+    return action
+
+
+def instrument(connection, service):
+    """
+    Record every request made through a boto connection
+    * Return the connection, whose make_request() is wrapped in place
+    """
+    make_request = connection.make_request
+    if service == "s3":
+        operation_name = _s3_operation
+    else:
+        operation_name = _query_operation
+
+    def instrumented(*args, **kwargs):
+        operation = operation_name(*args, **kwargs)
+        start = time.time()
+        try:
+            response = make_request(*args, **kwargs)
+        except Exception:
+            metrics.record(service, operation, time.time() - start, True)
+            raise
+        latency = time.time() - start
+        error = response.status >= 400
+        throttled = error and _is_throttled(response)
+        metrics.record(service, operation, latency, error, throttled)
+        return response
+
+    connection.make_request = instrumented
+    return connection
@@ -0,0 +1,90 @@
+# Bounded worker pool for per-resource pipelines
+import sys
+import threading
+
+from . import clock, connections, db, regions
+from .settings import EC2_DEFAULT_WORKERS
+
+
+class TaskResult(object):
+    """Outcome of running a task against one item"""
+
+    def __init__(self, item, value=None, error=None):
+        self.item = item
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class Prefetch(object):
+    """Run `func(*args)' on a background thread until its value is needed"""
+
+    def __init__(self, func, *args):
+        self._result = None
+
+        def worker():
+            try:
+                try:
+                    self._result = TaskResult(args, value=func(*args))
+                except Exception:
+                    self._result = TaskResult(args, error=sys.exc_info()[1])
+            finally:
+                connections.release_thread()
+                db.close()
+                clock.thread_done()
+
+        self._thread = threading.Thread(target=regions.bound(worker))
+        self._thread.daemon = True
+        clock.start_thread(self._thread)
+
+    def get(self):
+        """Wait for the value of `func', raising its exception if any"""
+        with clock.blocked():
+            self._thread.join()
+        if not self._result.ok:
+            raise self._result.error
+        return self._result.value
+
+
+def run_parallel(func, items, workers=EC2_DEFAULT_WORKERS):
+    """
+    Run `func(item)' for every item on at most `workers' threads
+    * Return a list of TaskResult in the same order as `items'
+    * An exception raised by `func' is recorded in its TaskResult instead of
+      aborting the other items
+    """
+    items = list(items)
+    results = [None] * len(items)
+    indexes = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    try:
+                        i = next(indexes)
+                    except StopIteration:
+                        return
+                try:
+                    results[i] = TaskResult(items[i], value=func(items[i]))
+                except Exception:
+                    results[i] = TaskResult(items[i], error=sys.exc_info()[1])
+        finally:
+            connections.release_thread()
+            db.close()
+            clock.thread_done()
+
+    num = max(1, min(workers, len(items)))
+    threads = [threading.Thread(target=regions.bound(worker))
+               for _ in range(num)]
+    for thread in threads:
+        thread.daemon = True
+        clock.start_thread(thread)
+    with clock.blocked():
+        for thread in threads:
+            thread.join()
+    return results
@@ -0,0 +1,252 @@
+# Execution plans
+# * Commands made of many AWS operations (init, store, restore) are described
+#   as a graph of tasks with explicit dependencies; each task starts as soon
+#   as the tasks it depends on are done, on at most `workers' threads
+# * A task whose dependency failed is skipped
+# * Before a run, a plan can be printed with its critical path estimated from
+#   PLAN_ESTIMATES (run.py --plan); after a run, the report tells where the
+#   wall time went: time per kind of task and the actual critical path
+import heapq
+import sys
+import threading
+
+from . import clock, connections, db, regions
+from .settings import PLAN_ESTIMATES, EC2_DEFAULT_WORKERS
+
+
+# When set (run.py --plan), commands print their plan instead of running it
+dry_run = False
+
+
+class Task(object):
+    """
+    Step of a plan
+    * `func' is called with the values of the tasks of `deps', in order
+    * `kind' groups the tasks of a kind in reports and gives the estimate
+    """
+
+    def __init__(self, index, name, kind, func, deps):
+        self.index = index
+        self.name = name
+        self.kind = kind
+        self.func = func
+        self.deps = deps
+        self.dependents = []
+        self.waiting = len(deps)  # Dependencies not done yet
+        self.status = "pending"  # pending, done, failed or skipped
+        self.value = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    @property
+    def ok(self):
+        return self.status == "done"
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    @property
+    def estimate(self):
+        return PLAN_ESTIMATES.get(self.kind, 1)
+
+
+class Plan(object):
+
+    def __init__(self, title):
+        self.title = title
+        self.tasks = []
+        self._tasks_by_name = {}
+        self._lock = threading.Lock()
+        self._ready = []  # Heap of (index, task)
+        self._active = 0
+        self._finished = 0
+        self._all_finished = threading.Event()
+        self.start = None
+        self.end = None
+
+    def add(self, name, kind, func, deps=()):
+        """Add a task depending on the tasks named `deps'; return `name'"""
+        if name in self._tasks_by_name:
+            raise ValueError("Duplicate task in plan: %s" % name)
+        deps = [self._tasks_by_name[dep] for dep in deps]
+        task = Task(len(self.tasks), name, kind, func, deps)
+        for dep in deps:
+            dep.dependents.append(task)
+        self.tasks.append(task)
+        self._tasks_by_name[name] = task
+        return name
+
+    def __getitem__(self, name):
+        return self._tasks_by_name[name]
+
+    def __contains__(self, name):
+        return name in self._tasks_by_name
+
+    def error(self, names):
+        """
+        First error among the tasks named `names', None if all are done
+        * A skipped task has the error of the task that failed before it
+        """
+        for name in names:
+            task = self[name]
+            if task.error is not None:
+                return task.error
+            if task.status != "done":
+                return RuntimeError("Task %s was %s" % (name, task.status))
+        return None
+
+    def run(self, workers=EC2_DEFAULT_WORKERS):
+        """Run the tasks, each as soon as its dependencies are done"""
+        self.start = clock.now()
+        if self.tasks:
+            with self._lock:
+                for task in self.tasks:
+                    if not task.deps:
+                        heapq.heappush(self._ready, (task.index, task))
+                self._dispatch(workers)
+            with clock.blocked():
+                self._all_finished.wait()
+        self.end = clock.now()
+
+    def _dispatch(self, workers):
+        """Start a thread for each ready task, up to `workers' busy threads"""
+        while self._ready and self._active < workers:
+            task = heapq.heappop(self._ready)[1]
+            self._active += 1
+            thread = threading.Thread(target=regions.bound(self._work),
+                                      args=(task, workers))
+            thread.daemon = True
+            clock.start_thread(thread)
+
+    def _work(self, task, workers):
+        try:
+            while task is not None:
+                self._run_task(task)
+                with self._lock:
+                    self._finish(task)
+                    # Go on with the next ready task on this thread
+                    task = None
+                    if self._ready:
+                        task = heapq.heappop(self._ready)[1]
+                        self._dispatch(workers)
+        finally:
+            connections.release_thread()
+            db.close()
+            with self._lock:
+                self._active -= 1
+                self._dispatch(workers)
+                # The run is over once every thread let go of its
+                # connections
+                if not self._active and self._finished == len(self.tasks):
+                    self._all_finished.set()
+            clock.thread_done()
+
+    def _run_task(self, task):
+        task.start = clock.now()
+        try:
+            task.value = task.func(*[dep.value for dep in task.deps])
+            task.status = "done"
+        except Exception:
+            task.error = sys.exc_info()[1]
+            task.status = "failed"
+        task.end = clock.now()
+
+    def _finish(self, task):
+        self._finished += 1
+        if task.status == "done":
+            for dependent in task.dependents:
+                dependent.waiting -= 1
+                if not dependent.waiting:
+                    heapq.heappush(self._ready, (dependent.index, dependent))
+            return
+        # Skip whatever depends on a failed task
+        pending = list(task.dependents)
+        while pending:
+            dependent = pending.pop()
+            if dependent.status == "pending":
+                dependent.status = "skipped"
+                dependent.error = task.error
+                self._finished += 1
+                pending.extend(dependent.dependents)
+
+    def critical_path(self, actual=False):
+        """
+        Longest chain of dependent tasks by estimated durations, or, after a
+        run, the chain that ended last: from the last task to finish, back
+        through the dependency each task waited for last
+        * Return the total seconds and the list of tasks
+        """
+        if not self.tasks:
+            return 0, []
+        if actual:
+            ran = [task for task in self.tasks if task.end is not None]
+            if not ran:
+                return 0, []
+            task = max(ran, key=lambda t: t.end)
+            path = [task]
+            while task.deps:
+                task = max(task.deps, key=lambda d: d.end)
+                path.append(task)
+            return path[0].end - self.start, path[::-1]
+        longest = {}  # Mapping of tasks to (seconds, previous task)
+        for task in self.tasks:  # Dependencies are added before dependents
+            previous = max(task.deps, key=lambda d: longest[d][0]) \
+                if task.deps else None
+            before = longest[previous][0] if previous else 0
+            longest[task] = (before + task.estimate, previous)
+        task = max(self.tasks, key=lambda t: longest[t][0])
+        total = longest[task][0]
+        path = []
+        while task is not None:
+            path.append(task)
+            task = longest[task][1]
+        return total, path[::-1]
+
+    def describe(self):
+        """Return the graph and its estimated critical path as lines"""
+        lines = ["Plan: %s (%d tasks)" % (self.title, len(self.tasks))]
+        for task in self.tasks:
+            line = "  %-30s %-12s ~%ds" % (task.name, task.kind, task.estimate)
+            if task.deps:
+                line += "  after " + ", ".join(d.name for d in task.deps)
+            lines.append(line)
+        total, path = self.critical_path()
+        lines.append("Estimated critical path: %ds" % total)
+        lines.extend("  %-30s ~%ds" % (t.name, t.estimate) for t in path)
+        return lines
+
+    def report(self):
+        """Return where the wall time of the last run went, as lines"""
+        wall = (self.end or 0) - (self.start or 0)
+        lines = ["Plan: %s ran in %.0fs" % (self.title, wall)]
+        statuses = {}
+        for task in self.tasks:
+            statuses[task.status] = statuses.get(task.status, 0) + 1
+        lines.append("  " + ", ".join("%d %s" % (n, status) for status, n
+                                      in sorted(statuses.items())))
+        fmt = "  {:<12} {:>6} {:>10} {:>10} {:>10}"
+        lines.append(fmt.format("Kind", "Tasks", "Total (s)", "Max (s)",
+                                "Path (s)"))
+        total, path = self.critical_path(actual=True)
+        kinds = {}
+        for task in self.tasks:
+            stats = kinds.setdefault(task.kind, [0, 0.0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += task.duration
+            stats[2] = max(stats[2], task.duration)
+        for task in path:
+            kinds[task.kind][3] += task.duration
+        for kind, (n, seconds, longest, on_path) in sorted(
+                kinds.items(), key=lambda k: -k[1][1]):
+            lines.append(fmt.format(kind, n, "%.0f" % seconds,
+                                    "%.0f" % longest, "%.0f" % on_path))
+        # Time of the critical path outside its tasks was spent waiting for
+        # a free worker
+        lines.append("  Critical path: %.0fs (%.0fs in tasks), %s" % (
+            total, sum(t.duration for t in path),
+            " -> ".join(t.name for t in path)))
+        return lines
@@ -0,0 +1,130 @@
+# Predictive prewarm
+# * Store and restore record in the history of each virtual machine (local
+#   DB) when they ran and how long they took; the daemon records when it
+#   first sees each virtual machine busy on a day
+# * A virtual machine is needed on a day from the first time it is restored
+#   by hand or seen busy; when it is needed today is predicted from its
+#   need times of the past days of the same kind, weekdays or weekends (see
+#   PREWARM_* in settings.py)
+# * `run.py prewarm', run every few minutes (e.g. from cron), restores the
+#   stored virtual machines whose predicted need is nearer than their
+#   measured restore duration plus PREWARM_MARGIN
+import datetime
+import time
+
+from . import clock
+from .conn import conn
+from .idle import percentile
+from .instances import get_instances, restore_instances
+from .settings import (PREWARM_HISTORY_DAYS, PREWARM_MIN_DAYS,
+                       PREWARM_MIN_USE, PREWARM_NEED_PERCENTILE,
+                       PREWARM_DURATION_PERCENTILE, PREWARM_MARGIN,
+                       EC2_DEFAULT_WORKERS)
+from .utils import output
+import db
+
+
+# Events telling that a virtual machine is needed, and events measuring how
+# long its restore takes
+NEED_EVENTS = ("restore", "active")
+RESTORE_EVENTS = ("restore", "prewarm")
+
+DAY = 24 * 3600
+
+
+def _midnight(timestamp):
+    """Local midnight of the day of `timestamp'"""
+    day = datetime.date.fromtimestamp(timestamp)
+    return time.mktime(day.timetuple())
+
+
+def _is_weekend(day):
+    return day.weekday() >= 5
+
+
+def need_times(events):
+    """
+    Return a dictionary mapping days to the time a virtual machine was first
+    needed on them
+    * `events' is its history, a list of (event, timestamp, duration)
+    """
+    needs = {}
+    for event, timestamp, _ in events:
+        if event in NEED_EVENTS:
+            day = datetime.date.fromtimestamp(timestamp)
+            needs[day] = min(needs.get(day, timestamp), timestamp)
+    return needs
+
+
+def restore_duration(events):
+    """Seconds a restore of a virtual machine takes, None if never measured"""
+    durations = [duration for event, _, duration in events
+                 if event in RESTORE_EVENTS and duration is not None]
+    if not durations:
+        return None
+    return percentile(durations, PREWARM_DURATION_PERCENTILE)
+
+
+def predict(events, now, since, duration=None):
+    """
+    Predict when a virtual machine is needed today
+    * `events' is its history, a list of (event, timestamp, duration), and
+      `since' the time the recorded history starts at
+    * `duration' is the restore duration to count on if none of its
+      restores was measured
+    * Return a tuple of the times its restore is to start at and it is
+      needed at, or None if it is not expected today
+    """
+    today = datetime.date.fromtimestamp(now)
+    first = max(datetime.date.fromtimestamp(since),
+                today - datetime.timedelta(days=PREWARM_HISTORY_DAYS))
+    days = [first + datetime.timedelta(days=n)
+            for n in range((today - first).days)]
+    days = [day for day in days if _is_weekend(day) == _is_weekend(today)]
+    needs = need_times(events)
+    times = [needs[day] - _midnight(needs[day]) for day in days
+             if day in needs]
+    if len(times) < max(PREWARM_MIN_DAYS, PREWARM_MIN_USE * len(days)):
+        return None
+    duration = restore_duration(events) or duration
+    if duration is None:
+        return None
+    need = _midnight(now) + percentile(times, PREWARM_NEED_PERCENTILE)
+    return need - duration - PREWARM_MARGIN, need
+
+
+def prewarm_instances(conn=conn, workers=EC2_DEFAULT_WORKERS):
+    """
+    Restore the stored virtual machines expected to be needed soon (see
+    predict)
+    * Return the list of TaskResult of the restore, None if no virtual
+      machine is due
+    """
+    now = clock.now()
+    db.prune_history(now - PREWARM_HISTORY_DAYS * DAY)
+    history = db.get_history()
+    if not history:
+        output.warning("No history yet: nothing to prewarm.")
+        return
+    since = min(events[0][1] for events in history.values())
+    durations = filter(None, map(restore_duration, history.values()))
+    # Virtual machines never restored count on the typical restore
+    default = percentile(durations, 50) if durations else None
+    running = set(instance.tags.get("Name") for instance in
+                  get_instances(conn, state=["pending", "running"]))
+    due = []
+    for name, events in sorted(history.items()):
+        prediction = predict(events, now, since, default)
+        if prediction is None or name in running:
+            continue
+        start, need = prediction
+        output.debug("%s is expected at %s; prewarm from %s." % (
+            name, time.strftime("%H:%M", time.localtime(need)),
+            time.strftime("%H:%M", time.localtime(start))))
+        if start <= now < need:
+            due.append(name)
+    if not due:
+        output.debug("No stored virtual machine is due to be prewarmed.")
+        return
+    output.debug("Prewarming %s..." % ", ".join(due))
+    return restore_instances(conn, workers, names=due, prewarm=True)
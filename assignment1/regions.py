@@ -0,0 +1,168 @@
+# Regions
+# * Commands run in the region of the calling thread: EC2_DEFAULT_REGION and
+#   EC2_DEFAULT_EBS_AZ, unless a `with use(region, zone)' block selects
+#   others. Connections (connections.get), the describe cache and the local
+#   DB follow the region of the thread using them
+# * Worker threads run in the region of the thread that started them, which
+#   wraps their target with bound()
+# * run_in_regions() runs a command in several regions at once, each on a
+#   thread of its own: the output of a region is held back and printed as a
+#   block as soon as the region is done, so that a slow region neither holds
+#   up nor interleaves with the others
+import contextlib
+import sys
+import threading
+
+from . import clock
+from .settings import EC2_DEFAULT_REGION, EC2_DEFAULT_EBS_AZ
+
+
+_local = threading.local()
+_print_lock = threading.Lock()
+
+
+def current():
+    """Region of the current thread"""
+    return getattr(_local, "region", None) or EC2_DEFAULT_REGION
+
+
+def zone():
+    """Availability zone of the current thread, in its region"""
+    return getattr(_local, "zone", None) or default_zone(current())
+
+
+def default_zone(region):
+    """EC2_DEFAULT_EBS_AZ in the default region, the first AZ elsewhere"""
+    if region == EC2_DEFAULT_REGION:
+        return EC2_DEFAULT_EBS_AZ
+    return region + "a"
+
+
+def parse(name):
+    """Return the region and the availability zone of a region or AZ name"""
+    if name[-1:].isalpha():
+        return name[:-1], name
+    return name, default_zone(name)
+
+
+@contextlib.contextmanager
+def use(region, zone=None, out=None):
+    """
+    Run the block in `region' and `zone' (default_zone(region) if not
+    given); with `out', a list, output of the block is appended to it as
+    (stream, data) while run_in_regions() holds back output
+    """
+    saved = _context()
+    _local.region, _local.zone, _local.out = region, zone, out
+    try:
+        yield
+    finally:
+        _local.region, _local.zone, _local.out = saved
+
+
+def _context():
+    return (getattr(_local, "region", None), getattr(_local, "zone", None),
+            getattr(_local, "out", None))
+
+
+def bound(func):
+    """Wrap `func' to run in the region of the calling thread"""
+    context = _context()
+
+    def run(*args, **kwargs):
+        _local.region, _local.zone, _local.out = context
+        return func(*args, **kwargs)
+    return run
+
+
+class _HeldOutput(object):
+    """
+    Stand-in for sys.stdout or sys.stderr appending what threads of a region
+    write to the output of their region, if it is held back
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        out = getattr(_local, "out", None)
+        if out is None:
+            self.stream.write(data)
+        else:
+            out.append((self.stream, data))
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_in_regions(func, names):
+    """
+    Run `func()' in each region or availability zone of `names' at once
+    * Return a list of TaskResult in the same order as `names', whose
+      values are tuples of the value of `func' and the seconds it took
+    """
+    from .parallel import run_parallel
+
+    def run(name):
+        region, zone = parse(name)
+        out = []
+        start = clock.now()
+        with use(region, zone, out):
+            try:
+                value = func()
+            finally:
+                _print_held(name, out, clock.now() - start)
+        return value, clock.now() - start
+
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _HeldOutput(sys.stdout), _HeldOutput(sys.stderr)
+    try:
+        return run_parallel(run, names, workers=len(names))
+    finally:
+        sys.stdout, sys.stderr = saved
+
+
+def _print_held(name, out, seconds):
+    with _print_lock:
+        stdout = getattr(sys.stdout, "stream", sys.stdout)
+        stdout.write("\n=== %s (%.0fs) ===\n" % (name, seconds))
+        for stream, data in out:
+            stream.write(data)
+        for stream in set(stream for stream, _ in out):
+            stream.flush()
+
+
+def print_report(results):
+    """
+    Print the merged outcome of a command run by run_in_regions()
+    * Values of the command that are lists of TaskResult are counted and
+      their failures listed
+    """
+    fmt = " {:<15} {:<10} {:>6} {:>7} {:>9}"
+    print
+    print fmt.format("Region", "Result", "Items", "Failed", "Time (s)")
+    print '-' * 52
+    failures = []
+    for result in results:
+        if not result.ok:
+            print fmt.format(result.item, "FAILED", "-", "-", "-")
+            failures.append((result.item, "-", result.error))
+            continue
+        value, seconds = result.value
+        items = value if isinstance(value, list) else []
+        failed = [item for item in items if not item.ok]
+        failures.extend((result.item, _label(item.item), item.error)
+                        for item in failed)
+        print fmt.format(result.item, "FAILED" if failed else "OK",
+                         len(items), len(failed), "%.0f" % seconds)
+    for region, label, error in failures:
+        print " %s %s: %s" % (region, label,
+                              str(error) or error.__class__.__name__)
+
+
+def _label(item):
+    """Name of an item of a command result: instance, AMI or name"""
+    tags = getattr(item, "tags", None)
+    if tags and tags.get("Name"):
+        return tags["Name"]
+    return getattr(item, "name", None) or getattr(item, "id", None) or item
@@ -1,13 +1,22 @@
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+import calendar
+import email.utils
+import hashlib
+import json
+import os
 import sys
+import threading
+import time
 
-
-from .settings import S3_DEFAULT_BUCKET
+from . import connections
+from .parallel import run_parallel
+from .settings import (S3_DEFAULT_BUCKET, S3_PART_SIZE,
+                       S3_TRANSFER_CONCURRENCY, S3_STREAM_CHUNK_SIZE,
+                       S3_SYNC_WORKERS, EC2_DEFAULT_REGION)
 from .utils import output, get_absolute_path
 
 
-s3_conn = S3Connection()
+# The bucket is the same whatever region the EC2 commands run in
+s3_conn = connections.get("s3", EC2_DEFAULT_REGION)
 
 
 def create_bucket():
@@ -19,15 +28,366 @@ def get_bucket():
     bucket = s3_conn.lookup(S3_DEFAULT_BUCKET)
     if bucket:
         return bucket
-    return create_bucket(name)
+    return create_bucket()
+
+
+# Suffixes of the local files of transfers in progress, kept next to the
+# files transferred: checkpoints (and their temporary files) and partial
+# downloads
+TRANSFER_SUFFIXES = (".s3upload", ".s3upload.tmp", ".s3download",
+                     ".s3download.tmp", ".s3part")
+
+
+class TransferCheckpoint(object):
+    """
+    Local record of the parts of an interrupted transfer already moved
+    * Stored as JSON next to the local file, rewritten atomically after each
+      part so that a crash loses at most the parts in flight
+    """
+
+    def __init__(self, path, identity):
+        self.path = path
+        self.identity = identity
+        self.state = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Return True if a checkpoint of the same transfer exists"""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except ValueError:
+            return False
+        if state.get("identity") != self.identity:
+            return False
+        self.state = state
+        return True
+
+    def start(self, **state):
+        self.state = dict(state, identity=self.identity, parts=[])
+        self._save()
+
+    @property
+    def parts(self):
+        return set(self.state.get("parts", []))
+
+    def part_done(self, part_num):
+        with self._lock:
+            self.state["parts"].append(part_num)
+            self._save()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.rename(tmp, self.path)
+
+
+def _thread_bucket(bucket):
+    """
+    `bucket' on the S3 client bound to the calling thread, so that part
+    workers send their requests through pooled clients of their own rather
+    than the client `bucket' was looked up with
+    """
+    return s3_conn.get_bucket(bucket.name, validate=False)
+
+
+def _split(size, part_size):
+    """Return (part number, offset, length) of each part of `size' bytes"""
+    parts = []
+    for i, offset in enumerate(range(0, size, part_size)):
+        parts.append((i + 1, offset, min(part_size, size - offset)))
+    return parts
+
+
+def _check_parts(results, action):
+    failed = [result for result in results if not result.ok]
+    if failed:
+        msg = "%d part(s) failed to %s (first error: %s). Run again to " \
+            "resume." % (len(failed), action, failed[0].error)
+        raise IOError(msg)
+
+
+def upload_file(bucket, key, filename, part_size=S3_PART_SIZE,
+                concurrency=S3_TRANSFER_CONCURRENCY):
+    """
+    Upload a file to `key'
+    * Files larger than `part_size' are sent as a multipart upload with
+      `concurrency' parts in flight
+    * An interrupted multipart upload is resumed from its local checkpoint
+    """
+    stat = os.stat(filename)
+    if stat.st_size <= part_size:
+        k = bucket.new_key(key)
+        k.set_contents_from_filename(filename)
+        return
+
+    identity = [bucket.name, key, stat.st_size, int(stat.st_mtime), part_size]
+    checkpoint = TransferCheckpoint(filename + ".s3upload", identity)
+    mp = None
+    if checkpoint.load():
+        upload_id = checkpoint.state["upload_id"]
+        for upload in bucket.list_multipart_uploads():
+            if upload.id == upload_id and upload.key_name == key:
+                mp = upload
+                output.debug("Resuming upload of %s (%d parts done)..." %
+                             (filename, len(checkpoint.parts)))
+                break
+    if mp is None:
+        mp = bucket.initiate_multipart_upload(key)
+        checkpoint.start(upload_id=mp.id)
+
+    def upload_part(part):
+        part_num, offset, length = part
+        upload = mp.__class__(_thread_bucket(bucket))
+        upload.key_name, upload.id = mp.key_name, mp.id
+        with open(filename, "rb") as fp:
+            fp.seek(offset)
+            upload.upload_part_from_file(fp, part_num, size=length)
+        checkpoint.part_done(part_num)
+
+    done = checkpoint.parts
+    parts = [part for part in _split(stat.st_size, part_size)
+             if part[0] not in done]
+    _check_parts(run_parallel(upload_part, parts, concurrency), "upload")
+    mp.complete_upload()
+    checkpoint.remove()
+
+
+def download_file(bucket, key, filename, part_size=S3_PART_SIZE,
+                  concurrency=S3_TRANSFER_CONCURRENCY):
+    """
+    Download `key' to a file
+    * Objects larger than `part_size' are fetched with concurrent ranged GETs
+      written into a preallocated temporary file, renamed when complete
+    * An interrupted download is resumed from its local checkpoint
+    """
+    k = bucket.get_key(key)
+    if not k:
+        return False
+    if k.size <= part_size:
+        k.get_contents_to_filename(filename)
+        return True
+
+    tmp = filename + ".s3part"
+    identity = [bucket.name, key, k.etag, k.size, part_size]
+    checkpoint = TransferCheckpoint(filename + ".s3download", identity)
+    if not (checkpoint.load() and os.path.exists(tmp)):
+        with open(tmp, "wb") as fp:
+            fp.truncate(k.size)
+        checkpoint.start()
+    else:
+        output.debug("Resuming download of %s (%d parts done)..." %
+                     (key, len(checkpoint.parts)))
+
+    def download_part(part):
+        part_num, offset, length = part
+        headers = {"Range": "bytes=%d-%d" % (offset, offset + length - 1)}
+        with open(tmp, "r+b") as fp:
+            fp.seek(offset)
+            _thread_bucket(bucket).new_key(key).get_contents_to_file(
+                fp, headers=headers)
+            if fp.tell() != offset + length:
+                raise IOError("Short read of part %d of '%s'" %
+                              (part_num, key))
+        checkpoint.part_done(part_num)
+
+    done = checkpoint.parts
+    parts = [part for part in _split(k.size, part_size)
+             if part[0] not in done]
+    _check_parts(run_parallel(download_part, parts, concurrency), "download")
+    os.rename(tmp, filename)
+    checkpoint.remove()
+    return True
+
+
+def _etag(filename, part_size=S3_PART_SIZE):
+    """
+    ETag S3 gives an object uploaded from `filename' by upload_file(): the
+    MD5 of the file, or the MD5 of the MD5s of its parts if it is larger
+    than `part_size'
+    """
+    hashes = []
+    with open(filename, "rb") as f:
+        while True:
+            part = f.read(part_size)
+            if not part:
+                break
+            hashes.append(hashlib.md5(part))
+    if len(hashes) <= 1:
+        return (hashes[0] if hashes else hashlib.md5()).hexdigest()
+    digests = "".join(h.digest() for h in hashes)
+    return "%s-%d" % (hashlib.md5(digests).hexdigest(), len(hashes))
+
+
+def _timestamp(last_modified):
+    """Parse the Last-Modified of a key (RFC 1123, or ISO 8601 in listings)"""
+    parsed = email.utils.parsedate_tz(last_modified)
+    if parsed:
+        return email.utils.mktime_tz(parsed)
+    return calendar.timegm(time.strptime(last_modified[:19],
+                                         "%Y-%m-%dT%H:%M:%S"))
+
+
+def _is_unchanged(filename, key):
+    """
+    Compare a local file to a key of a listing
+    * Different sizes mean a change. Otherwise the checksums are compared,
+      unless the file has the modification time of the object (set when it
+      was downloaded): an older file may still have been changed, e.g.
+      restored from a backup or copied with its time
+    """
+    stat = os.stat(filename)
+    if stat.st_size != key.size:
+        return False
+    if abs(stat.st_mtime - _timestamp(key.last_modified)) < 1:
+        return True
+    return _etag(filename) == key.etag.strip('"')
+
+
+def _list_keys(bucket, prefix=""):
+    """List the keys under `prefix' once; return a mapping of names to keys"""
+    return dict((k.name, k) for k in bucket.list(prefix=prefix)
+                if not k.name.endswith("/"))
+
+
+def _list_files(directory):
+    """Return a mapping of the paths of the files under `directory', relative
+    to it and with "/" separators, to their local paths"""
+    files = {}
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            # Left by interrupted transfers
+            if name.endswith(TRANSFER_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, directory)
+            files[relpath.replace(os.sep, "/")] = path
+    return files
+
+
+def _local_path(directory, relname):
+    """
+    Local path of the key `relname' (relative to the synchronized prefix)
+    under `directory', or None if it resolves outside of it, e.g. "../x"
+    """
+    directory = os.path.abspath(directory)
+    path = os.path.normpath(os.path.join(directory, *relname.split("/")))
+    if not path.startswith(os.path.join(directory, "")):
+        return None
+    return path
+
+
+def transfer_files(bucket, transfers, workers=S3_SYNC_WORKERS, remote=None):
+    """
+    Run a batch of uploads and downloads, skipping unchanged files
+    * `transfers' is a list of ("put", filename, key) and
+      ("get", key, filename) tuples
+    * `remote' maps key names to the keys of a listing; by default the keys
+      are listed once, under their common prefix
+    * Changed files are transferred on up to `workers' threads
+    * Return a list of TaskResult of the transfers made, and the number of
+      unchanged files skipped
+    """
+    if remote is None:
+        keys = [t[2] if t[0] == "put" else t[1] for t in transfers]
+        remote = _list_keys(bucket, os.path.commonprefix(keys)) if keys else {}
+
+    changed = []
+    for transfer in transfers:
+        action, source, target = transfer
+        if action == "put":
+            key = remote.get(target)
+            if key and _is_unchanged(source, key):
+                continue
+        else:
+            key = remote.get(source)
+            if (key and os.path.exists(target) and
+                    _is_unchanged(target, key)):
+                continue
+        changed.append(transfer)
+
+    def transfer(item):
+        action, source, target = item
+        if action == "put":
+            upload_file(bucket, target, source)
+            return
+        if source not in remote:
+            raise IOError("Key '%s' does not exist in bucket '%s'" %
+                          (source, bucket.name))
+        directory = os.path.dirname(target)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        download_file(bucket, source, target)
+        # Downloaded files take the time of their object, so that the next
+        # sync knows them unchanged without computing their checksums
+        mtime = _timestamp(remote[source].last_modified)
+        os.utime(target, (mtime, mtime))
+
+    results = run_parallel(transfer, changed, workers)
+    return results, len(transfers) - len(changed)
+
+
+def sync_directory(bucket, directory, prefix="", upload=True,
+                   workers=S3_SYNC_WORKERS):
+    """
+    Synchronize a local directory and the keys under `prefix', in the
+    direction of `upload'; see transfer_files()
+    """
+    remote = _list_keys(bucket, prefix)
+    if upload:
+        transfers = [("put", path, prefix + relpath) for relpath, path
+                     in sorted(_list_files(directory).items())]
+    else:
+        transfers = []
+        for name in sorted(remote):
+            path = _local_path(directory, name[len(prefix):])
+            if path is None:
+                output.warning("Skipping key '%s': it is outside of %s." %
+                               (name, directory))
+                continue
+            transfers.append(("get", name, path))
+    return transfer_files(bucket, transfers, workers, remote)
+
+
+def read_manifest(path):
+    """
+    Read a manifest of transfers: one "put FILE KEY" or "get KEY FILE" per
+    line; blank lines and lines starting with # are ignored
+    """
+    transfers = []
+    with open(path) as f:
+        for num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) != 3 or fields[0] not in ("put", "get"):
+                raise ValueError("Invalid line %d of manifest %s: '%s'" %
+                                 (num, path, line))
+            action, source, target = fields
+            if action == "put":
+                source = get_absolute_path(source)
+            else:
+                target = get_absolute_path(target)
+            transfers.append((action, source, target))
+    return transfers
 
 
 def store_object(key, filename):
     bucket = get_bucket()
-    k = Key(bucket)
-    k.key = key
     f = get_absolute_path(filename)
-    k.set_contents_from_filename(f)
+    upload_file(bucket, key, f)
     msg = "File %s has been stored with key '%s' to bucket '%s'." %(filename,
                                                                 key,
                                                                 bucket.name)
@@ -36,27 +396,84 @@ def store_object(key, filename):
 
 def get_object(key, filename):
     bucket = get_bucket()
-    k = bucket.get_key(key)
-    if not k:
+    f = get_absolute_path(filename)
+    if not download_file(bucket, key, f):
         msg = "Key '%s' does not exist in bucket '%s'." % (key, bucket.name)
         output.error(msg)
         sys.exit(1)
-    f = get_absolute_path(filename)
-    k.get_contents_to_filename(f)
     fmsg = ("Object with key '%s' has been stored to"
             " %s from bucket '%s'.")
     msg = fmsg % (key, filename, bucket.name)
     output.success(msg)
 
 
-def print_object(key):
-    bucket = get_bucket()
+def stream_object(bucket, key, out, start=None, end=None,
+                  chunk_size=S3_STREAM_CHUNK_SIZE):
+    """
+    Write the bytes `start' to `end' (inclusive) of `key' to file `out'
+    * Without `start', `end' is a number of bytes to read from the end of
+      the object; without both, the whole object is read
+    * Only the requested range is fetched, and held `chunk_size' bytes at a
+      time
+    * Return the number of bytes written, or None if `key' does not exist
+    """
     k = bucket.get_key(key)
     if not k:
+        return None
+    last = k.size - 1
+    if start is None and end is not None:
+        start, end = max(k.size - end, 0), last
+    else:
+        start = start or 0
+        end = last if end is None else min(end, last)
+    if start > end:
+        return 0
+    headers = None
+    if (start, end) != (0, last):
+        headers = {"Range": "bytes=%d-%d" % (start, end)}
+    written = 0
+    k.open_read(headers=headers)
+    try:
+        while True:
+            chunk = k.read(chunk_size)
+            if not chunk:
+                break
+            out.write(chunk)
+            written += len(chunk)
+    except:
+        # A plain close() reads the rest of the object first
+        k.close(fast=True)
+        raise
+    k.close()
+    return written
+
+
+def parse_range(spec):
+    """
+    Parse a byte range given as `start-end', `start-' or `-count' (the last
+    `count' bytes) into a (start, end) tuple for stream_object()
+    """
+    spec = spec.strip()
+    if not spec:
+        return None, None
+    start, sep, end = spec.partition("-")
+    if not sep or not (start or end):
+        raise ValueError("Invalid byte range: '%s'" % spec)
+    start = int(start) if start else None
+    end = int(end) if end else None
+    if start is not None and end is not None and start > end:
+        raise ValueError("Invalid byte range: '%s'" % spec)
+    return start, end
+
+
+def print_object(key, start=None, end=None):
+    bucket = get_bucket()
+    written = stream_object(bucket, key, sys.stdout, start, end)
+    if written is None:
         msg = "Key '%s' does not exist in bucket '%s'." % (key, bucket.name)
         output.error(msg)
         sys.exit(1)
-    print k.get_contents_as_string()
+    sys.stdout.flush()
 
 
 def s3_init():
@@ -92,4 +509,43 @@ def s3_get():
 def s3_print():
     print "Key name: "
     key = raw_input()
-    print_object(key)
+    print "Byte range (start-end, or -N for the last N bytes; empty for all): "
+    try:
+        start, end = parse_range(raw_input())
+    except ValueError as e:
+        output.error(str(e))
+        sys.exit(1)
+    print_object(key, start, end)
+
+
+def s3_sync(manifest=None):
+    """
+    Run the transfers of `manifest' if given, else ask for a directory to
+    synchronize with a key prefix
+    """
+    bucket = get_bucket()
+    if manifest:
+        transfers = read_manifest(manifest)
+        results, skipped = transfer_files(bucket, transfers)
+    else:
+        print "Direction (put|get): "
+        direction = raw_input().strip()
+        if direction not in ("put", "get"):
+            output.error("Invalid direction: '%s'" % direction)
+            sys.exit(1)
+        print "Local directory: "
+        directory = get_absolute_path(raw_input().strip())
+        print "Key prefix (empty for the whole bucket): "
+        prefix = raw_input().strip()
+        results, skipped = sync_directory(bucket, directory, prefix,
+                                          direction == "put")
+    failed = [result for result in results if not result.ok]
+    for result in failed:
+        action, source, target = result.item
+        output.error("Could not %s %s: %s" % (action, source, result.error))
+    msg = "%d file(s) transferred, %d unchanged file(s) skipped." % (
+        len(results) - len(failed), skipped)
+    if failed:
+        output.error(msg)
+        sys.exit(1)
+    output.success(msg)
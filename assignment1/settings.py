@@ -7,6 +7,8 @@ import os
 
 PROJECT_PATH = os.path.realpath(os.path.dirname(__file__))
 DB_PATH = os.path.abspath(os.path.join(PROJECT_PATH, os.pardir, "db"))
+DB_STATE_FILE = os.path.join(DB_PATH, "state.db")
+# Legacy CSV files, imported into DB_STATE_FILE on first use
 DB_FILES = {
     "addresses": os.path.join(DB_PATH, "addresses"),
     "snapshots": os.path.join(DB_PATH, "snapshots"),
@@ -17,8 +19,6 @@ EC2_DEFAULT_EBS_AZ = "us-east-1b"
 EC2_DEFAULT_EBS_SIZE = 2
 EC2_DEFAULT_INSTANCE_TYPE = "t1.micro"
 EC2_DEFAULT_IMAGE_ID = "ami-76f0061f"
-EC2_DEFAULT_INSTANCE_NUM = 2
-EC2_DEFAULT_TAG_NAMES = ["VM1", "VM2"]
 EC2_DEFAULT_SG_NAME = "assignment1"
 EC2_DEFAULT_SG_DESC = "security group for assignment1"
 EC2_DEFAULT_SG_TCP_PORTS = [22, 80]
@@ -27,16 +27,166 @@ EC2_DEFAULT_KEY_PATH = "~"
 EC2_DEFAULT_WAIT_INTERVAL = 5
 EC2_DEFAULT_DATA_DEVICE = "/dev/sdf"
 
+# Maximum number of snapshot copies in progress at once; AWS limits the
+# concurrent copies to a destination region
+EC2_SNAPSHOT_COPY_CONCURRENCY = 20
+
+# Default fleet: groups of virtual machines (see fleet.Group), overridden
+# with `run.py --fleet FILE'
+EC2_DEFAULT_FLEET = [
+    {"name": "VM%d", "count": 2, "instance_type": EC2_DEFAULT_INSTANCE_TYPE},
+]
+
+# Maximum number of instances processed concurrently by init/store/restore
+EC2_DEFAULT_WORKERS = 32
+
+# Maximum number of resources tagged by one CreateTags call
+EC2_TAG_BATCH_SIZE = 500
+
+# How store puts instances away:
+# * "snapshot": snapshot the data volume, create an AMI and terminate
+# * "stop": stop the instance (EBS-backed only), keeping its volumes and
+#   address; restore starts it again in a single batched call
+# A fleet group can set its own (see fleet.py); run.py --strategy overrides
+STORE_STRATEGIES = ("snapshot", "stop")
+EC2_DEFAULT_STORE_STRATEGY = "snapshot"
+
+# Maximum number of instances stopped or started by one call
+EC2_START_STOP_BATCH_SIZE = 500
+
+# Typical duration (seconds) of the tasks of a plan by kind, including their
+# waits, used to estimate the critical path with `run.py --plan'
+PLAN_ESTIMATES = {
+    "setup": 1,
+    "launch": 60,
+    "volume": 10,
+    "attach": 5,
+    "tag": 1,
+    "address": 1,
+    "detach": 10,
+    "snapshot": 1,
+    "deregister": 1,
+    "image": 240,
+    "terminate": 30,
+    "record": 2,
+    "stop": 60,
+    "start": 60,
+}
+
+# Idle clients kept per (service, region) for reuse by worker threads; their
+# HTTP connections stay open between requests
+AWS_CONNECTION_POOL_SIZE = int(os.environ.get("AWS_CONNECTION_POOL_SIZE", 16))
+
+# Waiters: initial and maximum poll interval (seconds), per-operation deadline
+# (seconds) for each resource kind, and maximum ids per describe call
+EC2_WAITER_DELAY = 2
+EC2_WAITER_MAX_DELAY = 30
+EC2_WAITER_TIMEOUTS = {
+    "instance": 600,
+    "volume": 600,
+    "image": 3600,
+    "snapshot": 3600,
+}
+EC2_WAITER_BATCH_SIZE = 200
+
+# Instances per page of describe results (5 to 1000)
+EC2_DESCRIBE_PAGE_SIZE = 100
+
+# Seconds a describe call result is served from the per-run cache
+EC2_CACHE_TTL = 60
+
 # Hour (24-hour) after which all instances will be labeled `idle'
 EC2_INSTANCE_IDLE_TIME = 19
 
 # CPU utilization (percent) where an instance will be labeled `idle'
 EC2_INSTANCE_IDLE_CPU = 50
 
+# Idle detection: instance metrics kept in the local history (name and
+# CloudWatch statistic), seconds per sample, and samples kept per metric
+IDLE_METRICS = {
+    "CPUUtilization": "Average",
+    "NetworkIn": "Sum",
+    "NetworkOut": "Sum",
+    "DiskReadOps": "Sum",
+    "DiskWriteOps": "Sum",
+}
+IDLE_SAMPLE_PERIOD = 60
+IDLE_HISTORY_SIZE = 180
+
+# An instance is idle when every rule holds: the `percentile' of the
+# samples of `metric' over the last `minutes' is below `threshold'. Rules
+# are only evaluated if at least IDLE_MIN_COVERAGE of the samples exist.
+# The 90th percentile of 10 samples ignores the busiest minute.
+IDLE_RULES = [
+    {"metric": "CPUUtilization", "percentile": 90,
+     "threshold": EC2_INSTANCE_IDLE_CPU, "minutes": 10},
+]
+IDLE_MIN_COVERAGE = 0.5
+
+# Prewarm: stored virtual machines are restored ahead of the time they are
+# usually needed, learnt from their history of the last PREWARM_HISTORY_DAYS
+# days. A VM is needed on a day from the first time it is restored by hand
+# or seen busy by the daemon. It is expected today if it was needed on at
+# least PREWARM_MIN_DAYS, and PREWARM_MIN_USE, of the past days of the same
+# kind (weekdays or weekends), at the PREWARM_NEED_PERCENTILE of its need
+# times of these days. Its restore starts ahead of that by the
+# PREWARM_DURATION_PERCENTILE of its restore durations plus PREWARM_MARGIN
+# seconds.
+PREWARM_HISTORY_DAYS = 28
+PREWARM_MIN_DAYS = 3
+PREWARM_MIN_USE = 0.5
+PREWARM_NEED_PERCENTILE = 20
+PREWARM_DURATION_PERCENTILE = 90
+PREWARM_MARGIN = 600
+
+# Seconds a prewarmed VM is kept from being stored by the daemon, idle or
+# not, so that it is still running when its users arrive
+PREWARM_HOLD = 3600
+
+# Maximum number of concurrent CloudWatch requests
+CW_DEFAULT_WORKERS = 16
+
+# Period (seconds) of EBS volume metrics in CloudWatch
+CW_EBS_PERIOD = 300
+
+# Seconds to wait for the EBS volume metrics of a detached volume to cover
+# its detach time, as they are reported minutes after each period ends, and
+# seconds between two requests meanwhile
+CW_EBS_COVERAGE_WAIT = 900
+CW_EBS_POLL_INTERVAL = 60
+
+# Daemon: seconds between evaluations of the fleet, maximum number of
+# instances stored at once, and local address of the health and metrics
+# endpoint
+DAEMON_POLL_INTERVAL = 60
+DAEMON_WORKERS = 8
+DAEMON_HTTP_ADDRESS = ("127.0.0.1",
+                       int(os.environ.get("DAEMON_HTTP_PORT", 8642)))
+
 # Autoscale config
 AS_DEFAULT_MIN_SIZE = 1
 AS_DEFAULT_MAX_SIZE = 3
 AS_DEFAULT_CPU_UP = "80"
 AS_DEFAULT_CPU_DOWN = "20"
 
+# Number of times an Autoscale group that could not be set up or deleted
+# is retried
+AS_RETRIES = 3
+
 S3_DEFAULT_BUCKET = "sa2648-assignment1"
+
+# Endpoint of an S3-compatible service to use instead of Amazon S3
+# (e.g. a local stand-in for testing), set as "host:port"
+S3_ENDPOINT = os.environ.get("S3_ENDPOINT")
+S3_IS_SECURE = os.environ.get("S3_IS_SECURE", "1") == "1"
+
+# Transfers of files larger than a part are split into parts of this size
+# (bytes, at least 5 MB for multipart uploads) and moved concurrently
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_TRANSFER_CONCURRENCY = 4
+
+# Size of the chunks objects are printed in by s3-print
+S3_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of files transferred at once by s3-sync
+S3_SYNC_WORKERS = 8
@@ -14,7 +14,7 @@ def initialize_security_group(conn):
 
 
 def get_security_group(conn, name=EC2_DEFAULT_SG_NAME):
-    sgs = conn.get_all_security_groups()
+    sgs = conn.get_all_security_groups(filters={"group-name": name})
     for sg in sgs:
         if name == sg.name:
             return sg
@@ -0,0 +1,1117 @@
+# In-memory simulation of the AWS services used by this package
+# * Fake EC2, CloudWatch, Autoscale and S3 connections implement the subset
+#   of the boto API this package calls, and count every call
+# * Resources move through their states (pending -> running, creating ->
+#   available, ...) after configurable latencies measured on a virtual
+#   clock, so waits cost no real time
+# * Each region has EC2, CloudWatch and Autoscale resources of its own; the
+#   fake connections follow the region of the calling thread (see
+#   regions.py)
+import calendar
+import contextlib
+import datetime
+import hashlib
+import heapq
+import itertools
+import threading
+from email.utils import formatdate
+
+from boto.exception import BotoServerError, EC2ResponseError
+
+from . import clock, regions
+
+
+# Seconds (of virtual time) each state transition takes
+DEFAULT_LATENCIES = {
+    "instance_boot": 60,
+    "instance_terminate": 30,
+    "instance_stop": 30,
+    "instance_start": 40,
+    "volume_create": 10,
+    "volume_attach": 5,
+    "volume_detach": 10,
+    "snapshot": 120,
+    "snapshot_copy": 180,
+    "image": 240,
+}
+
+DEFAULT_CPU_UTILIZATION = 5.0
+
+ERROR_XML = ("<Response><Errors><Error><Code>%s</Code><Message>%s</Message>"
+             "</Error></Errors></Response>")
+
+
+class VirtualClock(object):
+    """
+    Discrete-event clock shared by the threads of a simulation
+    * sleep() does not block for real: time jumps forward to the earliest
+      wake-up as soon as every participating thread is asleep or blocked
+    * Participating threads are the installing thread and threads started
+      through clock.start_thread()
+    """
+
+    def __init__(self, start=0.0):
+        self._now = start
+        self._running = 1  # The installing thread
+        self._sleepers = []  # Heap of (wake-up time, sequence, token)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        with self._cond:
+            token = [False]
+            wake = self._now + max(seconds, 0)
+            heapq.heappush(self._sleepers, (wake, next(self._seq), token))
+            self._running -= 1
+            self._advance()
+            while not token[0]:
+                self._cond.wait()
+
+    def start_thread(self, thread):
+        with self._cond:
+            self._running += 1
+        thread.start()
+
+    def thread_done(self):
+        with self._cond:
+            self._running -= 1
+            self._advance()
+
+    @contextlib.contextmanager
+    def blocked(self):
+        with self._cond:
+            self._running -= 1
+            self._advance()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running += 1
+
+    def _advance(self):
+        """Wake the earliest sleepers once no thread is runnable"""
+        if self._running > 0 or not self._sleepers:
+            return
+        self._now = max(self._now, self._sleepers[0][0])
+        while self._sleepers and self._sleepers[0][0] <= self._now:
+            token = heapq.heappop(self._sleepers)[2]
+            token[0] = True
+            self._running += 1
+        self._cond.notify_all()
+
+
+def ec2_error(code, message=""):
+    return EC2ResponseError(400, "Bad Request", ERROR_XML % (code, message))
+
+
+class ResultSet(list):
+    next_token = None
+
+
+class _Obj(object):
+    """Plain attribute holder"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Resource(object):
+    """A simulated resource whose state follows a timeline"""
+
+    state_attr = "state"
+
+    def __init__(self, sim, id, state):
+        self.sim = sim
+        self.id = id
+        self.tags = {}
+        self._timeline = [(sim.now(), state)]
+
+    def _current(self):
+        now = self.sim.now()
+        state = self._timeline[0][1]
+        for t, s in self._timeline:
+            if t <= now:
+                state = s
+        return state
+
+    def transition(self, state, after=None, then=None):
+        """Enter `state' now, and `then' after `after' seconds"""
+        now = self.sim.now()
+        self._timeline = [(now, state)]
+        if then is not None:
+            self._timeline.append((now + self.sim.latencies[after], then))
+
+    def __getattr__(self, name):
+        if name == self.state_attr:
+            return self._current()
+        raise AttributeError(name)
+
+
+class FakeInstance(Resource):
+
+    def __init__(self, sim, id, image_id, instance_type, placement):
+        Resource.__init__(self, sim, id, "pending")
+        self.image_id = image_id
+        self.instance_type = instance_type
+        self.placement = placement
+        self.ip_address = None
+        self.root_device_type = "ebs"
+        self.block_device_mapping = {}
+
+    def update(self):
+        return self.sim.ec2.get_only_instances([self.id])[0].state
+
+
+class FakeVolume(Resource):
+    state_attr = "status"
+
+    def __init__(self, sim, id, size, zone, snapshot_id=None):
+        Resource.__init__(self, sim, id, "creating")
+        self.size = size
+        self.zone = zone
+        self.snapshot_id = snapshot_id
+        self.attach_data = _Obj(instance_id=None, device=None,
+                                attach_time=None)
+
+    def update(self):
+        return self.sim.ec2.get_all_volumes([self.id])[0].status
+
+
+class FakeSnapshot(Resource):
+    state_attr = "status"
+
+    def __init__(self, sim, id, volume_id, volume_size):
+        Resource.__init__(self, sim, id, "pending")
+        self.volume_id = volume_id
+        self.volume_size = volume_size
+
+    def update(self):
+        return self.sim.ec2.get_all_snapshots([self.id])[0].status
+
+
+class FakeImage(Resource):
+
+    def __init__(self, sim, id, name, owner="self", root_snapshot_id=None):
+        Resource.__init__(self, sim, id, "pending")
+        self.name = name
+        self.owner = owner
+        self.block_device_mapping = {
+            "/dev/sda1": _Obj(snapshot_id=root_snapshot_id)}
+
+    def update(self):
+        return self.sim.ec2.get_all_images([self.id])[0].state
+
+
+def api(func):
+    """Count calls of a fake API method"""
+    def call(self, *args, **kwargs):
+        self.sim.count(self.service, func.__name__)
+        return func(self, *args, **kwargs)
+    call.__name__ = func.__name__
+    call.__doc__ = func.__doc__
+    return call
+
+
+class FakeEC2Connection(object):
+    service = "ec2"
+
+    def __init__(self, sim, region="us-east-1"):
+        self.sim = sim
+        self.region = _Obj(name=region)
+        self.instances = {}
+        self.volumes = {}
+        self.snapshots = {}
+        self.copies = []  # Ids of the snapshots created by copy_snapshot
+        self.images = {}
+        self.addresses = {}
+        self.security_groups = {}
+        self.key_pairs = {}
+        self._lock = threading.RLock()
+
+    def _find(self, kind, collection, ids, code):
+        if ids is None:
+            return ResultSet(collection.values())
+        missing = [i for i in ids if i not in collection]
+        if missing:
+            raise ec2_error(code, "The %s ID '%s' does not exist" %
+                            (kind, missing[0]))
+        return ResultSet(collection[i] for i in ids)
+
+    # Instances
+
+    @api
+    def run_instances(self, image_id, min_count=1, max_count=1,
+                      security_groups=None, key_name=None,
+                      instance_type="m1.small", placement=None, **kwargs):
+        return self.launch(image_id, max_count, instance_type, placement)
+
+    def launch(self, image_id, count, instance_type="m1.small",
+               placement=None):
+        """Launch instances without counting an API call"""
+        with self._lock:
+            if image_id not in self.images:
+                raise ec2_error("InvalidAMIID.NotFound", image_id)
+            instances = []
+            for _ in range(count):
+                instance = FakeInstance(self.sim, self.sim.new_id("i"),
+                                        image_id, instance_type, placement)
+                instance.transition("pending", "instance_boot", "running")
+                instance.block_device_mapping["/dev/sda1"] = _Obj(
+                    volume_id=self.sim.new_id("vol"))
+                self.instances[instance.id] = instance
+                instances.append(instance)
+            return _Obj(id=self.sim.new_id("r"), instances=instances)
+
+    @api
+    def get_only_instances(self, instance_ids=None, filters=None, **kwargs):
+        with self._lock:
+            instances = self._find("instance", self.instances, instance_ids,
+                                   "InvalidInstanceID.NotFound")
+            return ResultSet(i for i in instances
+                             if _matches(i, filters or {}))
+
+    @api
+    def get_all_reservations(self, instance_ids=None, filters=None,
+                             max_results=None, next_token=None, **kwargs):
+        """One reservation per instance, `max_results' instances per page"""
+        with self._lock:
+            if instance_ids and max_results:
+                raise ec2_error("InvalidParameterCombination",
+                                "The parameter instancesSet cannot be used "
+                                "with the parameter maxResults")
+            instances = self._find("instance", self.instances, instance_ids,
+                                   "InvalidInstanceID.NotFound")
+            instances = sorted((i for i in instances
+                                if _matches(i, filters or {})),
+                               key=lambda i: i.id)
+            start = int(next_token or 0)
+            end = start + max_results if max_results else len(instances)
+            page = ResultSet(_Obj(id="r-" + i.id[2:], instances=[i])
+                             for i in instances[start:end])
+            if end < len(instances):
+                page.next_token = str(end)
+            return page
+
+    @api
+    def terminate_instances(self, instance_ids):
+        return self.terminate(instance_ids)
+
+    def terminate(self, instance_ids):
+        """Terminate instances without counting an API call"""
+        with self._lock:
+            for instance in self._find("instance", self.instances,
+                                       instance_ids,
+                                       "InvalidInstanceID.NotFound"):
+                if instance.state in ("shutting-down", "terminated"):
+                    continue
+                instance.transition("shutting-down", "instance_terminate",
+                                    "terminated")
+                for address in self.addresses.values():
+                    if address.instance_id == instance.id:
+                        address.instance_id = None
+                instance.ip_address = None
+                for device, bdt in instance.block_device_mapping.items():
+                    volume = self.volumes.get(bdt.volume_id)
+                    if volume:
+                        self._detach(volume)
+                instance.block_device_mapping = {}
+            return instance_ids
+
+    @api
+    def stop_instances(self, instance_ids):
+        """Stop instances; their volumes and addresses are kept (as in VPC)"""
+        with self._lock:
+            instances = self._find("instance", self.instances, instance_ids,
+                                   "InvalidInstanceID.NotFound")
+            for instance in instances:
+                if instance.state in ("stopping", "stopped"):
+                    continue
+                if instance.state != "running":
+                    raise ec2_error("IncorrectInstanceState", instance.id)
+                instance.transition("stopping", "instance_stop", "stopped")
+            return instances
+
+    @api
+    def start_instances(self, instance_ids):
+        with self._lock:
+            instances = self._find("instance", self.instances, instance_ids,
+                                   "InvalidInstanceID.NotFound")
+            for instance in instances:
+                if instance.state in ("pending", "running"):
+                    continue
+                if instance.state != "stopped":
+                    raise ec2_error("IncorrectInstanceState", instance.id)
+                instance.transition("pending", "instance_start", "running")
+            return instances
+
+    @api
+    def create_tags(self, resource_ids, tags):
+        with self._lock:
+            for rid in resource_ids:
+                for collection in (self.instances, self.volumes,
+                                   self.snapshots, self.images):
+                    if rid in collection:
+                        collection[rid].tags.update(tags)
+                        break
+                else:
+                    raise ec2_error("InvalidID", rid)
+            return True
+
+    # Volumes
+
+    @api
+    def create_volume(self, size, zone, snapshot=None, **kwargs):
+        with self._lock:
+            if snapshot is not None:
+                if snapshot not in self.snapshots:
+                    raise ec2_error("InvalidSnapshot.NotFound", snapshot)
+                if self.snapshots[snapshot].status != "completed":
+                    raise ec2_error("IncorrectState", snapshot)
+                size = size or self.snapshots[snapshot].volume_size
+            volume = FakeVolume(self.sim, self.sim.new_id("vol"), size, zone,
+                                snapshot)
+            volume.transition("creating", "volume_create", "available")
+            self.volumes[volume.id] = volume
+            return volume
+
+    @api
+    def get_all_volumes(self, volume_ids=None, filters=None):
+        with self._lock:
+            return self._find("volume", self.volumes, volume_ids,
+                              "InvalidVolume.NotFound")
+
+    @api
+    def attach_volume(self, volume_id, instance_id, device):
+        with self._lock:
+            volume = self._find("volume", self.volumes, [volume_id],
+                                "InvalidVolume.NotFound")[0]
+            instance = self._find("instance", self.instances, [instance_id],
+                                  "InvalidInstanceID.NotFound")[0]
+            if volume.status != "available" or instance.state != "running":
+                raise ec2_error("IncorrectState", volume_id)
+            volume.transition("attaching", "volume_attach", "in-use")
+            volume.attach_data = _Obj(
+                instance_id=instance_id, device=device,
+                attach_time=_iso(self.sim.now()))
+            instance.block_device_mapping[device] = _Obj(volume_id=volume_id)
+            return True
+
+    @api
+    def detach_volume(self, volume_id, instance_id=None, device=None,
+                      force=False):
+        with self._lock:
+            volume = self._find("volume", self.volumes, [volume_id],
+                                "InvalidVolume.NotFound")[0]
+            if volume.status != "in-use":
+                raise ec2_error("IncorrectState", volume_id)
+            self._detach(volume)
+            return True
+
+    def _detach(self, volume):
+        instance = self.instances.get(volume.attach_data.instance_id)
+        if instance:
+            instance.block_device_mapping.pop(volume.attach_data.device, None)
+        volume.attach_data = _Obj(instance_id=None, device=None,
+                                  attach_time=None)
+        volume.transition("in-use", "volume_detach", "available")
+
+    @api
+    def delete_volume(self, volume_id):
+        with self._lock:
+            volume = self._find("volume", self.volumes, [volume_id],
+                                "InvalidVolume.NotFound")[0]
+            if volume.status != "available":
+                raise ec2_error("VolumeInUse", volume_id)
+            del self.volumes[volume_id]
+            return True
+
+    # Snapshots
+
+    @api
+    def create_snapshot(self, volume_id, description=None):
+        with self._lock:
+            volume = self._find("volume", self.volumes, [volume_id],
+                                "InvalidVolume.NotFound")[0]
+            snapshot = FakeSnapshot(self.sim, self.sim.new_id("snap"),
+                                    volume_id, volume.size)
+            snapshot.transition("pending", "snapshot", "completed")
+            self.snapshots[snapshot.id] = snapshot
+            return snapshot
+
+    @api
+    def copy_snapshot(self, source_region, source_snapshot_id,
+                      description=None):
+        with self._lock:
+            source = self._find("snapshot", self.snapshots,
+                                [source_snapshot_id],
+                                "InvalidSnapshot.NotFound")[0]
+            if source.status != "completed":
+                raise ec2_error("IncorrectState", source_snapshot_id)
+            copying = [i for i in self.copies
+                       if self.snapshots.get(i) and
+                       self.snapshots[i].status == "pending"]
+            if len(copying) >= self.sim.copy_limit:
+                raise ec2_error("ResourceLimitExceeded",
+                                "Too many snapshot copies in progress")
+            snapshot = FakeSnapshot(self.sim, self.sim.new_id("snap"),
+                                    source.volume_id, source.volume_size)
+            snapshot.transition("pending", "snapshot_copy", "completed")
+            self.snapshots[snapshot.id] = snapshot
+            self.copies.append(snapshot.id)
+            return snapshot.id
+
+    @api
+    def get_all_snapshots(self, snapshot_ids=None, owner=None,
+                          filters=None, **kwargs):
+        with self._lock:
+            return self._find("snapshot", self.snapshots, snapshot_ids,
+                              "InvalidSnapshot.NotFound")
+
+    @api
+    def delete_snapshot(self, snapshot_id):
+        with self._lock:
+            self._find("snapshot", self.snapshots, [snapshot_id],
+                       "InvalidSnapshot.NotFound")
+            del self.snapshots[snapshot_id]
+            return True
+
+    # Images
+
+    def register_public_image(self, image_id):
+        image = FakeImage(self.sim, image_id, image_id, owner="amazon")
+        image.transition("available")
+        self.images[image_id] = image
+        return image
+
+    @api
+    def create_image(self, instance_id, name, description=None,
+                     no_reboot=False):
+        with self._lock:
+            self._find("instance", self.instances, [instance_id],
+                       "InvalidInstanceID.NotFound")
+            root = FakeSnapshot(self.sim, self.sim.new_id("snap"), None,
+                                8)
+            root.transition("pending", "image", "completed")
+            self.snapshots[root.id] = root
+            image = FakeImage(self.sim, self.sim.new_id("ami"), name,
+                              root_snapshot_id=root.id)
+            image.transition("pending", "image", "available")
+            self.images[image.id] = image
+            return image.id
+
+    @api
+    def get_all_images(self, image_ids=None, owners=None, filters=None,
+                       **kwargs):
+        with self._lock:
+            images = self._find("image", self.images, image_ids,
+                                "InvalidAMIID.NotFound")
+            if owners:
+                images = ResultSet(i for i in images if i.owner in owners)
+            return images
+
+    @api
+    def get_image(self, image_id):
+        with self._lock:
+            return self.images.get(image_id)
+
+    @api
+    def deregister_image(self, image_id, delete_snapshot=False):
+        with self._lock:
+            self._find("image", self.images, [image_id],
+                       "InvalidAMIID.NotFound")
+            del self.images[image_id]
+            return True
+
+    # Addresses
+
+    @api
+    def allocate_address(self, domain=None):
+        with self._lock:
+            n = len(self.addresses) + 1
+            ip = "10.%d.%d.%d" % (n >> 16 & 255, n >> 8 & 255, n & 255)
+            address = _Obj(public_ip=ip, instance_id=None,
+                           allocation_id=None)
+            self.addresses[ip] = address
+            return address
+
+    @api
+    def associate_address(self, instance_id=None, public_ip=None, **kwargs):
+        with self._lock:
+            instance = self._find("instance", self.instances, [instance_id],
+                                  "InvalidInstanceID.NotFound")[0]
+            address = self.addresses.get(public_ip)
+            if address is None:
+                raise ec2_error("InvalidAddress.NotFound", public_ip)
+            address.instance_id = instance_id
+            instance.ip_address = public_ip
+            return True
+
+    @api
+    def disassociate_address(self, public_ip=None, association_id=None):
+        with self._lock:
+            address = self.addresses.get(public_ip)
+            if address is None:
+                raise ec2_error("InvalidAddress.NotFound", public_ip)
+            instance = self.instances.get(address.instance_id)
+            if instance:
+                instance.ip_address = None
+            address.instance_id = None
+            return True
+
+    @api
+    def get_all_addresses(self, addresses=None, filters=None,
+                          allocation_ids=None):
+        with self._lock:
+            return ResultSet(self.addresses.values())
+
+    @api
+    def release_address(self, public_ip=None, allocation_id=None):
+        with self._lock:
+            self.addresses.pop(public_ip, None)
+            return True
+
+    # Security groups and key pairs
+
+    @api
+    def get_all_security_groups(self, groupnames=None, group_ids=None,
+                                filters=None):
+        with self._lock:
+            groups = self.security_groups.values()
+            name = (filters or {}).get("group-name")
+            return ResultSet(g for g in groups if name in (None, g.name))
+
+    @api
+    def create_security_group(self, name, description):
+        with self._lock:
+            sg = _Obj(name=name, description=description,
+                      authorize=lambda *args, **kwargs: True)
+            self.security_groups[name] = sg
+            return sg
+
+    @api
+    def get_key_pair(self, keyname):
+        with self._lock:
+            return self.key_pairs.get(keyname)
+
+    @api
+    def create_key_pair(self, key_name):
+        with self._lock:
+            key_pair = _Obj(name=key_name, save=lambda path: True)
+            self.key_pairs[key_name] = key_pair
+            return key_pair
+
+
+def _matches(resource, filters):
+    for name, value in filters.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if name == "instance-state-name":
+            actual = resource.state
+        elif name == "instance-id":
+            actual = resource.id
+        elif name.startswith("tag:"):
+            actual = resource.tags.get(name[4:])
+        else:
+            raise ValueError("Unsupported filter: %s" % name)
+        if actual not in values:
+            return False
+    return True
+
+
+def _iso(timestamp):
+    """Format virtual time as an ISO 8601 timestamp like the EC2 API"""
+    import datetime
+    dt = datetime.datetime.utcfromtimestamp(timestamp)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+class FakeCloudWatchConnection(object):
+    service = "cloudwatch"
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.alarms = {}
+
+    @api
+    def get_metric_statistics(self, period, start_time, end_time,
+                              metric_name, namespace, statistics,
+                              dimensions=None, unit=None):
+        if namespace == "AWS/EC2":
+            # One datapoint per period; values are constant or functions of
+            # the timestamp (seconds) of the datapoint
+            instance_id = dimensions["InstanceId"][0]
+            if metric_name == "CPUUtilization":
+                value = self.sim.cpu.get(instance_id, DEFAULT_CPU_UTILIZATION)
+            else:
+                value = self.sim.instance_metrics.get(
+                    (instance_id, metric_name), 0.0)
+            points = []
+            timestamp = start_time
+            while timestamp < end_time:
+                seconds = calendar.timegm(timestamp.utctimetuple())
+                points.append({"Timestamp": timestamp, "Unit": unit,
+                               statistics: value(seconds) if callable(value)
+                               else value})
+                timestamp += datetime.timedelta(seconds=period)
+            return points
+        if metric_name in ("VolumeWriteOps", "VolumeWriteBytes"):
+            # All writes are reported in the first period; periods are only
+            # reported volume_metrics_delay seconds after they end
+            volume_id = dimensions["VolumeId"][0]
+            ops, written = self.sim.volume_writes.get(volume_id, (0, 0))
+            value = ops if metric_name == "VolumeWriteOps" else written
+            reported = datetime.datetime.utcfromtimestamp(
+                self.sim.now() - self.sim.volume_metrics_delay)
+            points = []
+            timestamp = start_time
+            while (timestamp < end_time and
+                   timestamp + datetime.timedelta(seconds=period) <=
+                   reported):
+                points.append({"Timestamp": timestamp, "Sum": 0.0,
+                               "Unit": unit})
+                timestamp += datetime.timedelta(seconds=period)
+            if points:
+                points[0]["Sum"] = float(value)
+            return points
+        return []
+
+    @api
+    def create_alarm(self, alarm):
+        self.alarms[alarm.name] = alarm
+        return True
+
+
+class FakeGroup(object):
+
+    def __init__(self, conn, name, launch_config_name, min_size, max_size):
+        self.connection = conn
+        self.name = name
+        self.launch_config_name = launch_config_name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.desired_capacity = min_size
+        self.instance_ids = []
+
+    @property
+    def instances(self):
+        return [_Obj(instance_id=i) for i in self.instance_ids]
+
+    def shutdown_instances(self):
+        self.min_size = self.max_size = self.desired_capacity = 0
+        self.connection.update_group(self)
+
+    def delete(self, force_delete=False):
+        return self.connection.delete_auto_scaling_group(self.name)
+
+
+class FakeAutoScaleConnection(object):
+    service = "autoscale"
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.launch_configurations = {}
+        self.groups = {}
+        self.policies = {}
+        self._lock = threading.RLock()
+
+    @api
+    def create_launch_configuration(self, launch_config):
+        with self._lock:
+            if launch_config.name in self.launch_configurations:
+                raise BotoServerError(400, "Bad Request", "AlreadyExists")
+            self.launch_configurations[launch_config.name] = launch_config
+            return True
+
+    @api
+    def get_all_launch_configurations(self, names=None, **kwargs):
+        with self._lock:
+            return [lc for name, lc in self.launch_configurations.items()
+                    if names is None or name in names]
+
+    @api
+    def delete_launch_configuration(self, launch_config_name):
+        with self._lock:
+            del self.launch_configurations[launch_config_name]
+            return True
+
+    @api
+    def create_auto_scaling_group(self, as_group):
+        with self._lock:
+            if as_group.name in self.groups:
+                raise BotoServerError(400, "Bad Request", "AlreadyExists")
+            lc = self.launch_configurations[as_group.launch_config_name]
+            group = FakeGroup(self, as_group.name, lc.name,
+                              as_group.min_size, as_group.max_size)
+            reservation = self.sim.ec2.launch(lc.image_id, group.min_size,
+                                              lc.instance_type)
+            group.instance_ids = [i.id for i in reservation.instances]
+            self.groups[group.name] = group
+            return True
+
+    @api
+    def get_all_groups(self, names=None, **kwargs):
+        with self._lock:
+            return [g for name, g in sorted(self.groups.items())
+                    if names is None or name in names]
+
+    @api
+    def update_group(self, group):
+        with self._lock:
+            if not group.desired_capacity and group.instance_ids:
+                self.sim.ec2.terminate(group.instance_ids)
+            return True
+
+    @api
+    def delete_auto_scaling_group(self, name, force_delete=False):
+        with self._lock:
+            group = self.groups[name]
+            for instance_id in group.instance_ids:
+                if self.sim.ec2.instances[instance_id].state != "terminated":
+                    raise BotoServerError(400, "Bad Request",
+                                          "ScalingActivityInProgress")
+            del self.groups[name]
+            return True
+
+    @api
+    def create_scaling_policy(self, scaling_policy):
+        with self._lock:
+            arn = ("arn:aws:autoscaling:us-east-1:000000000000:"
+                   "scalingPolicy:%s/%s" % (scaling_policy.as_name,
+                                             scaling_policy.name))
+            self.policies[(scaling_policy.as_name, scaling_policy.name)] = \
+                _Obj(name=scaling_policy.name, policy_arn=arn,
+                     as_name=scaling_policy.as_name)
+            return _Obj(PolicyARN=arn)
+
+    @api
+    def get_all_policies(self, as_group=None, policy_names=None, **kwargs):
+        with self._lock:
+            return [p for (group, name), p in sorted(self.policies.items())
+                    if as_group in (None, group) and
+                    (policy_names is None or name in policy_names)]
+
+
+class FakeKey(object):
+
+    def __init__(self, bucket, name, data=None):
+        self.bucket = bucket
+        self.name = self.key = name
+        self.data = data
+        self.last_modified = None
+        self.multipart_etag = None
+        self._stream = None
+
+    @property
+    def size(self):
+        return len(self.data or "")
+
+    @property
+    def etag(self):
+        if self.multipart_etag:
+            return '"%s"' % self.multipart_etag
+        return '"%s"' % hashlib.md5(self.data or "").hexdigest()
+
+    def _count(self, op):
+        self.bucket.connection.sim.count("s3", op)
+
+    def set_contents_from_string(self, data):
+        self._count("PutObject")
+        self.data = data
+        self.multipart_etag = None
+        self.last_modified = formatdate(
+            self.bucket.connection.sim.now(), usegmt=True)
+        self.bucket.keys[self.name] = self
+
+    def set_contents_from_filename(self, filename):
+        with open(filename, "rb") as f:
+            self.set_contents_from_string(f.read())
+
+    def _range(self, headers):
+        data = self.bucket.keys[self.name].data
+        spec = (headers or {}).get("Range")
+        if not spec:
+            return data
+        start, end = spec[len("bytes="):].split("-")
+        if not start:
+            return data[-int(end):]
+        return data[int(start):int(end) + 1 if end else None]
+
+    def get_contents_as_string(self, headers=None):
+        self._count("GetObject")
+        return self._range(headers)
+
+    def get_contents_to_file(self, fp, headers=None):
+        fp.write(self.get_contents_as_string(headers))
+
+    def get_contents_to_filename(self, filename, headers=None):
+        with open(filename, "wb") as f:
+            self.get_contents_to_file(f, headers)
+
+    def open_read(self, headers=None):
+        if self._stream is None:
+            self._count("GetObject")
+            self._stream = [self._range(headers), 0]
+
+    def read(self, size=0):
+        self.open_read()
+        data, pos = self._stream
+        if not size:
+            size = len(data) - pos
+        chunk = data[pos:pos + size]
+        self._stream[1] += len(chunk)
+        if not chunk:
+            self.close()
+        return chunk
+
+    def close(self, fast=False):
+        # Like boto, the rest of an open object is read unless `fast'
+        if self._stream and not fast:
+            data, pos = self._stream
+            if pos < len(data):
+                self._count("DrainObject")
+        self._stream = None
+
+
+class FakeMultiPartUpload(object):
+    """
+    Multipart upload; like boto's, one can be made for an upload initiated
+    elsewhere by setting its `id' and `key_name'
+    """
+
+    def __init__(self, bucket=None, id=None, key_name=None):
+        self.bucket = bucket
+        self.id = id
+        self.key_name = key_name
+        self.parts = {}
+
+    def _parts(self):
+        """Parts uploaded so far, kept by the upload initiated"""
+        return self.bucket.uploads[self.id].parts
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        self.bucket.connection.sim.count("s3", "UploadPart")
+        self._parts()[part_num] = fp.read(size) if size else fp.read()
+
+    def complete_upload(self):
+        self.bucket.connection.sim.count("s3", "CompleteMultipartUpload")
+        uploaded = self._parts()
+        parts = [uploaded[n] for n in sorted(uploaded)]
+        key = FakeKey(self.bucket, self.key_name)
+        key.data = "".join(parts)
+        # ETag of a multipart object: MD5 of the MD5s of its parts
+        digests = "".join(hashlib.md5(part).digest() for part in parts)
+        key.multipart_etag = "%s-%d" % (hashlib.md5(digests).hexdigest(),
+                                        len(parts))
+        key.last_modified = formatdate(
+            self.bucket.connection.sim.now(), usegmt=True)
+        self.bucket.keys[self.key_name] = key
+        del self.bucket.uploads[self.id]
+
+    def cancel_upload(self):
+        del self.bucket.uploads[self.id]
+
+
+class FakeBucket(object):
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.keys = {}
+        self.uploads = {}
+
+    def new_key(self, key_name):
+        return FakeKey(self, key_name)
+
+    def get_key(self, key_name):
+        self.connection.sim.count("s3", "HeadObject")
+        if key_name in self.keys:
+            key = self.keys[key_name]
+            fresh = FakeKey(self, key_name, key.data)
+            fresh.last_modified = key.last_modified
+            fresh.multipart_etag = key.multipart_etag
+            return fresh
+        return None
+
+    def list(self, prefix=""):
+        self.connection.sim.count("s3", "ListObjects")
+        return [self.keys[name] for name in sorted(self.keys)
+                if name.startswith(prefix)]
+
+    def delete_key(self, key_name):
+        self.connection.sim.count("s3", "DeleteObject")
+        self.keys.pop(key_name, None)
+
+    def initiate_multipart_upload(self, key_name, **kwargs):
+        self.connection.sim.count("s3", "CreateMultipartUpload")
+        upload = FakeMultiPartUpload(self, self.connection.sim.new_id("mpu"),
+                                     key_name)
+        self.uploads[upload.id] = upload
+        return upload
+
+    def list_multipart_uploads(self, **kwargs):
+        self.connection.sim.count("s3", "ListMultipartUploads")
+        return list(self.uploads.values())
+
+
+class FakeS3Connection(object):
+    """
+    Fake S3 client; clients given the same `buckets' see the same objects
+    """
+    service = "s3"
+
+    def __init__(self, sim, buckets=None):
+        self.sim = sim
+        self.buckets = {} if buckets is None else buckets
+
+    @api
+    def lookup(self, bucket_name, validate=True, headers=None):
+        return self.buckets.get(bucket_name)
+
+    def get_bucket(self, bucket_name, validate=True, headers=None):
+        """Bucket on this client, without a request as `validate' is off"""
+        bucket = self.buckets[bucket_name]
+        if bucket.connection is self:
+            return bucket
+        view = FakeBucket(self, bucket_name)
+        view.keys, view.uploads = bucket.keys, bucket.uploads
+        return view
+
+    @api
+    def create_bucket(self, bucket_name, **kwargs):
+        bucket = self.buckets.get(bucket_name)
+        if bucket is None:
+            bucket = self.buckets[bucket_name] = FakeBucket(self, bucket_name)
+        return bucket
+
+
+class FakeRegion(object):
+    """Fake EC2, CloudWatch and Autoscale connections of a region"""
+
+    def __init__(self, sim, name):
+        self.ec2 = FakeEC2Connection(sim, name)
+        self.cloudwatch = FakeCloudWatchConnection(sim)
+        self.autoscale = FakeAutoScaleConnection(sim)
+
+
+class _InRegion(object):
+    """Fake connection to a service in the region of the calling thread"""
+
+    def __init__(self, sim, service):
+        self._sim = sim
+        self._service = service
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._sim, self._service), name)
+
+
+class Simulator(object):
+    """
+    Simulated AWS account
+    * `latencies' overrides DEFAULT_LATENCIES
+    * `cpu' maps instance ids to the CPU Utilization CloudWatch reports
+    * `instance_metrics' maps (instance id, metric name) to the values of
+      other instance metrics CloudWatch reports, 0 by default
+    * `volume_writes' maps volume ids to the (write operations, bytes
+      written) CloudWatch reports; volumes are not written to by default
+    * `volume_metrics_delay' is the seconds after the end of a period
+      CloudWatch reports the volume metrics of that period
+    * `copy_limit' is the number of snapshot copies that can be in progress
+      at once
+    * `calls' maps (service, operation) to the number of API calls made
+    * `start' is the time (seconds since the epoch) the simulation starts at
+    * `ec2', `cloudwatch' and `autoscale' are the fake connections of the
+      region of the calling thread; `region(name)' those of another
+    """
+
+    def __init__(self, latencies=None, public_image_ids=(), start=0.0):
+        self.clock = VirtualClock(start)
+        self.latencies = dict(DEFAULT_LATENCIES, **(latencies or {}))
+        self.cpu = {}
+        self.instance_metrics = {}
+        self.volume_writes = {}
+        self.volume_metrics_delay = 0
+        self.copy_limit = 20
+        self.calls = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._public_image_ids = list(public_image_ids)
+        self._regions = {}
+        self.s3 = FakeS3Connection(self)
+
+    def region(self, name):
+        """Get the fake connections of region `name'"""
+        with self._lock:
+            if name not in self._regions:
+                region = self._regions[name] = FakeRegion(self, name)
+                for image_id in self._public_image_ids:
+                    region.ec2.register_public_image(image_id)
+            return self._regions[name]
+
+    @property
+    def ec2(self):
+        return self.region(regions.current()).ec2
+
+    @property
+    def cloudwatch(self):
+        return self.region(regions.current()).cloudwatch
+
+    @property
+    def autoscale(self):
+        return self.region(regions.current()).autoscale
+
+    def now(self):
+        return self.clock.time()
+
+    def new_id(self, prefix):
+        with self._lock:
+            return "%s-%08x" % (prefix, next(self._ids))
+
+    def count(self, service, operation):
+        with self._lock:
+            key = (service, operation)
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = {}
+
+    @contextlib.contextmanager
+    def installed(self):
+        """
+        Use this simulation in place of AWS
+        * The module-level connections of the package are replaced by the
+          fake ones (EC2 behind the usual describe cache) and the virtual
+          clock becomes the time source
+        * Yield the EC2 connection to pass to commands
+        """
+        from . import autoscale, cw, instances, s3
+        from . import conn as conn_module
+        from .cache import CachedConnection
+
+        conn = CachedConnection(_InRegion(self, "ec2"))
+        cw_conn = _InRegion(self, "cloudwatch")
+        targets = [
+            (conn_module, "conn", conn),
+            (instances, "conn", conn),
+            (cw, "cw_conn", cw_conn),
+            (instances, "cw_conn", cw_conn),
+            (autoscale, "cw_conn", cw_conn),
+            (autoscale, "as_conn", _InRegion(self, "autoscale")),
+            (s3, "s3_conn", self.s3),
+        ]
+        saved = [(module, name, getattr(module, name))
+                 for module, name, _ in targets]
+        for module, name, value in targets:
+            setattr(module, name, value)
+        previous = clock.install(self.clock)
+        try:
+            yield conn
+        finally:
+            clock.install(previous)
+            for module, name, value in saved:
+                setattr(module, name, value)
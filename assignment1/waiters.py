@@ -0,0 +1,262 @@
+# Batched waiters for EC2 resource state transitions
+import random
+import threading
+
+from boto.exception import EC2ResponseError
+
+from . import clock, regions
+from .cache import uncached, invalidate
+from .settings import (EC2_WAITER_DELAY, EC2_WAITER_MAX_DELAY,
+                       EC2_WAITER_TIMEOUTS, EC2_WAITER_BATCH_SIZE)
+from .utils import output
+
+
+class WaiterError(Exception):
+    """Raised by WaitResult.check() when a resource failed or timed out"""
+
+    def __init__(self, result):
+        self.result = result
+        msg = "Waiting for %s(s) to become '%s' failed" % (
+            result.kind, "|".join(result.states))
+        if result.failed:
+            msg += "; failed: %s" % ", ".join(result.failed)
+        if result.timed_out:
+            msg += "; timed out: %s" % ", ".join(result.timed_out)
+        Exception.__init__(self, msg)
+
+
+class WaitResult(object):
+    """
+    Outcome of a wait operation
+    * ready: ids that reached a target state
+    * failed: ids that reached a state they can not recover from
+    * timed_out: ids still pending when the deadline passed
+    * resources: mapping of ids to the most recently described objects
+    """
+
+    def __init__(self, kind, states):
+        self.kind = kind
+        self.states = states
+        self.ready = []
+        self.failed = []
+        self.timed_out = []
+        self.resources = {}
+
+    @property
+    def ok(self):
+        return not self.failed and not self.timed_out
+
+    def check(self):
+        if not self.ok:
+            raise WaiterError(self)
+        return self
+
+
+class Waiter(object):
+    """
+    Wait for many EC2 resources of one kind to reach a state
+    * Every resource watched by this waiter, including those of concurrent
+      callers, is described with a single API call per poll round
+    * The poll interval backs off exponentially with jitter, and each wait
+      has a deadline after which the pending ids are reported as timed out
+
+    `pending' lists the states worth waiting in; any other state which is
+    neither in `ready' nor `pending' is a failure. If `pending' is None,
+    every state except those in `failed' is worth waiting in.
+    """
+
+    kind = None
+    cache_kind = None
+    state_attr = "state"
+
+    def __init__(self, conn, ready, pending=None, failed=()):
+        self.conn = conn
+        # Always poll the live state, never a cached describe result
+        self.live_conn = uncached(conn)
+        self.ready = tuple(ready)
+        self.pending = pending and tuple(pending)
+        self.failed = tuple(failed)
+        self._lock = threading.Lock()
+        self._watched = {}  # Mapping of ids to number of callers
+        self._states = {}   # Mapping of ids to (state, object, poll time)
+
+    def describe(self, ids):
+        raise NotImplementedError
+
+    def wait(self, ids, timeout=None, delay=EC2_WAITER_DELAY,
+             max_delay=EC2_WAITER_MAX_DELAY):
+        ids = list(ids)
+        if timeout is None:
+            timeout = EC2_WAITER_TIMEOUTS[self.kind]
+        deadline = clock.now() + timeout
+        result = WaitResult(self.kind, self.ready)
+        pending = set(ids)
+        self._watch(ids)
+        try:
+            since = clock.now()
+            while True:
+                states = self._poll(pending, since)
+                for i in ids:
+                    if i not in pending or i not in states:
+                        continue
+                    state, obj = states[i]
+                    result.resources[i] = obj
+                    if state in self.ready:
+                        result.ready.append(i)
+                    elif state in self.failed or (
+                            self.pending is not None and
+                            state not in self.pending):
+                        result.failed.append(i)
+                    else:
+                        continue
+                    pending.discard(i)
+                if not pending:
+                    break
+                remaining = deadline - clock.now()
+                if remaining <= 0:
+                    result.timed_out = [i for i in ids if i in pending]
+                    break
+                since = clock.now()
+                # "Equal jitter": sleep between half and all of the delay
+                jittered = delay / 2.0 + random.uniform(0, delay / 2.0)
+                clock.sleep(min(remaining, jittered))
+                delay = min(delay * 2, max_delay)
+        finally:
+            self._unwatch(ids)
+            # States changed behind the back of a cached connection
+            invalidate(self.conn, self.cache_kind)
+
+        if result.timed_out:
+            output.warning("Timed out waiting for %s(s): %s" %
+                           (self.kind, ", ".join(result.timed_out)))
+        return result
+
+    def _watch(self, ids):
+        with self._lock:
+            for i in ids:
+                self._watched[i] = self._watched.get(i, 0) + 1
+
+    def _unwatch(self, ids):
+        with self._lock:
+            for i in ids:
+                self._watched[i] -= 1
+                if not self._watched[i]:
+                    del self._watched[i]
+                    self._states.pop(i, None)
+
+    def _poll(self, ids, since):
+        """
+        Return states of `ids' polled no earlier than `since'
+        * If any of them is stale, all watched ids are described at once
+        """
+        with self._lock:
+            stale = [i for i in ids
+                     if i not in self._states or self._states[i][2] < since]
+            if stale:
+                watched = list(self._watched)
+                now = clock.now()
+                for obj in self._describe_batched(watched):
+                    state = getattr(obj, self.state_attr)
+                    self._states[obj.id] = (state, obj, now)
+            return dict((i, self._states[i][:2])
+                        for i in ids if i in self._states)
+
+    def _describe_batched(self, ids):
+        objs = []
+        for start in range(0, len(ids), EC2_WAITER_BATCH_SIZE):
+            chunk = ids[start:start + EC2_WAITER_BATCH_SIZE]
+            try:
+                objs += self.describe(chunk)
+            except EC2ResponseError as e:
+                if not e.error_code or not e.error_code.endswith("NotFound"):
+                    raise
+                # Newly created resources may not be visible yet (eventual
+                # consistency); describe the chunk one by one
+                for i in chunk:
+                    try:
+                        objs += self.describe([i])
+                    except EC2ResponseError as e:
+                        if not (e.error_code and
+                                e.error_code.endswith("NotFound")):
+                            raise
+        return objs
+
+
+class InstanceWaiter(Waiter):
+    kind = "instance"
+    cache_kind = "instances"
+
+    def describe(self, ids):
+        return self.live_conn.get_only_instances(instance_ids=ids)
+
+
+class VolumeWaiter(Waiter):
+    kind = "volume"
+    cache_kind = "volumes"
+    state_attr = "status"
+
+    def describe(self, ids):
+        return self.live_conn.get_all_volumes(volume_ids=ids)
+
+
+class ImageWaiter(Waiter):
+    kind = "image"
+    cache_kind = "images"
+
+    def describe(self, ids):
+        return self.live_conn.get_all_images(image_ids=ids)
+
+
+class SnapshotWaiter(Waiter):
+    kind = "snapshot"
+    cache_kind = "snapshots"
+    state_attr = "status"
+
+    def describe(self, ids):
+        return self.live_conn.get_all_snapshots(snapshot_ids=ids)
+
+
+_waiters = {}
+_waiters_lock = threading.Lock()
+
+
+def get_waiter(cls, conn, ready, pending=None, failed=()):
+    """
+    Get the shared waiter for a connection, resource kind and target state
+    in the current region, so that concurrent callers waiting on the same
+    transition are polled together
+    """
+    key = (cls, conn, regions.current(), tuple(ready),
+           pending and tuple(pending), tuple(failed))
+    with _waiters_lock:
+        if key not in _waiters:
+            _waiters[key] = cls(conn, ready, pending, failed)
+        return _waiters[key]
+
+
+def wait_for_instances(conn, instance_ids, state="running",
+                       pending=("pending",), timeout=None):
+    """
+    Wait for instances to reach `state'
+    * With the default `pending', an instance leaving `pending' for any
+      state other than `state' is a failure; pass None to wait through any
+      state (e.g. running -> shutting-down -> terminated)
+    """
+    waiter = get_waiter(InstanceWaiter, conn, (state,), pending)
+    return waiter.wait(instance_ids, timeout)
+
+
+def wait_for_volumes(conn, volume_ids, state="available", timeout=None):
+    waiter = get_waiter(VolumeWaiter, conn, (state,), failed=("error",))
+    return waiter.wait(volume_ids, timeout)
+
+
+def wait_for_images(conn, image_ids, state="available", timeout=None):
+    failed = ("failed", "error", "invalid", "deregistered")
+    waiter = get_waiter(ImageWaiter, conn, (state,), failed=failed)
+    return waiter.wait(image_ids, timeout)
+
+
+def wait_for_snapshots(conn, snapshot_ids, state="completed", timeout=None):
+    waiter = get_waiter(SnapshotWaiter, conn, (state,), failed=("error",))
+    return waiter.wait(snapshot_ids, timeout)
@@ -0,0 +1,232 @@
+# Benchmark of run.py commands against the in-memory AWS simulator
+# * Reports simulated wall time and API calls of each command for fleets of
+#   several sizes; no AWS account is used
+# * Results can be saved and compared against a baseline to catch
+#   performance regressions
+# * Store strategies (STORE_STRATEGIES) are compared by storing, then
+#   restoring, each fleet with each of them
+# * With --startup, the cold start of each command (a fresh interpreter
+#   importing run.py and the command's modules) is measured instead
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from assignment1 import db, fleet
+from assignment1.settings import EC2_DEFAULT_IMAGE_ID
+from assignment1.simulator import Simulator
+from assignment1.utils import output
+import run
+
+
+FLEET_SIZES = [2, 50, 500]
+COMMANDS = ["init", "list", "store", "restore", "scale", "nscale"]
+
+# Store strategies compared by a store then a restore of each fleet
+STRATEGIES = ["snapshot", "stop"]
+
+# Relative increase of simulated time or API calls reported as a regression
+REGRESSION_TOLERANCE = 0.10
+
+# Interpreters started per command by the startup benchmark
+STARTUP_RUNS = 5
+STARTUP_SCRIPT = """
+import sys, time
+start = time.time()
+import run
+run.load_command(%r)
+boto = [m for m in sys.modules if m.startswith("boto")]
+print time.time() - start, len(boto)
+"""
+
+
+@contextlib.contextmanager
+def _quiet():
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def bench_fleet(size, commands=COMMANDS):
+    """
+    Run `commands' in order on a simulated fleet of `size' instances
+    * A command is a name, or a tuple of a name and a dictionary of options
+      (see run.run_command)
+    """
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    tmpdir = tempfile.mkdtemp()
+    db.path = os.path.join(tmpdir, "state.db")
+    saved = fleet.current
+    fleet.current = fleet.Fleet([fleet.Group("VM%d", size)])
+    results = []
+    try:
+        with sim.installed():
+            for command in commands:
+                command, options = (command if isinstance(command, tuple)
+                                    else (command, {}))
+                sim.reset_calls()
+                start, real_start = sim.now(), time.time()
+                error = None
+                try:
+                    with _quiet():
+                        run.run_command(command, **options)
+                except Exception as e:
+                    error = "%s: %s" % (e.__class__.__name__, e)
+                calls = sorted(sim.calls.items(), key=lambda c: -c[1])
+                results.append({
+                    "fleet": size,
+                    "command": command,
+                    "time": sim.now() - start,
+                    "calls": sim.total_calls(),
+                    "top_calls": ["%s:%s=%d" % (s, op, n)
+                                  for (s, op), n in calls[:3]],
+                    "real_time": time.time() - real_start,
+                    "error": error,
+                })
+    finally:
+        fleet.current = saved
+        db.close()
+        db.path = db.DB_STATE_FILE
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def bench_strategies(size):
+    """
+    Store then restore a simulated fleet of `size' instances with each
+    store strategy
+    * Return a list of (strategy, store result, restore result)
+    """
+    commands = ["init"]
+    for strategy in STRATEGIES:
+        commands += [("store", {"strategy": strategy}), "restore"]
+    results = bench_fleet(size, commands)[1:]
+    return [(strategy, results[2 * i], results[2 * i + 1])
+            for i, strategy in enumerate(STRATEGIES)]
+
+
+def print_strategies(results):
+    fmt = " {:>6} {:<10} {:>10} {:>10} {:>12} {:>10}"
+    print fmt.format("Fleet", "Strategy", "Store (s)", "Calls",
+                     "Restore (s)", "Calls")
+    print '-' * 64
+    for strategy, store, restore in results:
+        print fmt.format(store["fleet"], strategy,
+                         store["error"] and "error" or "%.0f" % store["time"],
+                         store["calls"],
+                         restore["error"] and "error" or
+                         "%.0f" % restore["time"],
+                         restore["calls"])
+
+
+def bench_startup(commands=None, runs=STARTUP_RUNS):
+    """Measure the median cold start of each command over `runs' runs"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for command in commands or sorted(run.CTRL_ARGS):
+        samples = []
+        for _ in range(runs):
+            start = time.time()
+            out = subprocess.check_output(
+                [sys.executable, "-c", STARTUP_SCRIPT % command], cwd=root)
+            imports, boto_modules = out.split()
+            samples.append((time.time() - start, float(imports)))
+        samples.sort()
+        results.append({
+            "command": command,
+            "startup": samples[runs // 2][0],
+            "imports": sorted(s[1] for s in samples)[runs // 2],
+            "boto_modules": int(boto_modules),
+        })
+    return results
+
+
+def print_startup(results):
+    fmt = " {:<12} {:>12} {:>12} {:>13}"
+    print fmt.format("Command", "Startup (ms)", "Imports (ms)", "boto modules")
+    print '-' * 53
+    for r in results:
+        print fmt.format(r["command"], "%.0f" % (1000 * r["startup"]),
+                         "%.0f" % (1000 * r["imports"]), r["boto_modules"])
+
+
+def compare(results, baseline):
+    """Return descriptions of results worse than the baseline"""
+    previous = dict(((r["fleet"], r["command"]), r) for r in baseline)
+    regressions = []
+    for result in results:
+        old = previous.get((result["fleet"], result["command"]))
+        if not old:
+            continue
+        for metric in ("time", "calls"):
+            if result[metric] > old[metric] * (1 + REGRESSION_TOLERANCE):
+                regressions.append("%s (%d instances): %s %.0f -> %.0f" % (
+                    result["command"], result["fleet"], metric, old[metric],
+                    result[metric]))
+        if result["error"] and not old["error"]:
+            regressions.append("%s (%d instances): %s" % (
+                result["command"], result["fleet"], result["error"]))
+    return regressions
+
+
+def print_results(results):
+    fmt = " {:>6} {:<10} {:>12} {:>10} {:>10}  {}"
+    print fmt.format("Fleet", "Command", "Sim time (s)", "API calls",
+                     "Real (s)", "Top calls")
+    print '-' * 90
+    for r in results:
+        detail = r["error"] or ", ".join(r["top_calls"])
+        print fmt.format(r["fleet"], r["command"], "%.0f" % r["time"],
+                         r["calls"], "%.2f" % r["real_time"], detail)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("sizes", nargs="*", type=int, default=FLEET_SIZES,
+                        help="fleet sizes (default: %s)" % FLEET_SIZES)
+    parser.add_argument("--save", metavar="FILE",
+                        help="write results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="fail if results regress against FILE")
+    parser.add_argument("--startup", action="store_true",
+                        help="measure the cold start of each command")
+    args = parser.parse_args()
+
+    if args.startup:
+        print_startup(bench_startup())
+        return
+
+    # Keep jittered waits reproducible
+    random.seed(0)
+    results = []
+    for size in args.sizes:
+        results += bench_fleet(size)
+    print_results(results)
+    print
+    print_strategies([result for size in args.sizes
+                      for result in bench_strategies(size)])
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        for regression in regressions:
+            output.error("Regression: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,154 @@
+import argparse
+import importlib
 import os
 import sys
 
-from assignment1.conn import conn
-from assignment1.cw import cw_conn, get_cpu_stat
-from assignment1.instances import (list_instances_info, initialize_instances,
-                                   store_instances, restore_instances,
-                                   autoscale_instances, stop_autoscale,
-                                   flush_db)
-from assignment1.s3 import s3_init, s3_put, s3_get, s3_print
+from assignment1 import connections, fleet, plan, regions
+from assignment1.metrics import metrics
+from assignment1.settings import STORE_STRATEGIES
 from assignment1.utils import output
 
 
 CMD_USAGE_ARGS = ("init|store|store-s3|store-force|restore|list|scale|nscale"
-                  "|flushdb|s3-init|s3-put|s3-get|s3-print")
-CMD_USAGE = "Usage: python run.py " + CMD_USAGE_ARGS
+                  "|daemon|prewarm|flushdb|s3-init|s3-put|s3-get|s3-print"
+                  "|s3-sync")
 INVALID_USAGE = "Invalid Argument: '%s'. Must be " + CMD_USAGE_ARGS
 
 
+# Mapping of command to the module defining it, and the statement to run in
+# that module's namespace; modules are only imported for the command run
 CTRL_ARGS = {
-    "init": "initialize_instances(conn)",
-    "store": "store_instances(conn, False, True)",
-    "store-s3": "store_instances(conn, True, True)",
-    "store-force": "store_instances(conn)",
-    "restore": "restore_instances(conn)",
-    "list": "list_instances_info(conn)",
-    "scale": "autoscale_instances(conn)",
-    "nscale": "stop_autoscale()",
-    "flushdb": "flush_db()",
-    "s3-init": "s3_init()",
-    "s3-put": "s3_put()",
-    "s3-get": "s3_get()",
-    "s3-print": "s3_print()",
+    "init": ("instances", "initialize_instances(conn)"),
+    "store": ("instances",
+              "store_instances(conn, False, True, strategy=strategy)"),
+    "store-s3": ("instances",
+                 "store_instances(conn, True, True, strategy=strategy)"),
+    "store-force": ("instances", "store_instances(conn, strategy=strategy)"),
+    "restore": ("instances", "restore_instances(conn)"),
+    "list": ("instances", "list_instances_info(conn)"),
+    "scale": ("instances", "autoscale_instances(conn)"),
+    "nscale": ("instances", "stop_autoscale(conn)"),
+    "daemon": ("daemon", "run_daemon(conn)"),
+    "prewarm": ("prewarm", "prewarm_instances(conn)"),
+    "flushdb": ("db", "flush_db()"),
+    "s3-init": ("s3", "s3_init()"),
+    "s3-put": ("s3", "s3_put()"),
+    "s3-get": ("s3", "s3_get()"),
+    "s3-print": ("s3", "s3_print()"),
+    "s3-sync": ("s3", "s3_sync(manifest)"),
 }
 
+# Options the statements of CTRL_ARGS refer to, and their default values
+DEFAULT_OPTIONS = {"manifest": None, "strategy": None}
+
+# Commands that can run in several regions at once (--regions)
+REGIONAL_COMMANDS = ("init", "list", "store", "store-s3", "store-force",
+                     "restore", "scale", "nscale", "prewarm")
+
 
 def main():
     cmd()
 
 
+def load_command(arg):
+    """Import the module of command `arg'; return it and the statement"""
+    module_name, statement = CTRL_ARGS[arg]
+    module = importlib.import_module("assignment1." + module_name)
+    return module, statement
+
+
+def run_command(arg, **options):
+    """
+    Run command `arg'; `options' are names its statement can refer to
+    * Return the value of the statement
+    """
+    module, statement = load_command(arg)
+    namespace = dict(vars(module))
+    namespace.update(DEFAULT_OPTIONS)
+    namespace.update(options)
+    return eval(statement, namespace)
+
+
+def run_in_regions(arg, names, **options):
+    """
+    Run command `arg' in each region or availability zone of `names' at
+    once, then print the merged outcome
+    """
+    load_command(arg)
+    results = regions.run_in_regions(lambda: run_command(arg, **options),
+                                     names)
+    regions.print_report(results)
+    return results
+
+
 def cmd():
-    if len(sys.argv) != 2:
-        print CMD_USAGE
-        sys.exit(1)
-    arg = sys.argv[1]
+    parser = argparse.ArgumentParser(
+        usage="python run.py " + CMD_USAGE_ARGS + " [options]")
+    parser.add_argument("command", help=argparse.SUPPRESS)
+    parser.add_argument("--fleet", metavar="FILE",
+                        help="read the fleet definition from FILE (JSON)")
+    parser.add_argument("--manifest", metavar="FILE",
+                        help="run the transfers listed in FILE (s3-sync)")
+    parser.add_argument("--strategy", choices=STORE_STRATEGIES,
+                        help="store all instances this way instead of the "
+                             "way of their fleet group (store commands)")
+    parser.add_argument("--regions", metavar="LIST",
+                        help="run the command in each region or "
+                             "availability zone of the comma-separated LIST "
+                             "at once (EC2 commands)")
+    parser.add_argument("--plan", action="store_true",
+                        help="print the plan of init, store or restore "
+                             "without running it")
+    parser.add_argument("--metrics-json", metavar="FILE",
+                        help="write API call metrics to FILE as JSON")
+    parser.add_argument("--metrics-prom", metavar="FILE",
+                        help="write API call metrics to FILE in the "
+                             "Prometheus text format")
+    args = parser.parse_args()
+    arg = args.command
+    if args.fleet:
+        fleet.current = fleet.load(args.fleet)
+    plan.dry_run = args.plan
 
-    if arg in ["-h", "--help"]:
-        print CMD_USAGE
-        sys.exit(0)
+    if args.regions and arg in CTRL_ARGS and arg not in REGIONAL_COMMANDS:
+        output.error("Command '%s' cannot run in several regions." % arg)
+        sys.exit(1)
 
     if arg in CTRL_ARGS:
-        statement = CTRL_ARGS[arg]
-        eval(statement)
+        metrics.command = arg
+        options = {"manifest": args.manifest, "strategy": args.strategy}
+        try:
+            if args.regions:
+                run_in_regions(arg, args.regions.split(","), **options)
+            else:
+                run_command(arg, **options)
+        finally:
+            report(args)
     else:
         output.error(INVALID_USAGE % arg)
         sys.exit(1)
 
 
+def report(args):
+    """Report API calls made by the command"""
+    if "assignment1.conn" in sys.modules:
+        stats = sys.modules["assignment1.conn"].conn.stats()
+        output.debug("EC2 describe cache: %d hits (API calls saved), "
+                     "%d misses" % (stats["hits"], stats["misses"]))
+    for (service, region), stats in sorted(connections.stats().items()):
+        output.debug("%s (%s) clients: %d created, %d reused" %
+                     (service, region, stats["created"], stats["reused"]))
+    if metrics.operations:
+        # Keep stdout clean for commands printing data (e.g. s3-print)
+        sys.stderr.write("\n".join(metrics.summary()) + "\n")
+    if args.metrics_json:
+        with open(args.metrics_json, "w") as f:
+            f.write(metrics.to_json())
+    if args.metrics_prom:
+        with open(args.metrics_prom, "w") as f:
+            f.write(metrics.to_prometheus())
+
+
 if __name__ == "__main__":
 
     # Setting default output mode to verbose
@@ -0,0 +1,28 @@
+# Package fixture: the local DB and the files of all tests are kept in a
+# temporary directory, removed once the tests are done; the legacy CSV files
+# imported into the DB are looked for there too
+import os
+import shutil
+import tempfile
+
+from assignment1 import db
+
+
+def setup():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+    db.path = os.path.join(tmpdir, "state.db")
+    db.csv_files = dict((name, os.path.join(tmpdir, name))
+                        for name in db.DB_FILES)
+
+
+def teardown():
+    db.close()
+    db.path = db.DB_STATE_FILE
+    db.csv_files = db.DB_FILES
+    shutil.rmtree(tmpdir)
+
+
+def temp_path(*parts):
+    """Path under the temporary directory of the tests"""
+    return os.path.join(tmpdir, *parts)
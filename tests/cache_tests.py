@@ -0,0 +1,53 @@
+from nose.tools import *
+from assignment1.cache import CachedConnection
+
+
+class Conn(object):
+    def __init__(self):
+        self.calls = 0
+
+    def get_only_instances(self, instance_ids=None):
+        self.calls += 1
+        return ["i-%d" % self.calls]
+
+    def terminate_instances(self, instance_ids):
+        return instance_ids
+
+
+def test_repeated_lookups_are_served_from_cache():
+    conn = CachedConnection(Conn())
+    assert_equal(conn.get_only_instances(), ["i-1"])
+    assert_equal(conn.get_only_instances(), ["i-1"])
+    assert_equal(conn.get_only_instances(instance_ids=["i-1"]), ["i-2"])
+    assert_equal(conn.stats(), {"hits": 1, "misses": 2})
+
+
+def test_mutating_calls_invalidate_entries():
+    conn = CachedConnection(Conn())
+    conn.get_only_instances()
+    conn.terminate_instances(["i-1"])
+    assert_equal(conn.get_only_instances(), ["i-2"])
+    assert_equal(conn.stats(), {"hits": 0, "misses": 2})
+
+
+def test_lookups_invalidated_while_running_are_not_cached():
+    conn = CachedConnection(Conn())
+    get_only_instances = conn.uncached.get_only_instances
+
+    def racing(instance_ids=None):
+        # Another thread changes the instances before the response arrives
+        value = get_only_instances(instance_ids)
+        conn.terminate_instances(["i-1"])
+        return value
+
+    conn.uncached.get_only_instances = racing
+    assert_equal(conn.get_only_instances(), ["i-1"])
+    conn.uncached.get_only_instances = get_only_instances
+    assert_equal(conn.get_only_instances(), ["i-2"])
+    assert_equal(conn.get_only_instances(), ["i-2"])
+
+
+def test_entries_expire():
+    conn = CachedConnection(Conn(), ttl=0)
+    conn.get_only_instances()
+    assert_equal(conn.get_only_instances(), ["i-2"])
@@ -0,0 +1,66 @@
+import time
+
+from nose.tools import *
+from assignment1 import connections
+from assignment1.connections import ConnectionPool, PooledConnection
+from assignment1.parallel import run_parallel
+
+
+class Conn(object):
+    closed = False
+
+    def make_request(self, *args, **kwargs):
+        pass
+
+    def get_all_volumes(self):
+        return self
+
+    def close(self):
+        self.closed = True
+
+
+def setup():
+    global saved, created
+    created = []
+
+    def connect(region):
+        created.append(Conn())
+        return created[-1]
+
+    saved = connections.CONNECTORS["ec2"]
+    connections.CONNECTORS["ec2"] = connect
+
+
+def teardown():
+    connections.CONNECTORS["ec2"] = saved
+
+
+def test_connects_on_first_use():
+    del created[:]
+    conn = PooledConnection(ConnectionPool("ec2", "us-east-1"))
+    assert not conn.connected
+    assert_equal(created, [])
+    assert conn.get_all_volumes() is conn.get_all_volumes()
+    assert conn.connected
+    assert_equal(len(created), 1)
+
+
+def test_workers_reuse_released_clients():
+    del created[:]
+    pool = ConnectionPool("ec2", "us-east-1", size=2)
+    conn = PooledConnection(pool)
+
+    def task(i):
+        # Keep every worker bound to a client at the same time
+        client = conn.get_all_volumes()
+        time.sleep(0.05)
+        return client
+
+    for _ in range(3):
+        run_parallel(task, range(4), workers=4)
+    stats = pool.stats()
+    assert_equal(stats["reused"], 2 * 2)
+    assert_equal(stats["created"] + stats["reused"], 3 * 4)
+    # Clients beyond the pool size are closed rather than kept
+    assert_equal(stats["idle"], 2)
+    assert_equal(len([c for c in created if not c.closed]), 2)
@@ -0,0 +1,43 @@
+import json
+import urllib2
+
+from nose.tools import *
+from assignment1.daemon import Daemon, serve
+from assignment1.instances import initialize_instances, get_instances
+from assignment1.settings import EC2_DEFAULT_IMAGE_ID
+from assignment1.simulator import Simulator
+
+
+def _get(server, path):
+    url = "http://%s:%d%s" % (server.server_address + (path,))
+    try:
+        response = urllib2.urlopen(url)
+    except urllib2.HTTPError as e:
+        response = e
+    return response.getcode(), response.read()
+
+
+def test_daemon_stores_idle_instances():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        busy, idle = list(get_instances(conn))
+        sim.cpu[busy.id] = 90.0
+        daemon = Daemon(conn, interval=60, workers=1, time_limit=24)
+        server = serve(daemon, ("127.0.0.1", 0))
+        try:
+            assert_equal(_get(server, "/health")[0], 503)
+
+            daemon.run(rounds=3)
+
+            code, body = _get(server, "/health")
+            assert_equal(code, 200)
+            health = json.loads(body)
+            assert_equal((health["polls"], health["stored"],
+                          health["failed"], health["storing"]),
+                         (3, 1, 0, []))
+            code, body = _get(server, "/metrics")
+            assert "assignment1_daemon_stored_total 1" in body
+        finally:
+            server.shutdown()
+        assert_equal([i.id for i in get_instances(conn)], [busy.id])
@@ -0,0 +1,79 @@
+import os
+from nose.tools import *
+from assignment1 import db
+from tests import temp_path
+
+
+@with_setup(db.flush)
+def test_latest_snapshot_per_name():
+    db.put_snapshot("VM1", "snap-1", created_at=1)
+    db.put_snapshot("VM1", "snap-2", created_at=2)
+    db.put_snapshot("VM2", "snap-3", created_at=1)
+    assert_equal(db.get_latest_snapshots(),
+                 {"snap-2": "VM1", "snap-3": "VM2"})
+    db.delete_snapshots(["snap-2"])
+    assert_equal(db.get_latest_snapshots(),
+                 {"snap-1": "VM1", "snap-3": "VM2"})
+
+
+@with_setup(db.flush)
+def test_addresses_are_upserted():
+    db.put_addresses([("VM1", "1.1.1.1"), ("VM2", "2.2.2.2")])
+    db.put_addresses([("VM1", "3.3.3.3")])
+    assert_equal(db.get_addresses(), {"VM1": "3.3.3.3", "VM2": "2.2.2.2"})
+
+
+@with_setup(db.flush)
+def test_snapshot_lineage():
+    db.put_snapshot("VM1", "snap-1", created_at=1, volume_id="vol-1")
+    db.put_snapshot("VM1", "snap-2", created_at=2, volume_id="vol-2",
+                    parent_id="snap-1")
+    # Reused for an unchanged volume
+    db.put_snapshot("VM1", "snap-2", created_at=3, volume_id="vol-3",
+                    parent_id="snap-2")
+    assert_equal(db.get_lineage("snap-2"),
+                 [("snap-2", "vol-2", "snap-1"), ("snap-1", "vol-1", None)])
+
+
+def test_csv_files_are_imported_once():
+    with open(db.csv_files["addresses"], "w") as f:
+        f.write("VM1,1.1.1.1\nVM2,2.2.2.2\n")
+    with open(db.csv_files["snapshots"], "w") as f:
+        f.write("VM1,snap-1\nVM2,snap-2\nVM1,snap-3\n")
+    saved, db.path = db.path, temp_path("legacy.db")
+    try:
+        assert_equal(db.get_addresses(), {"VM1": "1.1.1.1", "VM2": "2.2.2.2"})
+        assert_equal(db.get_latest_snapshots(),
+                     {"snap-3": "VM1", "snap-2": "VM2"})
+        # Not imported again by a later run
+        db.flush()
+        db.close()
+        db._initialized.discard(db.path)
+        assert_equal(db.get_addresses(), {})
+        assert_equal(db.get_latest_snapshots(), {})
+    finally:
+        db.close()
+        db.path = saved
+        for filename in db.csv_files.values():
+            os.remove(filename)
+
+
+def test_lineage_columns_are_added():
+    import sqlite3
+    path = temp_path("old.db")
+    old = sqlite3.connect(path)
+    old.execute("CREATE TABLE snapshots (name TEXT NOT NULL, created_at REAL "
+                "NOT NULL, snapshot_id TEXT NOT NULL, "
+                "PRIMARY KEY (name, created_at))")
+    old.execute("INSERT INTO snapshots VALUES ('VM1', 1, 'snap-1')")
+    old.commit()
+    old.close()
+    saved, db.path = db.path, path
+    try:
+        db.put_snapshot("VM1", "snap-2", volume_id="vol-2",
+                        parent_id="snap-1")
+        assert_equal(db.get_lineage("snap-2"),
+                     [("snap-2", "vol-2", "snap-1"), ("snap-1", None, None)])
+    finally:
+        db.close()
+        db.path = saved
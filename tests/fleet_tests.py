@@ -0,0 +1,39 @@
+import json
+import os
+import tempfile
+
+from nose.tools import *
+from assignment1.fleet import Fleet, Group, load
+
+
+def test_group_names():
+    group = Group("web%d", 3, start=0)
+    assert_equal(group.names, ["web0", "web1", "web2"])
+
+
+def test_load_definition():
+    f = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+    json.dump([{"name": "web%d", "count": 2, "instance_type": "m1.small"},
+               {"name": "db%d", "count": 1, "store_strategy": "stop"}], f)
+    f.close()
+    try:
+        fleet = load(f.name)
+    finally:
+        os.remove(f.name)
+    assert_equal(fleet.size, 3)
+    assert_equal(fleet.names, ["web1", "web2", "db1"])
+    assert_equal(fleet.instance_type("web2"), "m1.small")
+    assert_equal(fleet.group_of("db1").name, "db%d")
+    assert_equal(fleet.group_of("cache1"), None)
+    assert_equal(fleet.store_strategy("db1"), "stop")
+    assert_equal(fleet.store_strategy("web1"), "snapshot")
+
+
+@raises(ValueError)
+def test_duplicate_names():
+    Fleet([Group("vm%d", 2), Group("vm%d", 2, start=2)])
+
+
+@raises(ValueError)
+def test_unknown_store_strategy():
+    Group("vm%d", 2, store_strategy="hibernate")
@@ -0,0 +1,69 @@
+from nose.tools import *
+from assignment1 import clock, cw, db
+from assignment1.idle import IdleDetector, Rule, percentile
+from assignment1.instances import initialize_instances, get_instances
+from assignment1.instances import get_idle_instances
+from assignment1.settings import EC2_DEFAULT_IMAGE_ID, IDLE_METRICS
+from assignment1.simulator import Simulator
+
+
+def _cw_calls(sim):
+    return sim.calls.get(("cloudwatch", "get_metric_statistics"), 0)
+
+
+def test_percentile():
+    values = range(1, 101)
+    assert_equal(percentile(values, 95), 95)
+    assert_equal(percentile(values, 100), 100)
+    assert_equal(percentile([7], 50), 7)
+
+
+def test_rule_needs_coverage():
+    rule = Rule("CPUUtilization", threshold=50, minutes=10)
+    history = [(t, 1.0) for t in range(0, 600, 60)]
+    assert_equal(rule.evaluate(history, 600), 1.0)
+    assert_equal(rule.evaluate(history[-2:], 600), None)
+
+
+def test_refresh_is_incremental():
+    db.flush()
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        ids = [i.id for i in get_instances(conn)]
+        clock.sleep(3600 - clock.now() % 60)
+        detector = IdleDetector()
+        detector.refresh(cw.cw_conn, ids)
+        calls = _cw_calls(sim)
+        assert_equal(calls, len(ids) * len(IDLE_METRICS))
+
+        # Within the same period, neither this detector nor a new one
+        # (e.g. of the next run) has anything to fetch
+        clock.sleep(10)
+        detector.refresh(cw.cw_conn, ids)
+        IdleDetector().refresh(cw.cw_conn, ids)
+        assert_equal(_cw_calls(sim), calls)
+
+        clock.sleep(60)
+        detector.refresh(cw.cw_conn, ids)
+        assert_equal(_cw_calls(sim), 2 * calls)
+        history = detector.history(ids[0], "CPUUtilization")
+        assert_equal(len(history), detector.size)
+
+
+def test_single_spike_is_not_busy():
+    db.flush()
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        spiky, busy = list(get_instances(conn))
+        clock.sleep(3600)
+        spike = int(clock.now()) // 60 * 60 - 120
+        sim.cpu[spiky.id] = lambda t: 100.0 if t == spike else 5.0
+        sim.cpu[busy.id] = lambda t: 100.0 if t % 180 == 0 else 5.0
+        sim.reset_calls()
+        idle = get_idle_instances(conn, time_limit=24,
+                                  detector=IdleDetector())
+        assert_equal([i.id for i in idle], [spiky.id])
+        # Only CPUUtilization, which the rules read, is fetched
+        assert_equal(_cw_calls(sim), 2)
@@ -0,0 +1,100 @@
+from nose.tools import *
+from assignment1 import db, fleet
+from assignment1.instances import (initialize_instances, store_instances,
+                                   restore_instances, get_instances)
+from assignment1.journal import Journal
+from assignment1.settings import EC2_DEFAULT_IMAGE_ID
+from assignment1.simulator import Simulator, ec2_error
+
+
+def _fail(*args, **kwargs):
+    raise ec2_error("InternalError", "Interrupted")
+
+
+def _calls(sim, operation):
+    return sim.calls.get(("ec2", operation), 0)
+
+
+@with_setup(db.flush)
+def test_steps_are_recorded_once():
+    journal = Journal("store")
+    calls = []
+    step = journal.step("i-1", "image", lambda: calls.append(1) or "ami-1")
+    assert_equal(step(), "ami-1")
+    # A rerun returns the recorded value
+    journal = Journal("store")
+    step = journal.step("i-1", "image", lambda: calls.append(1) or "ami-2")
+    assert_equal(step(), "ami-1")
+    assert_equal((len(calls), journal.resumed), (1, 1))
+    # ... unless it no longer holds
+    step = journal.step("i-1", "image", lambda: "ami-2", lambda v: False)
+    assert_equal(step(), "ami-2")
+    journal.done(["i-1"])
+    assert_equal(db.get_journal("store"), {})
+
+
+@with_setup(db.flush)
+def test_interrupted_store_resumes():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        sim.ec2.terminate_instances = _fail
+        results = store_instances(conn)
+        assert not any(result.ok for result in results)
+        assert_equal(db.get_latest_snapshots(), {})
+        del sim.ec2.terminate_instances
+
+        sim.reset_calls()
+        results = store_instances(conn)
+        assert all(result.ok for result in results)
+        # AMIs and snapshots of the interrupted run are kept
+        for operation in ("create_image", "create_snapshot",
+                          "detach_volume", "deregister_image"):
+            assert_equal(_calls(sim, operation), 0)
+        assert_equal(_calls(sim, "terminate_instances"), 2)
+        assert_equal(list(get_instances(conn)), [])
+        assert_equal(sorted(db.get_latest_snapshots().values()),
+                     fleet.current.names)
+        assert_equal(db.get_journal("store"), {})
+
+
+@with_setup(db.flush)
+def test_store_of_terminated_instances_resumes():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        sim.ec2.delete_volume = _fail
+        results = store_instances(conn)
+        assert not any(result.ok for result in results)
+        assert_equal(list(get_instances(conn)), [])
+        del sim.ec2.delete_volume
+
+        sim.reset_calls()
+        results = store_instances(conn)
+        assert_equal(len(results), 2)
+        assert all(result.ok for result in results)
+        assert_equal(_calls(sim, "terminate_instances"), 0)
+        assert_equal(_calls(sim, "delete_volume"), 2)
+        assert_equal(sim.ec2.volumes, {})
+        assert_equal(db.get_journal("store"), {})
+
+
+@with_setup(db.flush)
+def test_interrupted_restore_resumes():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        store_instances(conn)
+        sim.ec2.attach_volume = _fail
+        results = restore_instances(conn)
+        assert not any(result.ok for result in results)
+        del sim.ec2.attach_volume
+
+        sim.reset_calls()
+        results = restore_instances(conn)
+        assert all(result.ok for result in results)
+        assert_equal(_calls(sim, "run_instances"), 0)
+        assert_equal(_calls(sim, "create_volume"), 0)
+        assert_equal(_calls(sim, "attach_volume"), 2)
+        assert_equal(len(list(get_instances(conn))), 2)
+        assert_equal(db.get_journal("restore"), {})
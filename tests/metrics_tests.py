@@ -0,0 +1,43 @@
+from nose.tools import *
+from assignment1.metrics import Metrics, instrument
+import assignment1.metrics
+
+
+class Response(object):
+    def __init__(self, status, body=""):
+        self.status = status
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class Conn(object):
+    def __init__(self, responses):
+        self.responses = responses
+
+    def make_request(self, action, params=None, path="/", verb="GET"):
+        return self.responses.pop(0)
+
+
+def setup():
+    assignment1.metrics.metrics = Metrics()
+
+
+def test_records_calls_errors_and_throttles():
+    metrics = assignment1.metrics.metrics
+    metrics.command = "store"
+    conn = instrument(Conn([
+        Response(200),
+        Response(400, "<Code>RequestLimitExceeded</Code>"),
+        Response(400, "<Code>InvalidVolume.NotFound</Code>"),
+    ]), "ec2")
+    for _ in range(3):
+        conn.make_request("DescribeVolumes")
+
+    stats = metrics.operations[("store", "ec2", "DescribeVolumes")]
+    assert_equal((stats.count, stats.errors, stats.throttles), (3, 2, 1))
+    prom = metrics.to_prometheus()
+    assert ('assignment1_api_calls_total{command="store",service="ec2",'
+            'operation="DescribeVolumes"} 3') in prom
+    assert 'le="+Inf"} 3' in prom
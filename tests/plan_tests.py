@@ -0,0 +1,86 @@
+import threading
+import time
+
+from nose.tools import *
+from assignment1 import db, plan as plans
+from assignment1.instances import initialize_instances, store_instances
+from assignment1.plan import Plan
+from assignment1.settings import EC2_DEFAULT_IMAGE_ID
+from assignment1.simulator import Simulator
+
+
+def test_tasks_get_the_values_of_their_dependencies():
+    plan = Plan("test")
+    plan.add("a", "setup", lambda: 1)
+    plan.add("b", "setup", lambda: 2)
+    plan.add("sum", "setup", lambda a, b: a + b, ["a", "b"])
+    plan.add("double", "setup", lambda total: 2 * total, ["sum"])
+    plan.run()
+    assert_equal(plan["double"].value, 6)
+    assert plan["sum"].start >= max(plan["a"].end, plan["b"].end)
+    assert_equal(plan.error(["a", "b", "sum", "double"]), None)
+
+
+def test_dependents_of_failed_tasks_are_skipped():
+    def fail():
+        raise ValueError("boom")
+
+    plan = Plan("test")
+    plan.add("fail", "setup", fail)
+    plan.add("after", "setup", lambda _: 1, ["fail"])
+    plan.add("after-after", "setup", lambda _: 1, ["after"])
+    plan.add("other", "setup", lambda: 1)
+    plan.run()
+    assert_equal(plan["fail"].status, "failed")
+    assert_equal(plan["after"].status, "skipped")
+    assert_equal(plan["after-after"].status, "skipped")
+    assert_equal(plan["other"].status, "done")
+    assert_is_instance(plan.error(["other", "after-after"]), ValueError)
+
+
+def test_concurrency_limit():
+    lock = threading.Lock()
+    active = [0, 0]  # Current and highest number of running tasks
+
+    def task():
+        with lock:
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+
+    plan = Plan("test")
+    for i in range(20):
+        plan.add("task%d" % i, "setup", task)
+    plan.run(workers=3)
+    assert all(task.ok for task in plan.tasks)
+    assert_equal(active[1], 3)
+
+
+def test_estimated_critical_path():
+    plan = Plan("test")
+    plan.add("launch", "launch", lambda: None)
+    plan.add("volume", "volume", lambda: None)
+    plan.add("attach", "attach", lambda *_: None, ["launch", "volume"])
+    plan.add("tag", "tag", lambda _: None, ["launch"])
+    total, path = plan.critical_path()
+    assert_equal([task.name for task in path], ["launch", "attach"])
+    assert_equal(total, plan["launch"].estimate + plan["attach"].estimate)
+
+
+def test_dry_run_makes_no_changes():
+    db.flush()
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        sim.reset_calls()
+        plans.dry_run = True
+        try:
+            initialize_instances(conn)
+            store_instances(conn)
+        finally:
+            plans.dry_run = False
+        read_only = ("get_", "describe", "list")
+        assert all(op.startswith(read_only) for _, op in sim.calls)
+        assert_equal(len(list(conn.get_only_instances())), 2)
@@ -0,0 +1,87 @@
+import datetime
+import time
+
+from nose.tools import *
+from assignment1 import db, fleet
+from assignment1.daemon import Daemon
+from assignment1.instances import (initialize_instances, store_instances,
+                                   get_instances)
+from assignment1.prewarm import predict, prewarm_instances
+from assignment1.settings import EC2_DEFAULT_IMAGE_ID, PREWARM_MARGIN
+from assignment1.simulator import Simulator
+
+
+# Wednesday
+TODAY = datetime.date(2026, 10, 14)
+
+
+def _at(days_ago, hour, minute=0):
+    """Local time on the day `days_ago' days before TODAY"""
+    day = TODAY - datetime.timedelta(days=days_ago)
+    return time.mktime(datetime.datetime(day.year, day.month, day.day,
+                                         hour, minute).timetuple())
+
+
+def _weekdays(count):
+    """Numbers of days ago of the last `count' weekdays before TODAY"""
+    days = [n for n in range(1, 2 * count)
+            if (TODAY - datetime.timedelta(days=n)).weekday() < 5]
+    return days[:count]
+
+
+def _names(conn):
+    return sorted(i.tags["Name"] for i in get_instances(conn))
+
+
+def test_need_time_is_learnt_from_days_of_the_same_kind():
+    events = [("restore", _at(n, 9, i), 100.0)
+              for i, n in enumerate(_weekdays(10))]
+    since = _at(14, 0)
+    start, need = predict(events, _at(0, 8), since)
+    # 20th percentile of 9:00 to 9:09
+    assert_equal(need, _at(0, 9, 1))
+    assert_equal(start, need - 100 - PREWARM_MARGIN)
+    # Saturday: never needed on weekends
+    assert_equal(predict(events, _at(-3, 8), since), None)
+
+
+def test_rarely_needed_vms_are_not_prewarmed():
+    events = [("active", _at(n, 9), None) for n in _weekdays(10)[:3]]
+    events.append(("prewarm", _at(1, 8, 45), 100.0))
+    assert_equal(predict(events, _at(0, 8), _at(14, 0)), None)
+    assert predict(events, _at(0, 8), _at(7, 0))
+
+
+@with_setup(db.flush)
+def test_prewarm_restores_vms_due_soon():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID],
+                    start=_at(0, 8, 40))
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        store_instances(conn)
+        first, second = fleet.current.names
+        db.put_history([(first, "restore", _at(n, 9), 300.0)
+                        for n in _weekdays(10)])
+        prewarm_instances(conn)
+        assert_equal(_names(conn), [first])
+        history = db.get_history(events=["prewarm"])
+        assert_equal(history.keys(), [first])
+        # Prewarmed VMs are kept running until their users arrive
+        Daemon(conn, time_limit=0).run(rounds=1)
+        assert_equal(_names(conn), [first])
+        # Nothing else is due
+        assert_equal(prewarm_instances(conn), None)
+
+
+@with_setup(db.flush)
+def test_daemon_records_first_activity_of_the_day():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID],
+                    start=_at(0, 9))
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        busy, idle = list(get_instances(conn))
+        sim.cpu[busy.id] = 90.0
+        Daemon(conn, interval=60, workers=1, time_limit=24).run(rounds=12)
+        history = db.get_history(events=["active"])
+        assert_equal(history.keys(), [busy.tags["Name"]])
+        assert_equal(len(history[busy.tags["Name"]]), 1)
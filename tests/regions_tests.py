@@ -0,0 +1,107 @@
+import os
+import sys
+from StringIO import StringIO
+
+from nose.tools import *
+from assignment1 import clock, db, fleet, regions
+from assignment1.instances import (initialize_instances, store_instances,
+                                   restore_instances, get_instances)
+from assignment1.settings import EC2_DEFAULT_IMAGE_ID, EC2_DEFAULT_REGION
+from assignment1.simulator import Simulator
+from tests import temp_path
+
+
+def _flush_all():
+    for region in (EC2_DEFAULT_REGION, "eu-west-1"):
+        with regions.use(region):
+            db.flush()
+    db.close()
+
+
+def test_parse():
+    assert_equal(regions.parse("eu-west-1"), ("eu-west-1", "eu-west-1a"))
+    assert_equal(regions.parse("eu-west-1c"), ("eu-west-1", "eu-west-1c"))
+    assert_equal(regions.parse(EC2_DEFAULT_REGION)[1],
+                 regions.default_zone(EC2_DEFAULT_REGION))
+
+
+@with_setup(_flush_all)
+def test_regions_have_their_own_resources_and_state():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    names = [EC2_DEFAULT_REGION, "eu-west-1c"]
+    with sim.installed() as conn:
+        results = regions.run_in_regions(
+            lambda: initialize_instances(conn), names)
+        assert all(result.ok for result in results)
+        with regions.use("eu-west-1"):
+            instances = list(get_instances(conn))
+            assert_equal(sorted(i.tags["Name"] for i in instances),
+                         fleet.current.names)
+            assert_equal(set(i.placement for i in instances),
+                         set(["eu-west-1c"]))
+            assert_equal(sorted(db.get_addresses()), fleet.current.names)
+        assert_equal(len(sim.region("eu-west-1").ec2.key_pairs), 1)
+        assert os.path.exists(temp_path("state.eu-west-1.db"))
+
+        # Regions run at once: two take about as long as one
+        start = clock.now()
+        results = regions.run_in_regions(lambda: store_instances(conn),
+                                         names)
+        assert all(r.ok for result in results for r in result.value[0])
+        store_time = clock.now() - start
+        assert store_time < 1.5 * max(r.value[1] for r in results)
+        with regions.use("eu-west-1"):
+            assert_equal(list(get_instances(conn)), [])
+            assert_equal(sorted(db.get_latest_snapshots().values()),
+                         fleet.current.names)
+        # Stored in one region, restored in it alone
+        restore_instances(conn)
+        assert_equal(len(list(get_instances(conn))), 2)
+        with regions.use("eu-west-1"):
+            assert_equal(list(get_instances(conn)), [])
+
+
+def _store_calls(names):
+    """API calls of a store of 20 instances in each of `names'"""
+    _flush_all()
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        regions.run_in_regions(lambda: initialize_instances(conn), names)
+        sim.reset_calls()
+        regions.run_in_regions(lambda: store_instances(conn), names)
+    return sim.total_calls()
+
+
+def test_api_calls_grow_linearly_with_regions():
+    saved = fleet.current
+    fleet.current = fleet.Fleet([fleet.Group("VM%d", 20)])
+    try:
+        one = _store_calls([EC2_DEFAULT_REGION])
+        two = _store_calls([EC2_DEFAULT_REGION, "eu-west-1"])
+    finally:
+        fleet.current = saved
+    # Waits of a region only describe its own resources
+    assert two < 2.2 * one, (one, two)
+
+
+def test_a_failing_region_does_not_stop_the_others():
+    def command():
+        print "working in", regions.current()
+        if regions.current() == "eu-west-1":
+            raise RuntimeError("boom")
+        return 1
+
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        results = regions.run_in_regions(command, ["us-west-2",
+                                                   "eu-west-1"])
+        regions.print_report(results)
+        printed = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    assert_equal(results[0].value[0], 1)
+    assert_is_instance(results[1].error, RuntimeError)
+    # The output of each region is printed as a block
+    assert "=== us-west-2 (0s) ===\nworking in us-west-2\n" in printed
+    assert "eu-west-1       FAILED" in printed
@@ -0,0 +1,477 @@
+import os
+import time
+
+from boto.exception import BotoServerError
+from nose.tools import *
+from assignment1 import connections, db, fleet, s3
+from assignment1.instances import (initialize_instances, store_instances,
+                                   restore_instances, list_instances_info,
+                                   get_instances, autoscale_instances,
+                                   stop_autoscale)
+from assignment1.s3 import (upload_file, download_file, stream_object,
+                            parse_range, sync_directory, transfer_files,
+                            read_manifest, _etag)
+from assignment1.settings import EC2_DEFAULT_IMAGE_ID, EC2_DEFAULT_DATA_DEVICE
+from assignment1.simulator import (Simulator, FakeKey, FakeMultiPartUpload,
+                                  FakeS3Connection)
+from tests import temp_path
+
+
+def _names(instances):
+    return sorted(i.tags.get("Name") for i in instances)
+
+
+def test_store_and_restore_cycle():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        instances = list(get_instances(conn))
+        assert_equal(_names(instances), fleet.current.names)
+        for instance in instances:
+            assert EC2_DEFAULT_DATA_DEVICE in instance.block_device_mapping
+            assert instance.ip_address
+        assert_equal(list_instances_info(conn), len(instances))
+        # Only the CPU utilization shown is fetched
+        assert_equal(sim.calls[("cloudwatch", "get_metric_statistics")],
+                     len(instances))
+
+        results = store_instances(conn)
+        assert all(result.ok for result in results)
+        assert_equal(list(get_instances(conn)), [])
+        snapshots = db.get_latest_snapshots()
+        assert_equal(sorted(snapshots.values()), fleet.current.names)
+
+        results = restore_instances(conn)
+        assert all(result.ok for result in results)
+        instances = list(get_instances(conn))
+        assert_equal(_names(instances), fleet.current.names)
+        for instance in instances:
+            assert EC2_DEFAULT_DATA_DEVICE in instance.block_device_mapping
+            assert_equal(instance.ip_address,
+                         db.get_addresses()[instance.tags["Name"]])
+        # Snapshots are kept as the baseline of the restored volumes
+        assert_equal(db.get_latest_snapshots(), snapshots)
+
+    # Waits are simulated: the cycle takes minutes of virtual time only
+    assert sim.now() > sim.latencies["image"]
+
+
+def test_multipart_transfers():
+    sim = Simulator()
+    bucket = sim.s3.create_bucket("test")
+    source = temp_path("source")
+    target = temp_path("target")
+    with open(source, "wb") as f:
+        f.write(os.urandom(10 * 1024 + 1))
+
+    with sim.installed():
+        upload_file(bucket, "key", source, part_size=1024)
+        download_file(bucket, "key", target, part_size=1024)
+
+    assert_equal(sim.calls[("s3", "UploadPart")], 11)
+    assert_equal(bucket.get_key("key").etag.strip('"'),
+                 _etag(source, part_size=1024))
+    with open(source, "rb") as f:
+        with open(target, "rb") as g:
+            assert f.read() == g.read()
+    assert not os.path.exists(target + ".s3download")
+
+
+def test_interrupted_transfers_resume_with_the_missing_parts():
+    sim = Simulator()
+    bucket = sim.s3.create_bucket("test")
+    source = temp_path("resumed-source")
+    target = temp_path("resumed-target")
+    with open(source, "wb") as f:
+        f.write(os.urandom(10 * 1024 + 1))
+    upload_part = FakeMultiPartUpload.upload_part_from_file
+    get_contents_to_file = FakeKey.get_contents_to_file
+
+    def failing_upload(self, fp, part_num, size=None):
+        if part_num == 4:
+            raise IOError("Connection reset by peer")
+        upload_part(self, fp, part_num, size)
+
+    def failing_download(self, fp, headers=None):
+        if headers["Range"].startswith("bytes=3072-"):
+            raise IOError("Connection reset by peer")
+        get_contents_to_file(self, fp, headers)
+
+    with sim.installed():
+        FakeMultiPartUpload.upload_part_from_file = failing_upload
+        try:
+            assert_raises(IOError, upload_file, bucket, "key", source,
+                          part_size=1024)
+        finally:
+            FakeMultiPartUpload.upload_part_from_file = upload_part
+        assert_equal(bucket.get_key("key"), None)
+        sim.reset_calls()
+        upload_file(bucket, "key", source, part_size=1024)
+        assert_equal(sim.calls[("s3", "UploadPart")], 1)
+
+        FakeKey.get_contents_to_file = failing_download
+        try:
+            assert_raises(IOError, download_file, bucket, "key", target,
+                          part_size=1024)
+        finally:
+            FakeKey.get_contents_to_file = get_contents_to_file
+        assert not os.path.exists(target)
+        sim.reset_calls()
+        download_file(bucket, "key", target, part_size=1024)
+        assert_equal(sim.calls[("s3", "GetObject")], 1)
+
+    with open(source, "rb") as f:
+        with open(target, "rb") as g:
+            assert f.read() == g.read()
+    assert not os.path.exists(source + ".s3upload")
+    assert not os.path.exists(target + ".s3download")
+
+
+def test_part_workers_use_pooled_clients():
+    sim = Simulator()
+    bucket = sim.s3.create_bucket("test")
+    source = temp_path("pooled-source")
+    target = temp_path("pooled-target")
+    with open(source, "wb") as f:
+        f.write(os.urandom(10 * 1024 + 1))
+
+    def connect(region):
+        client = FakeS3Connection(sim, sim.s3.buckets)
+        client.make_request = None  # Requests are made by the fake objects
+        return client
+
+    pool = connections.ConnectionPool("s3", "us-east-1")
+    saved = connections.CONNECTORS["s3"]
+    connections.CONNECTORS["s3"] = connect
+    try:
+        with sim.installed():
+            s3.s3_conn = connections.PooledConnection(pool)
+            upload_file(bucket, "key", source, part_size=1024,
+                        concurrency=4)
+            download_file(bucket, "key", target, part_size=1024,
+                          concurrency=4)
+    finally:
+        connections.CONNECTORS["s3"] = saved
+    # One client per worker thread, reused by the workers of the download
+    assert_equal(pool.stats(), {"created": 4, "reused": 4, "idle": 4})
+    with open(source, "rb") as f:
+        with open(target, "rb") as g:
+            assert f.read() == g.read()
+
+
+class _Out(object):
+    """File-like object recording the size of the largest write"""
+
+    def __init__(self):
+        self.data = ""
+        self.largest = 0
+
+    def write(self, data):
+        self.data += data
+        self.largest = max(self.largest, len(data))
+
+
+def test_stream_object_ranges():
+    sim = Simulator()
+    bucket = sim.s3.create_bucket("test")
+    data = os.urandom(10 * 1024 + 1)
+    bucket.new_key("key").set_contents_from_string(data)
+
+    for spec, expected in (("", data), ("100-199", data[100:200]),
+                           ("10000-", data[10000:]), ("-10", data[-10:]),
+                           ("-99999", data), ("20000-", "")):
+        out = _Out()
+        written = stream_object(bucket, "key", out, *parse_range(spec),
+                                chunk_size=1000)
+        assert_equal(out.data, expected)
+        assert_equal(written, len(expected))
+        assert out.largest <= 1000
+    assert_equal(stream_object(bucket, "missing", _Out()), None)
+    assert_raises(ValueError, parse_range, "-")
+    assert_raises(ValueError, parse_range, "9-1")
+
+    # A failed write drops the connection instead of reading the rest
+    def fail(data):
+        raise IOError("No space left on device")
+    out = _Out()
+    out.write = fail
+    assert_raises(IOError, stream_object, bucket, "key", out,
+                  chunk_size=1000)
+    assert ("s3", "DrainObject") not in sim.calls
+
+
+def _write(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_sync_directory():
+    # Objects get the current time as their Last-Modified
+    sim = Simulator(start=time.time())
+    bucket = sim.s3.create_bucket("test")
+    source = temp_path("sync-source")
+    target = temp_path("sync-target")
+    for name in ("a", "b/c", "b/d/e"):
+        _write(os.path.join(source, *name.split("/")), name * 100)
+
+    with sim.installed():
+        results, skipped = sync_directory(bucket, source, "backup/")
+        assert_equal((len(results), skipped), (3, 0))
+        assert_equal(sorted(k.name for k in bucket.list()),
+                     ["backup/a", "backup/b/c", "backup/b/d/e"])
+
+        # Unchanged files are skipped, changed ones sent again
+        _write(os.path.join(source, "b", "c"), "changed")
+        results, skipped = sync_directory(bucket, source, "backup/")
+        assert_equal([r.item[2] for r in results], ["backup/b/c"])
+        assert_equal(skipped, 2)
+
+        # A change keeping the size, with a time older than the object, is
+        # sent too
+        path = os.path.join(source, "a")
+        _write(path, "A" * 100)
+        os.utime(path, (time.time() - 3600, time.time() - 3600))
+        results, skipped = sync_directory(bucket, source, "backup/")
+        assert_equal([r.item[2] for r in results], ["backup/a"])
+
+        # Files of interrupted transfers are not sent
+        for suffix in (".s3upload", ".s3part"):
+            _write(os.path.join(source, "b", "d", "e" + suffix), "{}")
+        results, skipped = sync_directory(bucket, source, "backup/")
+        assert_equal((len(results), skipped), (0, 3))
+
+        results, skipped = sync_directory(bucket, target, "backup/", False)
+        assert all(result.ok for result in results)
+        assert_equal((len(results), skipped), (3, 0))
+        with open(os.path.join(target, "b", "d", "e")) as f:
+            assert_equal(f.read(), "b/d/e" * 100)
+
+        sim.reset_calls()
+        results, skipped = sync_directory(bucket, target, "backup/", False)
+        assert_equal((len(results), skipped), (0, 3))
+        assert_equal(sim.calls.keys(), [("s3", "ListObjects")])
+
+        # Keys resolving outside of the directory are not downloaded
+        for name in ("backup/../../escaped", "backup/b/../../escaped"):
+            bucket.new_key(name).set_contents_from_string("x")
+        results, skipped = sync_directory(bucket, target, "backup/", False)
+        assert_equal((len(results), skipped), (0, 3))
+        assert not os.path.exists(temp_path("escaped"))
+
+        manifest = temp_path("manifest")
+        with open(manifest, "w") as f:
+            f.write("# Batch\nput %s single\n\nget missing %s\n" %
+                    (os.path.join(source, "a"), os.path.join(target, "x")))
+        results, skipped = transfer_files(bucket, read_manifest(manifest))
+        assert_equal([r.ok for r in results], [True, False])
+        assert_equal(bucket.get_key("single").size, 100)
+
+
+def test_get_instances_filters_and_pages():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        launched = sim.ec2.launch(EC2_DEFAULT_IMAGE_ID, 12).instances
+        sim.clock.sleep(sim.latencies["instance_boot"])
+        sim.ec2.create_tags([launched[0].id], {"Name": "VM1"})
+        sim.reset_calls()
+
+        instances = get_instances(conn, page_size=5)
+        assert_equal(next(instances).id, launched[0].id)
+        assert_equal(len(list(instances)), 11)
+        assert_equal(sim.calls[("ec2", "get_all_reservations")], 3)
+
+        tagged = list(get_instances(conn, tags={"Name": "VM1"}))
+        assert_equal([i.id for i in tagged], [launched[0].id])
+        assert_equal(list(get_instances(conn, state="pending")), [])
+        assert_equal(list(get_instances(conn, instance_ids=[])), [])
+
+
+def test_fleet_groups():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    saved = fleet.current
+    fleet.current = fleet.Fleet([fleet.Group("web%d", 30, "m1.small"),
+                                 fleet.Group("db%d", 2, "m1.large")])
+    try:
+        with sim.installed() as conn:
+            initialize_instances(conn)
+            instances = list(get_instances(conn))
+            assert_equal(_names(instances), sorted(fleet.current.names))
+            for instance in instances:
+                name = instance.tags["Name"]
+                assert_equal(instance.instance_type,
+                             fleet.current.instance_type(name))
+                assert_equal(instance.tags["Group"],
+                             fleet.current.group_of(name).name)
+            # Name tags, and one call per group for group tags
+            assert_equal(sim.calls[("ec2", "create_tags")], 32 + 2)
+
+            assert all(result.ok for result in store_instances(conn))
+            assert all(result.ok for result in restore_instances(conn))
+            for instance in get_instances(conn):
+                name = instance.tags["Name"]
+                assert_equal(instance.instance_type,
+                             fleet.current.instance_type(name))
+    finally:
+        fleet.current = saved
+
+
+def test_stop_strategy_per_group():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    saved = fleet.current
+    fleet.current = fleet.Fleet([fleet.Group("web%d", 1),
+                                 fleet.Group("db%d", 2,
+                                             store_strategy="stop")])
+    try:
+        with sim.installed() as conn:
+            initialize_instances(conn)
+            before = dict((i.tags["Name"], i.id) for i in get_instances(conn))
+            sim.reset_calls()
+            results = store_instances(conn)
+            assert all(result.ok for result in results)
+            assert_equal(sim.calls[("ec2", "stop_instances")], 1)
+            assert_equal(sim.calls[("ec2", "create_image")], 1)
+            stopped = [i for i in sim.ec2.instances.values()
+                       if i.state == "stopped"]
+            assert_equal(_names(stopped), ["db1", "db2"])
+
+            sim.reset_calls()
+            results = restore_instances(conn)
+            assert all(result.ok for result in results)
+            assert_equal(sim.calls[("ec2", "start_instances")], 1)
+            assert_equal(sim.calls[("ec2", "run_instances")], 1)
+            # The addresses of stopped instances stayed associated
+            assert_equal(sim.calls[("ec2", "associate_address")], 1)
+            after = dict((i.tags["Name"], i.id) for i in get_instances(conn))
+            assert_equal(sorted(after), ["db1", "db2", "web1"])
+            for name in ("db1", "db2"):
+                assert_equal(after[name], before[name])
+            for instance in get_instances(conn):
+                assert EC2_DEFAULT_DATA_DEVICE in instance.block_device_mapping
+                assert_equal(instance.ip_address,
+                             db.get_addresses()[instance.tags["Name"]])
+    finally:
+        fleet.current = saved
+
+
+def test_store_reuses_snapshots_of_unchanged_volumes():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        store_instances(conn)
+        restore_instances(conn)
+        baseline = dict((name, snapshot_id) for snapshot_id, name
+                        in db.get_latest_snapshots().items())
+        written = list(get_instances(conn))[0]
+        volume_id = written.block_device_mapping[
+            EC2_DEFAULT_DATA_DEVICE].volume_id
+        sim.volume_writes[volume_id] = (10, 4096)
+        sim.clock.sleep(3600)
+        sim.reset_calls()
+
+        results = store_instances(conn)
+        assert all(result.ok for result in results)
+        reused = dict((r.item.tags["Name"], r.value[1]) for r in results)
+        assert_equal(sum(reused.values()), len(results) - 1)
+        assert not reused[written.tags["Name"]]
+        assert_equal(sim.calls[("ec2", "create_snapshot")], 1)
+
+        latest = dict((name, snapshot_id) for snapshot_id, name
+                      in db.get_latest_snapshots().items())
+        for name, snapshot_id in latest.items():
+            if reused[name]:
+                assert_equal(snapshot_id, baseline[name])
+            else:
+                assert snapshot_id != baseline[name]
+                # Superseded snapshot is deleted, lineage is recorded
+                assert baseline[name] not in sim.ec2.snapshots
+                assert_equal(db.get_lineage(snapshot_id)[0],
+                             (snapshot_id, volume_id, baseline[name]))
+        assert all(snapshot_id in sim.ec2.snapshots
+                   for snapshot_id in latest.values())
+
+
+def test_unchanged_volumes_wait_for_lagging_metrics():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        store_instances(conn)
+        restore_instances(conn)
+        sim.clock.sleep(3600)
+        # Periods are reported 7 minutes after they end
+        sim.volume_metrics_delay = 420
+        sim.reset_calls()
+        start = sim.now()
+        results = store_instances(conn)
+        assert all(result.ok and result.value[1] for result in results)
+        assert ("ec2", "create_snapshot") not in sim.calls
+        assert sim.now() - start >= sim.volume_metrics_delay
+
+
+def test_autoscale_setup_and_teardown():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        names = _names(get_instances(conn))
+        sim.reset_calls()
+        results = autoscale_instances(conn)
+        assert all(result.ok for result in results)
+        assert_equal(sorted(sim.autoscale.groups), names)
+        # Alarms use the ARNs returned when the policies were created
+        assert ("autoscale", "get_all_policies") not in sim.calls
+        for alarm in sim.cloudwatch.alarms.values():
+            assert alarm.alarm_actions[0].startswith("arn:aws:autoscaling")
+        assert_equal(sim.calls[("ec2", "get_all_security_groups")], 1)
+
+        # Groups existing before the run fail after retries instead of
+        # ending it
+        results = autoscale_instances(conn)
+        assert not any(result.ok for result in results)
+
+        results = stop_autoscale(conn)
+        assert all(result.ok for result in results)
+        assert_equal(sim.autoscale.groups, {})
+        assert_equal(sim.autoscale.launch_configurations, {})
+
+
+def test_autoscale_setup_is_retried_from_the_failed_step():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        names = _names(get_instances(conn))
+        create_scaling_policy = sim.autoscale.create_scaling_policy
+        failures = []
+
+        def throttled(policy):
+            if not failures:
+                failures.append(policy.as_name)
+                raise BotoServerError(400, "Bad Request", "Throttling")
+            return create_scaling_policy(policy)
+
+        sim.autoscale.create_scaling_policy = throttled
+        results = autoscale_instances(conn)
+        assert all(result.ok for result in results)
+        assert_equal(len(failures), 1)
+        assert_equal(sorted(sim.autoscale.groups), names)
+        assert_equal(len(sim.autoscale.policies), 2 * len(names))
+        assert_equal(len(sim.cloudwatch.alarms), 2 * len(names))
+        assert_equal(sim.calls[("autoscale", "create_auto_scaling_group")],
+                     len(names))
+
+
+def test_store_copies_snapshots_in_a_pipeline():
+    sim = Simulator(public_image_ids=[EC2_DEFAULT_IMAGE_ID])
+    # One copy at a time: the second one is refused, then tried again
+    sim.copy_limit = 1
+    with sim.installed() as conn:
+        initialize_instances(conn)
+        results = store_instances(conn, copy_snapshots=True)
+        assert all(result.ok for result in results)
+        snapshot_ids = sorted(db.get_latest_snapshots())
+        assert_equal(snapshot_ids, sorted(sim.ec2.copies))
+        # Source snapshots of the data volumes are deleted
+        volume_ids = set(sim.ec2.snapshots[i].volume_id for i in snapshot_ids)
+        assert_equal(sorted(i for i, s in sim.ec2.snapshots.items()
+                            if s.volume_id in volume_ids), snapshot_ids)
+        assert sim.calls[("ec2", "copy_snapshot")] > len(snapshot_ids)
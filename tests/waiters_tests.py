@@ -0,0 +1,49 @@
+from nose.tools import *
+from assignment1.waiters import VolumeWaiter, WaiterError
+
+
+class Volume(object):
+    def __init__(self, id, statuses):
+        self.id = id
+        self.statuses = statuses
+
+    @property
+    def status(self):
+        if len(self.statuses) > 1:
+            return self.statuses.pop(0)
+        return self.statuses[0]
+
+
+class Conn(object):
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.calls = 0
+
+    def get_all_volumes(self, volume_ids):
+        self.calls += 1
+        return [self.volumes[i] for i in volume_ids]
+
+
+def test_wait_batches_describe_calls():
+    conn = Conn({
+        "vol-1": Volume("vol-1", ["in-use", "available"]),
+        "vol-2": Volume("vol-2", ["in-use", "in-use", "available"]),
+        "vol-3": Volume("vol-3", ["error"]),
+    })
+    waiter = VolumeWaiter(conn, ("available",), failed=("error",))
+    result = waiter.wait(["vol-1", "vol-2", "vol-3"], timeout=10, delay=0)
+    assert_equal(result.ready, ["vol-1", "vol-2"])
+    assert_equal(result.failed, ["vol-3"])
+    assert_equal(conn.calls, 3)
+    assert_raises(WaiterError, result.check)
+
+
+def test_wait_reports_timed_out_resources():
+    conn = Conn({
+        "vol-1": Volume("vol-1", ["available"]),
+        "vol-2": Volume("vol-2", ["in-use"]),
+    })
+    waiter = VolumeWaiter(conn, ("available",))
+    result = waiter.wait(["vol-1", "vol-2"], timeout=0)
+    assert_equal(result.ready, ["vol-1"])
+    assert_equal(result.timed_out, ["vol-2"])